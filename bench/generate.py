@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import random
+import getopt
+from array import array
+
+# Generates a synthetic directory tree and the matching fdupes report for benchmarks (see run.py).
+#
+#   generate.py [-n files] [-f fanout] [-d depth] [-p files_per_folder] [-r dup_ratio] [-k nested] [-s seed] dir
+#
+# creates dir/tree (the files) and dir/dups (what `fdupes -r dir/tree` would print) and dir/params.json.
+# The same parameters always give the same tree.
+#
+# Folders are created breadth first, fanout subfolders per folder, until there are about files/files_per_folder
+# folders or depth is reached. Duplicates come in two flavours, about dup_ratio/2 of the files each:
+#   - folder copies: a folder gets exactly the files of an earlier folder (same names, same content).
+#   - single files: a file gets the content of a random earlier file.
+# nested adds that many instances of the pattern from the header of process_fdups.py: fl1 holds the same
+# files as fl2 plus the subfolders fl5 and fl6, which are copies of fl3 and fl4. fl1 and fl2 are NOT identical.
+#
+# The content of every file is the id of its duplicate set, so fdupes or the built-in finder (-s) find
+# exactly the sets of the report, too.
+
+DEFAULTS = {"files": 10000, "fanout": 8, "depth": 6, "files_per_folder": 16, "dup_ratio": 0.5, "nested": 10, "seed": 1}
+
+
+class SyntheticTree:
+    def __init__(self, files, fanout, depth, files_per_folder, dup_ratio, nested, seed):
+        generator = random.Random(seed)
+        # folders: parallel arrays, folder 0 is the root. counts: number of files in the folder.
+        self.names = [""]
+        self.parents = array("q", [-1])
+        self.counts = array("q", [0])
+        # origin: the folder whose files this folder copies, -1 for none.
+        self.origin = array("q", [-1])
+        depths = [0]
+        target = max(1, files // files_per_folder)
+        current = 0
+        while current < len(self.names) and len(self.names) < target:
+            if depths[current] < depth:
+                for number in range(fanout):
+                    if len(self.names) >= target:
+                        break
+                    self._add_folder(current, "d{0}".format(number))
+                    depths.append(depths[current] + 1)
+            current += 1
+
+        for folder in range(len(self.names)):
+            self.counts[folder] = files // len(self.names) + (folder < files % len(self.names))
+        for folder in range(1, len(self.names)):
+            if generator.random() < dup_ratio / 2:
+                self.origin[folder] = generator.randrange(folder)
+                self.counts[folder] = self.counts[self.origin[folder]]
+
+        if nested:
+            parent = self._add_folder(0, "nested")
+        for instance in range(nested):
+            pattern = self._add_folder(parent, "p{0}".format(instance))
+            fl3 = self._add_folder(pattern, "fl3", files_per_folder)
+            fl4 = self._add_folder(pattern, "fl4", files_per_folder)
+            fl2 = self._add_folder(pattern, "fl2", files_per_folder)
+            fl1 = self._add_folder(pattern, "fl1", files_per_folder, fl2)
+            self._add_folder(fl1, "fl5", files_per_folder, fl3)
+            self._add_folder(fl1, "fl6", files_per_folder, fl4)
+
+        # single duplicate files: (folder, file) -> earlier (folder, file), encoded as folder * stride + file.
+        self.stride = max(self.counts) + 1
+        self.file_dups = {}
+        for folder in range(1, len(self.names)):
+            if self.origin[folder] >= 0:
+                continue
+            for number in range(self.counts[folder]):
+                if generator.random() < dup_ratio / 2:
+                    source = generator.randrange(folder)
+                    if self.counts[source]:
+                        self.file_dups[folder * self.stride + number] = \
+                            source * self.stride + generator.randrange(self.counts[source])
+
+    def _add_folder(self, parent, name, count=0, origin=-1):
+        self.names.append(name)
+        self.parents.append(parent)
+        self.counts.append(count)
+        self.origin.append(origin)
+        return len(self.names) - 1
+
+    # the original file of the duplicate set of key (key itself for unique files).
+    def canonical(self, key):
+        while True:
+            folder, number = divmod(key, self.stride)
+            if self.origin[folder] >= 0:
+                key = self.origin[folder] * self.stride + number
+            elif key in self.file_dups:
+                key = self.file_dups[key]
+            else:
+                return key
+
+    def folder_paths(self, root):
+        paths = [root]
+        for folder in range(1, len(self.names)):
+            paths.append(paths[self.parents[folder]] + "/" + self.names[folder])
+        return paths
+
+    # writes the files below root and returns the duplicate sets: canonical key -> other keys.
+    def write(self, root):
+        paths = self.folder_paths(root)
+        sets = {}
+        for folder, path in enumerate(paths):
+            os.makedirs(path, exist_ok=True)
+            for number in range(self.counts[folder]):
+                key = folder * self.stride + number
+                canonical = self.canonical(key)
+                if canonical != key:
+                    sets.setdefault(canonical, array("q")).append(key)
+                with open("{0}/f{1}".format(path, number), "wb") as f:
+                    f.write(b"%d\n" % canonical)
+        return sets
+
+    def write_report(self, root, sets, file_name):
+        paths = self.folder_paths(root)
+        def path(key):
+            folder, number = divmod(key, self.stride)
+            return "{0}/f{1}".format(paths[folder], number)
+        # sorted like dupfinder.find_duplicates: the paths of a set, the sets by their first path.
+        # The sets are disjoint - sorting by the first path only keeps just one path per set in memory.
+        order = sorted(sets, key=lambda canonical: min([path(canonical)] + [path(key) for key in sets[canonical]]))
+        with open(file_name, "w") as report:
+            for canonical in order:
+                for file_path in sorted([path(canonical)] + [path(key) for key in sets[canonical]]):
+                    report.write(file_path + "\n")
+                report.write("\n")
+
+
+# generates (or reuses, if the parameters did not change) the tree in directory. Returns the path of the report.
+def generate(directory, **params):
+    params = dict(DEFAULTS, **params)
+    directory = os.path.abspath(directory)
+    params_file = os.path.join(directory, "params.json")
+    report = os.path.join(directory, "dups")
+    if os.path.isfile(params_file):
+        with open(params_file) as f:
+            if json.load(f) == params and os.path.isfile(report):
+                return report
+        raise ValueError("{0} holds a tree generated with other parameters".format(directory))
+    if os.path.exists(os.path.join(directory, "tree")):
+        raise ValueError("{0}/tree exists, but was not generated by generate.py".format(directory))
+
+    tree = SyntheticTree(**params)
+    root = os.path.join(directory, "tree")
+    sets = tree.write(root)
+    tree.write_report(root, sets, report)
+    # written last: a tree without params.json is incomplete.
+    with open(params_file, "w") as f:
+        json.dump(params, f)
+    return report
+
+
+def usage():
+    print("generate.py [-n files] [-f fanout] [-d depth] [-p files_per_folder] [-r dup_ratio] [-k nested] [-s seed] dir")
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:f:d:p:r:k:s:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    names = {"-n": "files", "-f": "fanout", "-d": "depth", "-p": "files_per_folder", "-r": "dup_ratio",
+             "-k": "nested", "-s": "seed"}
+    params = {}
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            return
+        try:
+            params[names[opt]] = float(arg) if opt == "-r" else int(arg)
+        except ValueError:
+            usage()
+            sys.exit(1)
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+    try:
+        print(generate(args[0], **params))
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
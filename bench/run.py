@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import getopt
+import platform
+import resource
+import subprocess
+from contextlib import contextmanager, redirect_stdout
+
+# Benchmark harness: generates synthetic trees (see generate.py) and runs both engines on them,
+# process_fdups.py (node, compact and numpy backend) and lars/Tree.py.
+#
+#   run.py [-n files,...] [-e engine,...] [-j jobs] [-w workdir] [-o results.json] [-b baseline.json]
+#          [-f fanout] [-d depth] [-p files_per_folder] [-r dup_ratio] [-k nested] [-s seed]
+#
+# e.g. run.py -n 10000,1000000,10000000 -o $(git rev-parse --short HEAD).json -b baseline.json
+#
+# Every engine runs in a fresh process per tree size. For every phase the wall and CPU time, the peak RSS
+# during the phase, the directory syscalls (see listing.py) and the read syscalls (/proc/self/io) are
+# recorded. The results are written as JSON; -b prints the changes relative to an earlier result file.
+# Generated trees are kept in workdir and reused by later runs with the same parameters.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from generate import generate, DEFAULTS
+
+ENGINES = ("node", "compact", "numpy", "lars")
+
+
+def read_proc(file_name, fields):
+    values = {}
+    try:
+        with open(file_name) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in fields:
+                    values[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+# peak RSS in KiB since the last reset_peak_rss (since the start of the process if resetting is not supported).
+def peak_rss():
+    values = read_proc("/proc/self/status", ("VmHWM",))
+    if "VmHWM" in values:
+        return values["VmHWM"]
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_peak_rss():
+    try:
+        # Linux >= 4.0: resets VmHWM to the current RSS.
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def read_syscalls():
+    return read_proc("/proc/self/io", ("syscr",)).get("syscr")
+
+
+class Phases:
+    def __init__(self, listing_cache):
+        self.listing_cache = listing_cache
+        self.results = {}
+
+    @contextmanager
+    def measure(self, name):
+        reset_peak_rss()
+        syscalls = self.listing_cache.syscalls
+        reads = read_syscalls()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            result = {"wall_s": round(time.perf_counter() - wall, 4),
+                      "cpu_s": round(time.process_time() - cpu, 4),
+                      "peak_rss_kb": peak_rss(),
+                      "listing_syscalls": self.listing_cache.syscalls - syscalls}
+            if reads is not None:
+                result["read_syscalls"] = read_syscalls() - reads
+            self.results[name] = result
+
+    # measures every call of cls.attribute as phase name.
+    def wrap(self, cls, attribute, name):
+        function = getattr(cls, attribute)
+        def measured(*args, **kwargs):
+            with self.measure(name):
+                return function(*args, **kwargs)
+        setattr(cls, attribute, measured)
+
+
+def run_process_fdups(backend, report, jobs):
+    sys.path.insert(0, REPO_DIR)
+    import listing
+    import compact_tree
+    import process_fdups
+
+    if backend == "numpy":
+        import vectorized
+
+    phases = Phases(listing.cache)
+    with phases.measure("build"):
+        root = compact_tree.CompactTree() if backend != "node" else None
+        _, _, tree = process_fdups.build_tree(process_fdups.read_report(report), process_fdups.report_size(report), root)
+        if backend != "node":
+            tree.finish_build()
+    with phases.measure("stats"):
+        if backend == "numpy":
+            vectorized.stats(tree)
+        else:
+            tree.stats()
+    verdicts = None
+    if jobs > 1:
+        with phases.measure("verify"):
+            if backend != "node":
+                verdicts = compact_tree.verify_folders(tree, jobs)
+            else:
+                verdicts = process_fdups.verify_folders(tree, jobs)
+    with phases.measure("purge"):
+        if backend != "node":
+            compact_tree.drop_unique_folders(tree, verdicts=verdicts)
+        else:
+            process_fdups.drop_unique_folders(tree, verdicts=verdicts)
+    with phases.measure("identical"):
+        if backend == "numpy":
+            groups = list(vectorized.find_identical_folders(tree))
+        elif backend == "compact":
+            groups = list(compact_tree.find_identical_folders(tree))
+        else:
+            groups = list(process_fdups.find_identical_folders(tree))
+    return phases.results, len(groups)
+
+def run_lars(report, target):
+    sys.path.insert(0, os.path.join(REPO_DIR, "lars"))
+    from Tree import Tree, Node
+    # Tree puts the shared modules on sys.path
+    import listing
+
+    phases = Phases(listing.cache)
+    with phases.measure("build"):
+        tree = Tree(Node(False, [], target, -1))
+        id = 0
+        with open(report) as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line:
+                    id += 1
+                    continue
+                parts = os.path.relpath(line, target).split(os.sep)
+                tree.insert(Node(True, [target] + parts[:-1], parts[-1], id))
+    phases.wrap(Tree, "treeshake", "treeshake")
+    phases.wrap(Tree, "create_checksums", "checksums")
+    phases.wrap(Tree, "checksum_index", "checksum_index")
+    phases.wrap(Node, "dfs_find_toplevel_duplicates", "toplevel")
+    duplicates = tree.find_toplevel_duplicates(os.devnull)
+    return phases.results, len(duplicates)
+
+# runs one engine in this process and prints the result as JSON.
+def worker(engine, report, target, jobs):
+    with redirect_stdout(open(os.devnull, "w")):
+        if engine == "lars":
+            results, groups = run_lars(report, target)
+        else:
+            results, groups = run_process_fdups(engine, report, jobs)
+    print(json.dumps({"phases": results, "groups": groups}))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline, results):
+    old = {(run["files"], run["engine"]): run for run in baseline["runs"]}
+    for run in results["runs"]:
+        before = old.get((run["files"], run["engine"]))
+        if before is None:
+            continue
+        print("{0} files, {1}:".format(run["files"], run["engine"]))
+        for phase, result in run["phases"].items():
+            if phase not in before["phases"]:
+                continue
+            previous = before["phases"][phase]
+            print("  {0:14} {1:10.3f}s -> {2:10.3f}s ({3:+.1%})   {4:10} KiB -> {5:10} KiB".format(
+                phase, previous["wall_s"], result["wall_s"],
+                result["wall_s"] / previous["wall_s"] - 1 if previous["wall_s"] else 0,
+                previous["peak_rss_kb"], result["peak_rss_kb"]))
+        if before["groups"] != run["groups"]:
+            print("  identical groups changed: {0} -> {1}".format(before["groups"], run["groups"]))
+
+
+def usage():
+    print("run.py [-n files,...] [-e engine,...] [-j jobs] [-w workdir] [-o results.json] [-b baseline.json] "
+          "[-f fanout] [-d depth] [-p files_per_folder] [-r dup_ratio] [-k nested] [-s seed]")
+
+
+def main():
+    if sys.argv[1:2] == ["--worker"]:
+        engine, report, target, jobs = sys.argv[2:]
+        worker(engine, report, target, int(jobs))
+        return
+
+    sizes = [10000]
+    engines = list(ENGINES)
+    jobs = 1
+    workdir = "bench_trees"
+    output = None
+    baseline = None
+    params = {}
+    names = {"-f": "fanout", "-d": "depth", "-p": "files_per_folder", "-r": "dup_ratio", "-k": "nested", "-s": "seed"}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:e:j:w:o:b:f:d:p:r:k:s:")
+        for opt, arg in opts:
+            if opt == "-h":
+                usage()
+                return
+            elif opt == "-n":
+                sizes = [int(size) for size in arg.split(",")]
+            elif opt == "-e":
+                engines = arg.split(",")
+                if not set(engines) <= set(ENGINES):
+                    raise ValueError(arg)
+            elif opt == "-j":
+                jobs = int(arg)
+            elif opt == "-w":
+                workdir = arg
+            elif opt == "-o":
+                output = arg
+            elif opt == "-b":
+                baseline = arg
+            else:
+                params[names[opt]] = float(arg) if opt == "-r" else int(arg)
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(1)
+
+    results = {"commit": git_commit(), "python": platform.python_version(), "machine": platform.machine(),
+               "params": dict(DEFAULTS, **params), "jobs": jobs, "runs": []}
+    for size in sizes:
+        directory = os.path.join(workdir, str(size))
+        sys.stderr.write("Generating {0} files in {1}...\n".format(size, directory))
+        report = generate(directory, **dict(params, files=size))
+        target = os.path.join(os.path.abspath(directory), "tree")
+        for engine in engines:
+            sys.stderr.write("Running {0} on {1} files...\n".format(engine, size))
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", engine, report, target,
+                                      str(jobs)], stdout=subprocess.PIPE, text=True, check=True)
+            run = json.loads(process.stdout)
+            run.update({"files": size, "engine": engine})
+            results["runs"].append(run)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+    if baseline:
+        with open(baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+from array import array
+from bisect import bisect_left
+
+from traversal import postorder, subfolders
+
+# Compressed bitmaps of non-negative ints (duplicate set ids), roaring-style:
+# the ids are split into chunks of 2**16 by their high bits; a chunk with few ids stores them as a
+# sorted array of the low 16 bits (2 bytes per id), a chunk with many ids as a 65536-bit int.
+# Sparse and clustered sets of ids both stay small, and unions, intersections, subset tests and equality
+# are done chunk by chunk - on ints these are single C-level operations.
+#
+# Bitmaps are immutable: operations return new bitmaps (or one of the operands, unchanged).
+
+CHUNK_BITS = 16
+LOW_MASK = (1 << CHUNK_BITS) - 1
+# chunks with more ids are stored as bitsets (an array of 4096 ids is as big as the bitset).
+ARRAY_LIMIT = 4096
+
+
+def _to_int(lows):
+    bits = bytearray(1 << (CHUNK_BITS - 3))
+    for low in lows:
+        bits[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(bits, "little")
+
+def _int_values(bitset):
+    for position, byte in enumerate(bitset.to_bytes(1 << (CHUNK_BITS - 3), "little")):
+        if byte:
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield position << 3 | bit
+
+def _count(container):
+    return bin(container).count("1") if isinstance(container, int) else len(container)
+
+def _as_int(container):
+    return container if isinstance(container, int) else _to_int(container)
+
+# the canonical container for a set of low bits - equal sets always get equal containers.
+def _container(lows):
+    if len(lows) > ARRAY_LIMIT:
+        return _to_int(lows)
+    return array("H", sorted(lows))
+
+def _normalized(bitset):
+    return _container(set(_int_values(bitset))) if _count(bitset) <= ARRAY_LIMIT else bitset
+
+
+class Bitmap:
+    __slots__ = ("chunks",)
+
+    def __init__(self, chunks=None):
+        # high bits -> container
+        self.chunks = chunks if chunks is not None else {}
+
+    @classmethod
+    def of(cls, values):
+        return union_all((), values)
+
+    def __len__(self):
+        return sum(_count(container) for container in self.chunks.values())
+
+    def __bool__(self):
+        return bool(self.chunks)
+
+    def __contains__(self, value):
+        container = self.chunks.get(value >> CHUNK_BITS)
+        if container is None:
+            return False
+        low = value & LOW_MASK
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        position = bisect_left(container, low)
+        return position < len(container) and container[position] == low
+
+    def __iter__(self):
+        for high in sorted(self.chunks):
+            container = self.chunks[high]
+            lows = _int_values(container) if isinstance(container, int) else container
+            for low in lows:
+                yield high << CHUNK_BITS | low
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.chunks == other.chunks
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Bitmap({0} ids in {1} chunks)".format(len(self), len(self.chunks))
+
+    def __or__(self, other):
+        return union_all((self, other))
+
+    def __and__(self, other):
+        chunks = {}
+        for high, container in self.chunks.items():
+            other_container = other.chunks.get(high)
+            if other_container is None:
+                continue
+            if isinstance(container, int) and isinstance(other_container, int):
+                bitset = container & other_container
+                if bitset:
+                    chunks[high] = _normalized(bitset)
+                continue
+            if isinstance(container, int):
+                container, other_container = other_container, container
+            # container is an array: keep the ids the other chunk has, too.
+            if isinstance(other_container, int):
+                lows = [low for low in container if other_container >> low & 1]
+            else:
+                lows = set(container).intersection(other_container)
+            if lows:
+                chunks[high] = _container(lows)
+        return Bitmap(chunks)
+
+    # the number of ids in both bitmaps - without building the intersection for bitset chunks.
+    def intersection_count(self, other):
+        count = 0
+        for high, container in self.chunks.items():
+            other_container = other.chunks.get(high)
+            if other_container is None:
+                continue
+            if isinstance(container, int) and isinstance(other_container, int):
+                count += bin(container & other_container).count("1")
+            elif isinstance(container, int) or isinstance(other_container, int):
+                bitset, lows = (container, other_container) if isinstance(container, int) else (other_container, container)
+                count += sum(1 for low in lows if bitset >> low & 1)
+            else:
+                count += len(set(container).intersection(other_container))
+        return count
+
+    def issubset(self, other):
+        for high, container in self.chunks.items():
+            other_container = other.chunks.get(high)
+            if other_container is None or _count(container) > _count(other_container):
+                return False
+            if isinstance(container, int) or isinstance(other_container, int):
+                if _as_int(container) & ~_as_int(other_container):
+                    return False
+            elif not set(container).issubset(other_container):
+                return False
+        return True
+
+
+# the union of bitmaps and the ids in values, in one pass over all chunks.
+def union_all(bitmaps, values=()):
+    bitmaps = list(bitmaps)
+    if len(bitmaps) == 1 and not values:
+        # immutable - can be shared.
+        return bitmaps[0]
+    bitsets = {}
+    lows = {}
+    for value in values:
+        lows.setdefault(value >> CHUNK_BITS, set()).add(value & LOW_MASK)
+    for bitmap in bitmaps:
+        for high, container in bitmap.chunks.items():
+            if isinstance(container, int):
+                bitsets[high] = bitsets.get(high, 0) | container
+            else:
+                lows.setdefault(high, set()).update(container)
+    chunks = {}
+    for high, bitset in bitsets.items():
+        # more than ARRAY_LIMIT ids already - stays a bitset.
+        chunks[high] = bitset | _to_int(lows.pop(high)) if high in lows else bitset
+    for high, chunk_lows in lows.items():
+        chunks[high] = _container(chunk_lows)
+    return Bitmap(chunks)
+
+
+# one post-order pass over all folders below root (a Node tree, see process_fdups.py) whose bitmap is not
+# cached: a folder's bitmap is the union of its subfolders' bitmaps and the udids of its files.
+def compute_bitmaps(root):
+    for node in postorder(root, lambda node: () if node._bitmap is not None else subfolders(node)):
+        if node._bitmap is None:
+            node._bitmap = union_all((child._bitmap for child in node.children.values() if child.children),
+                                     [child.udid for child in node.children.values()
+                                      if not child.children and child.udid is not None])
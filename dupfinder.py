@@ -0,0 +1,148 @@
+import os
+import stat
+from hashlib import blake2b
+from concurrent.futures import ProcessPoolExecutor
+
+from hashcache import PARTIAL, FULL
+
+# Built-in replacement for `fdupes -r`, producing the same duplicate sets without an external tool or a
+# temporary report file. Candidates are narrowed down in stages, each one cheaper than the next:
+#
+#   1. walk the roots and group regular files by size - a file with a unique size has no duplicate.
+#   2. hash the first and the last PARTIAL_SIZE bytes of every file in a size group.
+#   3. hash the complete content of the files that still collide - on a process pool.
+#
+# Like fdupes (without -H), several hard links to the same inode are reported once.
+
+PARTIAL_SIZE = 4096
+BLOCK_SIZE = 1 << 20
+DIGEST_SIZE = 16
+
+
+# yields (path, stat result) for all regular files below the roots. Symlinks are not followed.
+def walk(roots):
+    stack = [os.path.abspath(root) for root in reversed(roots)]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry.path, entry.stat(follow_symlinks=False)
+                    except OSError:
+                        # vanished or unreadable entry.
+                        continue
+        except OSError:
+            continue
+
+
+# hashes the first and the last PARTIAL_SIZE bytes (the whole file if it is smaller).
+# Returns None for unreadable files. Runs on the worker processes.
+def partial_hash(path):
+    try:
+        with open(path, "rb") as f:
+            h = blake2b(f.read(PARTIAL_SIZE), digest_size=DIGEST_SIZE)
+            size = os.fstat(f.fileno()).st_size
+            if size > PARTIAL_SIZE:
+                f.seek(max(PARTIAL_SIZE, size - PARTIAL_SIZE))
+                h.update(f.read(PARTIAL_SIZE))
+        return h.digest()
+    except OSError:
+        return None
+
+def full_hash(path):
+    try:
+        h = blake2b(digest_size=DIGEST_SIZE)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                h.update(block)
+        return h.digest()
+    except OSError:
+        return None
+
+
+# splits every (size, [(path, stat key)]) group by the result of hash_function (computed on executor),
+# dropping groups that are left with a single file. Digests found in cache (see hashcache.py) are not
+# computed again, new ones are added to it.
+def _split(groups, hash_function, kind, executor, workers, cache):
+    entries = [entry for _, group in groups for entry in group]
+    digests = [None] * len(entries)
+    if cache is not None:
+        missing = []
+        for number, (path, key) in enumerate(entries):
+            digests[number] = cache.get(key, kind)
+            if digests[number] is None:
+                missing.append(number)
+    else:
+        missing = range(len(entries))
+
+    computed = executor.map(hash_function, [entries[number][0] for number in missing],
+                            chunksize=max(1, len(missing) // (4 * workers)))
+    for number, digest in zip(missing, computed):
+        digests[number] = digest
+    if cache is not None:
+        cache.put_many(((entries[number][1], digests[number]) for number in missing
+                        if digests[number] is not None), kind)
+
+    split = {}
+    digests = iter(digests)
+    for number, (size, group) in enumerate(groups):
+        for entry in group:
+            digest = next(digests)
+            if digest is not None:
+                split.setdefault((number, digest), (size, []))[1].append(entry)
+    return [(size, group) for size, group in split.values() if len(group) > 1]
+
+
+# Returns the duplicate sets below roots as sorted lists of absolute paths. The sets are sorted, too, so
+# build_tree assigns the same unique duplicate ids to an unchanged tree on every run.
+# jobs: number of hashing processes (default: one per CPU). skip_empty: like fdupes -n.
+# cache: an open hashcache.HashCache - files with unchanged metadata are not read at all.
+def find_duplicates(roots, jobs=None, skip_empty=False, cache=None):
+    workers = jobs or os.cpu_count() or 1
+    by_size = {}
+    inodes = set()
+    for path, st in walk(roots):
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        if (st.st_dev, st.st_ino) in inodes:
+            # another hard link to a file we have already seen.
+            continue
+        inodes.add((st.st_dev, st.st_ino))
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        by_size.setdefault(st.st_size, []).append((path, key))
+    inodes = None
+
+    duplicates = []
+    empty = by_size.pop(0, [])
+    if len(empty) > 1 and not skip_empty:
+        # nothing to read - all empty files are equal.
+        duplicates.append([path for path, _ in empty])
+
+    groups = [(size, group) for size, group in by_size.items() if len(group) > 1]
+    by_size = None
+    if groups:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            groups = _split(groups, partial_hash, PARTIAL, executor, workers, cache)
+            # files up to 2 * PARTIAL_SIZE have been read completely already.
+            large = [(size, group) for size, group in groups if size > 2 * PARTIAL_SIZE]
+            groups = [(size, group) for size, group in groups if size <= 2 * PARTIAL_SIZE]
+            groups += _split(large, full_hash, FULL, executor, workers, cache)
+        duplicates += [[path for path, _ in group] for _, group in groups]
+
+    for group in duplicates:
+        group.sort()
+    duplicates.sort()
+    return duplicates
+
+
+# Turns duplicate sets into fdupes output lines (one path per line, a blank line after each set)
+# - the input build_tree expects.
+def format_fdupes(duplicates):
+    for group in duplicates:
+        for path in group:
+            yield path + "\n"
+        yield "\n"
@@ -0,0 +1,67 @@
+from traversal import preorder, children
+
+# Inverted index of a Node tree (see process_fdups.py): unique duplicate id -> the files (leaf nodes) of that
+# duplicate set. Filled by build_tree and kept up to date whenever files leave the tree (the purge, the watch
+# mode), so the folders holding a set are found in O(set size) - no walk over the tree, no per-folder summary.
+
+
+class DuplicateIndex:
+    def __init__(self):
+        self.sets = {}
+
+    # the index of an existing tree, e.g. one built without it.
+    @classmethod
+    def of(cls, root):
+        index = cls()
+        for node in preorder(root, children):
+            if not node.children:
+                index.add(node)
+        return index
+
+    def add(self, leaf):
+        if leaf.udid is not None:
+            self.sets.setdefault(leaf.udid, set()).add(leaf)
+
+    def discard(self, leaf):
+        files = self.sets.get(leaf.udid)
+        if files is not None:
+            files.discard(leaf)
+            if not files:
+                del self.sets[leaf.udid]
+
+    def discard_subtree(self, node):
+        for node in preorder(node, children):
+            if not node.children:
+                self.discard(node)
+
+    def udids(self):
+        return sorted(self.sets)
+
+    # the files of the duplicate set udid still in the tree.
+    def files(self, udid):
+        return self.sets.get(udid, ())
+
+    def count(self, udid):
+        return len(self.sets.get(udid, ()))
+
+    # the folders directly holding a file of the duplicate set.
+    def candidate_parents(self, udid):
+        return {leaf.parent for leaf in self.sets.get(udid, ())}
+
+    # the folders below (or including) root that hold a file of the duplicate set udid, at any depth.
+    # Every folder on the way up from a file is looked at once - O(set size * depth) at most.
+    def folders_containing(self, udid, root):
+        below = set()
+        outside = set()
+        for leaf in self.sets.get(udid, ()):
+            path = []
+            node = leaf.parent
+            while node is not None and node is not root and node not in below and node not in outside:
+                path.append(node)
+                node = node.parent
+            if node is None or node in outside:
+                outside.update(path)
+            else:
+                below.update(path)
+                below.add(root)
+        return below
@@ -0,0 +1,273 @@
+import os
+import heapq
+import tempfile
+from collections import namedtuple
+from itertools import groupby
+
+from signature import leaf_signature, folder_signature
+from listing import ListingCache, check_folder, MISSING, UNIQUE
+from results import files_size, sizes_total
+
+# Out-of-core variant of build_tree + drop_unique_folders + find_identical_folders (process_fdups.py)
+# for reports too big for any in-memory tree. Memory is bounded by the budget given, not by the report:
+#
+#   1. the report is streamed; every file becomes a record (depth of its folder, folder, name, udid, size).
+#      The records are sorted externally - deepest folders first, then by folder - in runs of at most
+#      `memory` bytes that are spilled to disk and merged.
+#   2. the folders are signed bottom-up, one level at a time: the records of a level are merged with the
+#      signatures of the subfolders computed on the level below, which come sorted by folder already -
+#      a level writes its results in the order the next level reads them. Every folder is checked against
+#      the disk (listing.check_folder) exactly like the purge does it, one listing at a time.
+#   3. the (signature, folder) pairs are sorted externally; equal signatures end up next to each other.
+#      The groups are sorted by size (externally again) and streamed.
+#
+# Folder keys: the names joined with "\0" (which no name can contain). Sorting keys sorts folders
+# component-wise, so the parents of sorted folders are sorted, too - "/a/b" < "/a/b-c" although
+# "/a/b/x" > "/a/b-c/y". Records are lines: no path in an fdupes report contains a newline.
+#
+# Same groups and sizes as the in-memory engine, but in another order: the in-memory engine streams every
+# group as soon as it is complete, here the groups are known once all signatures are sorted - so they are
+# streamed largest first; groups of the same size are ordered by their first path.
+
+# counts like the ones the serial engine prints: before and after the purge, the root not counted.
+ExternalResult = namedtuple("ExternalResult", ["groups", "file_count", "folder_count", "purged_file_count",
+                                               "purged_folder_count", "discarded"])
+
+# fields within a record. Names and keys can not contain it.
+SEPARATOR = b"\0\0"
+# the deepest folder a report may have - depths are stored inverted, so that sorting puts them first.
+MAX_DEPTH = 99999
+# the same for the sizes of the groups.
+MAX_GROUP_SIZE = 9999999999
+# runs open at once - more are merged into one while the lines are added.
+MERGE_FAN_IN = 64
+
+
+# Sorts lines (bytes, ending in b"\n") of any number with about memory bytes of RAM.
+class ExternalSorter:
+    def __init__(self, memory, directory=None):
+        self.memory = memory
+        self.directory = directory
+        self.buffer = []
+        self.buffered = 0
+        self.runs = []
+
+    def add(self, line):
+        self.buffer.append(line)
+        # the bytes object and its slot in the list.
+        self.buffered += len(line) + 41
+        if self.buffered >= self.memory:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort()
+        self.runs.append(self._write_run(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+        if len(self.runs) >= MERGE_FAN_IN:
+            runs = self.runs
+            self.runs = [self._write_run(heapq.merge(*runs))]
+            for run in runs:
+                run.close()
+
+    def _write_run(self, lines):
+        run = tempfile.TemporaryFile(dir=self.directory)
+        run.writelines(lines)
+        run.seek(0)
+        return run
+
+    # the lines in sorted order. Call once.
+    def __iter__(self):
+        if not self.runs:
+            self.buffer.sort()
+            yield from self.buffer
+            self.buffer = []
+            return
+        if self.buffer:
+            self._spill()
+        try:
+            yield from heapq.merge(*self.runs)
+        finally:
+            for run in self.runs:
+                run.close()
+            self.runs = []
+
+
+def _key(names):
+    return b"\0".join(names)
+
+def _path(key):
+    return os.fsdecode(b"/" + key.replace(b"\0", b"/"))
+
+# records of one level: [folder key, name, udid, size] for files,
+# [folder key, name, signature (hex, b"" if purged), number of files below, size] for folders.
+# Sizes in bytes, b"" if unknown.
+def _records(lines):
+    for line in lines:
+        yield line[:-1].split(SEPARATOR)
+
+
+def _size_field(size):
+    return b"%d" % size if size is not None else b""
+
+def _size(field):
+    return int(field) if field else None
+
+# Phase 1 - returns the sorted records (all levels, deepest first), the counts, the deepest level and whether
+# any file has a size. sizes: see external_identical_folders.
+def _sorted_files(lines, memory, directory, sizes):
+    sorter = ExternalSorter(memory, directory)
+    file_count = discarded = 0
+    unique_duplicate_id = 0
+    deepest = 0
+    sized = False
+    for path in lines:
+        # same rules as build_tree.
+        path = os.fsdecode(path)
+        if path.strip() == "":
+            if sizes is not None:
+                # the set is complete - its size is in the records now.
+                sizes.pop(unique_duplicate_id, None)
+            unique_duplicate_id += 1
+            continue
+        if not path.startswith("/"):
+            discarded += 1
+            continue
+        size = sizes.get(unique_duplicate_id) if sizes is not None else None
+        sized = sized or size is not None
+        names = os.fsencode(path.rstrip()).split(b"/")
+        names.pop(0)
+        depth = len(names) - 1
+        if depth > MAX_DEPTH:
+            raise ValueError("path too deep: " + path)
+        deepest = max(deepest, depth)
+        sorter.add(b"%05d%s%s%s%s%d%s%s\n" % (MAX_DEPTH - depth, _key(names[:-1]), SEPARATOR, names[-1], SEPARATOR,
+                                             unique_duplicate_id, SEPARATOR, _size_field(size)))
+        file_count += 1
+    return sorter, file_count, discarded, deepest, sized
+
+
+# Phase 2 - signs the folders of one level. files: the records of the files on this level, subfolders: those
+# of the folders signed on the level below. Writes the records of this level's folders to output (for the
+# level above) and (signature, files, size, folder) records to signatures. Returns the counts before and after the purge.
+# stat: the sizes of the surviving files are taken from the file system.
+def _sign_level(files, subfolders, output, signatures, verify, listing_cache, stat):
+    counts = [0, 0, 0, 0]
+    merged = heapq.merge(files, subfolders, key=lambda record: record[0])
+    for key, records in groupby(merged, key=lambda record: record[0]):
+        file_udids = {}
+        file_sizes = {}
+        folder_signatures = {}
+        folder_files = {}
+        folder_sizes = {}
+        for record in records:
+            if len(record) == 4:
+                # listed twice: the later set wins, like in build_tree.
+                udid = int(record[2])
+                if udid > file_udids.get(record[1], -1):
+                    file_udids[record[1]] = udid
+                    file_sizes[record[1]] = _size(record[3])
+            else:
+                folder_signatures[record[1]] = bytes.fromhex(record[2].decode())
+                folder_files[record[1]] = int(record[3])
+                folder_sizes[record[1]] = _size(record[4])
+        counts[0] += len(file_udids)
+        counts[1] += len(folder_signatures)
+
+        verdict = None
+        path = _path(key) if key else "/"
+        if verify:
+            names = {os.fsdecode(name) for name in file_udids}
+            names.update(os.fsdecode(name) for name in folder_signatures)
+            verdict = check_folder(path, names, listing_cache)
+            # one listing at a time - nothing is kept.
+            listing_cache.clear()
+        if verdict == MISSING:
+            print("\rCannot find directory '{0}' - removing path from tree.".format(path))
+            file_udids = {}
+            folder_signatures = {}
+        elif verdict == UNIQUE:
+            file_udids = {}
+        if stat:
+            for name in file_udids:
+                file_sizes[name] = files_size([os.path.join(path, os.fsdecode(name))])
+        children = [leaf_signature(udid) for udid in file_udids.values()]
+        children += [signature for signature in folder_signatures.values() if signature]
+        counts[2] += len(file_udids)
+        counts[3] += sum(1 for signature in folder_signatures.values() if signature)
+
+        signature = folder_signature(children) if children else b""
+        file_count = len(file_udids) + sum(folder_files[name] for name, signature in folder_signatures.items()
+                                           if signature)
+        size = _size_field(sizes_total([file_sizes[name] for name in file_udids] +
+                                       [folder_sizes[name] for name, signature in folder_signatures.items()
+                                        if signature]))
+        if key:
+            parent, _, name = key.rpartition(b"\0")
+            signature = signature.hex().encode()
+            # a purged folder is written, too - the parent needs its name for the check.
+            output.write(SEPARATOR.join((parent, name, signature, b"%d" % file_count, size)) + b"\n")
+            if signature:
+                signatures.add(SEPARATOR.join((signature, b"%d" % file_count, size, key)) + b"\n")
+    return counts
+
+
+# lines: like build_tree. memory: bytes of RAM for each sort buffer. directory: for the temporary files
+# (default: the system's temp dir) - needs about three times the size of the report.
+# verify: check the folders against the disk like the purge. sizes: udid -> file size in bytes, e.g.
+# report_formats.ReportMetadata.sizes filled while the lines are read - every set is removed once it is read,
+# so the dict never holds the whole report. stat: without sizes, the sizes of the groups are taken from the
+# file system - one stat per surviving file, so only worth it if they are written out.
+# Returns an ExternalResult with the groups of identical folders as a lazy iterator of (paths, number of
+# files in one folder, their size in bytes or None if unknown), largest groups first.
+def external_identical_folders(lines, memory, directory=None, verify=True, sizes=None, stat=False):
+    sorted_files, file_count, discarded, deepest, sized = _sorted_files(lines, memory, directory, sizes)
+    file_records = _records(sorted_files)
+    signatures = ExternalSorter(memory, directory)
+    listing_cache = ListingCache()
+    totals = [0, 0, 0, 0]
+
+    subfolders = None
+    pending = next(file_records, None)
+    for depth in range(deepest, -1, -1):
+        prefix = b"%05d" % (MAX_DEPTH - depth)
+
+        def level_files():
+            nonlocal pending
+            while pending is not None and pending[0].startswith(prefix):
+                pending[0] = pending[0][len(prefix):]
+                yield pending
+                pending = next(file_records, None)
+
+        level_subfolders = _records(subfolders) if subfolders is not None else ()
+        output = tempfile.TemporaryFile(dir=directory)
+        # a report without any sizes is like none at all.
+        counts = _sign_level(level_files(), level_subfolders, output, signatures, verify, listing_cache,
+                             stat and not sized)
+        if subfolders is not None:
+            subfolders.close()
+        output.seek(0)
+        subfolders = output
+        for index, count in enumerate(counts):
+            totals[index] += count
+    if subfolders is not None:
+        subfolders.close()
+
+    # the subfolder records of every level count the folders once - the root is never a subfolder.
+    return ExternalResult(_groups(signatures, memory, directory), file_count, totals[1], totals[2], totals[3],
+                          discarded)
+
+
+# Phase 3 - the groups of identical folders, largest first.
+def _groups(signatures, memory, directory):
+    groups = ExternalSorter(memory, directory)
+    for _, records in groupby((line[:-1].split(SEPARATOR, 3) for line in signatures), key=lambda record: record[0]):
+        records = list(records)
+        if len(records) > 1:
+            # equal signatures - equal numbers and sizes of files.
+            keys = b"\0\0\0".join(key for _, _, _, key in records)
+            groups.add(SEPARATOR.join((b"%010d" % (MAX_GROUP_SIZE - len(records)), records[0][1], records[0][2],
+                                       keys)) + b"\n")
+    for line in groups:
+        _, file_count, size, keys = line[:-1].split(SEPARATOR, 3)
+        yield [_path(key) for key in keys.split(b"\0\0\0")], int(file_count), _size(size)
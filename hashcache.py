@@ -0,0 +1,70 @@
+import sqlite3
+
+# Persistent content hash cache for dupfinder, so repeated scans of the same (mostly unchanged) archive
+# only cost a stat per file. Entries are keyed by (st_dev, st_ino, size, mtime_ns): a file whose metadata
+# did not change is assumed to have the same content and is not read again.
+# Every run gets a new generation number; when the cache grows beyond max_entries, the entries that were
+# used longest ago are evicted.
+
+PARTIAL = 0
+FULL = 1
+
+DEFAULT_MAX_ENTRIES = 20000000
+
+
+class HashCache:
+    def __init__(self, file_name, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(file_name)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+                kind INTEGER NOT NULL, digest BLOB NOT NULL, used INTEGER NOT NULL,
+                PRIMARY KEY (dev, ino, size, mtime_ns, kind)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        self.generation = (row[0] if row else 0) + 1
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (self.generation,))
+
+    # key: (st_dev, st_ino, st_size, st_mtime_ns). Returns the digest or None.
+    def get(self, key, kind):
+        row = self.db.execute("SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ? "
+                              "AND kind = ?", key + (kind,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE hashes SET used = ? WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ? "
+                        "AND kind = ?", (self.generation,) + key + (kind,))
+        return row[0]
+
+    # entries: iterable of (key, digest)
+    def put_many(self, entries, kind):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (key + (kind, digest, self.generation) for key, digest in entries))
+
+    def evict(self):
+        count = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        if count > self.max_entries:
+            with self.db:
+                self.db.execute("DELETE FROM hashes WHERE (dev, ino, size, mtime_ns, kind) IN "
+                                "(SELECT dev, ino, size, mtime_ns, kind FROM hashes ORDER BY used LIMIT ?)",
+                                (count - self.max_entries,))
+
+    def close(self):
+        self.db.commit()
+        self.evict()
+        self.db.close()
+
+    def report(self):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0
+        return "Hash cache: {0} hits, {1} misses ({2:.1%} hit ratio).".format(self.hits, self.misses, ratio)
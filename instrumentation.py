@@ -0,0 +1,120 @@
+import sys
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Phase timers, counters and progress output for process_fdups.py.
+#
+# Metrics records the wall and CPU time of every phase and named counters (nodes visited, bytes read, ...)
+# and writes them as JSON, e.g. at exit. With trace_memory, the memory allocated by Python is traced, too
+# (tracemalloc - slows everything down considerably, for diagnosis only).
+# NullMetrics has the same interface and does nothing: instrumentation can stay in the code for good.
+
+class Metrics:
+    def __init__(self, trace_memory=False):
+        self.phases = []
+        self.counters = {}
+        self.trace_memory = trace_memory
+        self.started = time.perf_counter()
+        if trace_memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            phase = {"name": name, "wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu}
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                phase["traced_bytes"] = current
+                phase["traced_peak_bytes"] = peak
+                # the ten places holding the most memory at the end of the phase.
+                statistics = tracemalloc.take_snapshot().statistics("lineno")[:10]
+                phase["top_allocations"] = [str(statistic) for statistic in statistics]
+            self.phases.append(phase)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def as_dict(self):
+        return {"wall_s": time.perf_counter() - self.started, "phases": self.phases, "counters": self.counters}
+
+    def dump(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+
+class NullMetrics:
+    def phase(self, name):
+        return nullcontext()
+
+    def count(self, name, amount=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def dump(self, file_name):
+        pass
+
+
+# Progress output for long loops. add_progress only counts; the clock is looked at every CHECK_EVERY calls
+# and a line is written at most every INTERVAL seconds - and only if the output is a terminal.
+# When a loop is done, finish() writes one final line (terminal or not) and adds the count to metrics.
+class Progress:
+    CHECK_EVERY = 1024
+    INTERVAL = 0.5
+
+    # output: a file, sys.stdout (at the time of writing) by default.
+    def __init__(self, output=None, metrics=None):
+        self.output = output
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.start(None, "")
+
+    # total: expected amount (None if unknown). counter: name of the metrics counter the amount is added to.
+    def start(self, total, message, counter=None):
+        self.total = total
+        self.message = message
+        self.counter = counter
+        self.current = 0
+        self.countdown = self.CHECK_EVERY
+        self.started = self.last_output = time.monotonic()
+        self.interactive = (self.output or sys.stdout).isatty()
+
+    def add_progress(self, amount=1):
+        self.current += amount
+        self.countdown -= 1
+        if not self.countdown:
+            self.countdown = self.CHECK_EVERY
+            now = time.monotonic()
+            if self.interactive and now - self.last_output >= self.INTERVAL:
+                self.last_output = now
+                output = self.output or sys.stdout
+                output.write("\r" + self.status(now))
+                output.flush()
+
+    def status(self, now):
+        rate = self.current / (now - self.started) if now > self.started else 0
+        if self.total:
+            line = "{0}... [{1:.2%}] {2:.0f}/s".format(self.message, self.current / self.total, rate)
+            if rate and self.current < self.total:
+                line += ", ETA {0:.0f}s".format((self.total - self.current) / rate)
+            return line + "   "
+        # total unknown (e.g. reading from a pipe) - just show how far we got.
+        return "{0}... [{1}] {2:.0f}/s   ".format(self.message, self.current, rate)
+
+    def finish(self):
+        if self.message:
+            (self.output or sys.stdout).write("\r{0}... [100.00%] in {1:.1f}s.\n".format(self.message, time.monotonic() - self.started))
+        if self.counter:
+            self.metrics.count(self.counter, self.current)
+        self.start(None, "")
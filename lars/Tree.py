@@ -1,9 +1,72 @@
 __author__ = 'lars'
 
 from functools import reduce
-from collections import Counter
-from hashlib import md5
+from hashlib import blake2b
 import os
+import sys
+
+# the modules shared with process_fdups.py live one level up
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from listing import cache as listing_cache
+from results import files_size
+from ranking import rank_groups, listed_size
+from traversal import preorder, preorder_edges, postorder, preorder_with_path, postorder_with_path, ancestors
+
+# size of the node checksums in bytes
+CHECKSUM_SIZE=16
+
+# accessors for the traversals (see traversal.py) - the dfs_* methods use an explicit stack, no recursion
+def children(node):
+    return node.children
+
+def children_of_folders(node):
+    # files found by fdupes are not looked into
+    return () if node.isFile else node.children
+
+def parent(node):
+    return node.parent
+
+def join_path(parent_path,node):
+    """
+    the full path of node from the already resolved full path of its parent, see preorder_with_path
+    :param parent_path: node.parent.full_path()
+    :param node: Node
+    :rtype: str
+    """
+    if node.parent.parent is None and not node.parent.insert_path:
+        # the root is special: its full path has a leading "/", the paths below it start with its name
+        return node.parent.name+"/"+node.name
+    return parent_path+"/"+node.name
+
+def node_size(node,sizes=None):
+    """
+    size of the files below node in bytes, from the listings of the treeshake (see listing.ListingCache.sizes)
+    :param node: Node
+    :param sizes: optional dict id -> file size in bytes reported by the duplicate finder, no listings needed
+    :rtype: int or None if unknown
+    """
+    if sizes is not None:
+        total=0
+        for child in preorder(node,children):
+            if child.isFile:
+                if child.id not in sizes:
+                    return None
+                total+=sizes[child.id]
+        return total
+    files=[path for child,path in preorder_with_path(node,children,node.full_path(),join_path) if child.isFile]
+    return listed_size(files,listing_cache)
+
+def write_group(writer,nodes):
+    """
+    writes a set of dups with the number and size of the files below the first node
+    :param writer: results.ResultWriter
+    :param nodes: a list of Nodes with the same checksum
+    :rtype: None
+    """
+    first=nodes[0]
+    files=[path for node,path in preorder_with_path(first,children,first.full_path(),join_path) if node.isFile]
+    writer.write_group(sorted(node.full_path() for node in nodes),len(files),files_size(files))
+
 class Tree:
     def __init__(self,root):
         """
@@ -50,77 +113,109 @@ class Tree:
         """
         return self.root.dfs_generate_checksum_list([])
 
-    def find_toplevel_duplicates(self,filename):
+    def checksum_index(self):
+        """
+        returns the checksums shared by more than one potential duplicate, with their nodes
+        :rtype: {checksum: [Node]}
+        """
+        return self.root.dfs_checksum_index()
+
+    def find_toplevel_duplicates(self,filename,writer=None):
         """
         :param filename: the name of an existing file to be overwritten with information about duplicates
+        :param writer: optional results.ResultWriter, gets the toplevel nodes of every set of dups
         :rtype: None
         """
 
         self.treeshake()
         self.create_checksums()
-        checksum_list=self.generate_checksum_list()
-        duplicate_checksums=[x for x, y in Counter(checksum_list).items() if y > 1]
+        index=self.checksum_index()
 
         #this dictionary contains checksums as keys and for each key a list of nodes with this checksum
         duplicates={}
 
-        if duplicate_checksums:
+        if index:
             print("there are folders or files with the same checksum")
 
-            # traverse the tree, each node compares its own checksum to the list of duplicate checksums
-            duplicates=self.root.dfs_find_toplevel_duplicates(duplicate_checksums,duplicates, True)
+            # each node of the index looks up the checksum of its parent
+            duplicates=self.root.dfs_find_toplevel_duplicates(index,duplicates, True)
 
             #write results to file
-            file=open(filename,"w")
-            for key in duplicates:
-                duplicates[key].sort(key=lambda tuple:tuple[0],reverse=True)
-                if duplicates[key][0][0]==False:
-                    continue
-                print("a set of dups",file=file)
-                for value in duplicates[key]:
-                    (toplevel,node)=value
-                    if toplevel:
-                        print("/".join(node.path)+"/"+node.name,file=file)
-                    else:
-                        print("non-toplevel occurences: "+"/".join(node.path)+"/"+node.name,file=file)
-
-                print("-----------------------",file=file)
+            with open(filename,"w") as file:
+                for key in duplicates:
+                    duplicates[key].sort(key=lambda tuple:tuple[0],reverse=True)
+                    if duplicates[key][0][0]==False:
+                        continue
+                    print("a set of dups",file=file)
+                    for value in duplicates[key]:
+                        (toplevel,node)=value
+                        if toplevel:
+                            print(node.full_path(),file=file)
+                        else:
+                            print("non-toplevel occurences: "+node.full_path(),file=file)
+
+                    print("-----------------------",file=file)
+                    toplevel_nodes=[node for toplevel,node in duplicates[key] if toplevel]
+                    if writer and len(toplevel_nodes)>1:
+                        # one toplevel node alone is no set of dups - its copies are inside duplicate folders
+                        write_group(writer,toplevel_nodes)
 
         return duplicates
 
 
-    def find_all_duplicates(self,filename):
+    def find_all_duplicates(self,filename,writer=None):
         """
         :param filename: the name of an existing file to be overwritten with information about duplicates
+        :param writer: optional results.ResultWriter, gets every set of dups as soon as it is found
         :rtype: None
         """
 
         self.treeshake()
         self.create_checksums()
-        checksum_list=self.generate_checksum_list()
-        duplicate_checksums=[x for x, y in Counter(checksum_list).items() if y > 1]
 
         #this dictionary contains checksums as keys and for each key a list of nodes with this checksum
-        duplicates={}
+        duplicates=self.checksum_index()
 
-        if duplicate_checksums:
+        if duplicates:
             print("there are folders or files with the same checksum")
 
-            for dup_checksum in duplicate_checksums:
-                duplicates[dup_checksum]=[]
-                self.root.dfs_search_for_checksum(dup_checksum,duplicates[dup_checksum])
+            if writer:
+                for dup_checksum in duplicates:
+                    write_group(writer,duplicates[dup_checksum])
 
-        file=open(filename,"w")
-        for key in duplicates:
-            print("a set of dups",file=file)
-            for value in duplicates[key]:
-                print("/".join(value.path)+"/"+value.name,file=file)
+        with open(filename,"w") as file:
+            for key in duplicates:
+                print("a set of dups",file=file)
+                for value in duplicates[key]:
+                    print(value.full_path(),file=file)
 
-            print("-----------------------",file=file)
+                print("-----------------------",file=file)
 
         return duplicates
 
 
+    def largest_duplicates(self,duplicates,k,deadline=None,sizes=None):
+        """
+        the sets of dups freeing the most space if all but one node were deleted, see ranking.py
+        set listing_cache.sizes before the treeshake (or pass sizes), or every folder is listed again
+        :param duplicates: the result of find_toplevel_duplicates or find_all_duplicates
+        :param k: number of sets
+        :param deadline: optional time.monotonic() value, the best sets found until then are returned
+        :param sizes: optional dict id -> file size, e.g. report_formats.ReportMetadata.sizes
+        :rtype: list of ranking.RankedGroup with lists of Nodes, largest first
+        """
+        groups=[]
+        for nodes in duplicates.values():
+            if nodes and isinstance(nodes[0],tuple):
+                # find_toplevel_duplicates: only the toplevel occurences count
+                nodes=[node for toplevel,node in nodes if toplevel]
+            if len(nodes)>1:
+                groups.append(nodes)
+        # with a deadline the sets with the most deletable files are sized first
+        files=lambda nodes:(len(nodes)-1)*sum(1 for child in preorder(nodes[0],children) if child.isFile)
+        ranked,_=rank_groups(groups,lambda nodes:node_size(nodes[0],sizes),k,deadline,files if deadline is not None else None)
+        return ranked
+
     def print_graphml(self,filename):
         """
         :param filename: name of an existing file to be overwritten with a graph in graphml format
@@ -159,17 +254,22 @@ class Tree:
 
 
 class Node:
+    # one Node per file found by fdupes - no per-instance __dict__
+    # the path is not stored: nodes in the tree know their parent, the path is resolved when it is needed
+    __slots__ = ("isFile", "parent", "insert_path", "name", "id", "children", "potentialDup", "checksum")
+
     def __init__(self, isFile, path, name, id):
         """
 
         :param isFile: has this been found by fdupes ? is it a file ?
-        :param path: a list of foldernames as strings
+        :param path: a list of foldernames as strings, only kept until the node is inserted into a tree
         :param name: name of this file/folder
         :param id: if this was found by fdupes, set to correct id, -1 otherwise
         :rtype : Node
         """
         self.isFile=isFile
-        self.path=path
+        self.parent=None
+        self.insert_path=path
         self.name=name
         self.id=id
         self.children=[]
@@ -178,6 +278,25 @@ class Node:
         self.potentialDup=True
         self.checksum=None
 
+    @property
+    def path(self):
+        """
+        a list of foldernames as strings, computed from the parents
+        :rtype: []
+        """
+        if self.parent is None:
+            return list(self.insert_path or [])
+        names=[node.name for node in ancestors(self.parent,parent)]
+        names.reverse()
+        return names
+
+    def full_path(self):
+        """
+        the path of this file/folder as a string
+        :rtype: str
+        """
+        return "/".join(self.path)+"/"+self.name
+
 
     def dfs_insert(self,node):
         """
@@ -185,27 +304,31 @@ class Node:
         :param node:Node to be inserted into the tree
         :type node: None
         """
-        node_path=node.path.copy()
+        node_path=node.insert_path
 
         # search for the path in the tree, it's not going to exist completely
         # this method returns the "longest match"
         current_node=self.dfs_search_for_partial_path(node_path)
 
-        # get the path that was found
-        partial_path=current_node.path.copy()
-        partial_path.append(current_node.name)
+        # the number of path elements that were found: the nodes from here down to current_node
+        matched=1
+        for ancestor in ancestors(current_node,parent):
+            if ancestor is self:
+                break
+            matched+=1
 
         # this is the rest, which has to be created by hand
-        path_rest=node_path[len(partial_path):len(node_path)]
-
-        current_path=partial_path
+        path_rest=node_path[matched:len(node_path)]
 
         for elem in path_rest:
-            temp_node=Node(False,current_path,elem,-1)
+            temp_node=Node(False,None,elem,-1)
+            temp_node.parent=current_node
             current_node.children.append(temp_node)
             current_node=temp_node
-            current_path=current_path+[elem]
 
+        # from now on the path follows from the parents
+        node.parent=current_node
+        node.insert_path=None
         current_node.children.append(node)
 
     def dfs_search_for_checksum(self,checksum,dups_list):
@@ -215,39 +338,48 @@ class Node:
         :param dups_list: list of nodes with this checksum
         :rtype: []
         """
-        if self.checksum.digest()==checksum:
-            dups_list.append(self)
-        for child in self.children:
-            dups_list=child.dfs_search_for_checksum(checksum,dups_list)
+        for node in preorder(self,children):
+            if node.checksum==checksum:
+                dups_list.append(node)
         return dups_list
 
-    def dfs_find_toplevel_duplicates(self,checksum_list, duplicates, toplevel):
+    def dfs_find_toplevel_duplicates(self,index, duplicates, toplevel):
         """
-        compares the checksum of all nodes (dfs) to the checksum_list,
-        if a match is found, the dfs continues
-        all duplicates are appended to the dict, but the toplevel dups are marked as such
+        takes all duplicates from the index of this node (see dfs_checksum_index),
+        the toplevel dups are marked as such
         :param duplicates: a dict of duplicates
-        :param checksum_list: a list of duplicate checksums
+        :param index: the result of dfs_checksum_index
         :param toplevel: boolean flag, is this inside of a duplicate, or outside
         :rtype:{}
         """
-        checksum_string=self.checksum.digest()
-
-        if checksum_string in checksum_list:
-            if checksum_string in duplicates:
-                duplicates[checksum_string].append((toplevel,self))
-            else:
-                duplicates[checksum_string]=[(toplevel,self)]
-
-            # this is the most toplevel duplicate, still look at all the other files
-            for child in self.children:
-                duplicates=child.dfs_find_toplevel_duplicates(checksum_list,duplicates, False)
-        else:
-            # no duplicate found so far, lets continue the dfs
-            for child in self.children:
-                duplicates=child.dfs_find_toplevel_duplicates(checksum_list,duplicates, True)
+        for checksum_string,nodes in index.items():
+            for node in nodes:
+                # the children of a duplicate are not toplevel - a dict lookup, no search
+                if node is self:
+                    node_toplevel=toplevel
+                else:
+                    node_toplevel=node.parent.checksum not in index
+                if checksum_string in duplicates:
+                    duplicates[checksum_string].append((node_toplevel,node))
+                else:
+                    duplicates[checksum_string]=[(node_toplevel,node)]
         return duplicates
 
+    def dfs_checksum_index(self):
+        """
+        one dfs over all nodes: the checksums of the potential duplicates that occur more than once,
+        each with its nodes in dfs order
+        :rtype: {checksum: [Node]}
+        """
+        index={}
+        for node in preorder(self,children):
+            if node.potentialDup:
+                if node.checksum in index:
+                    index[node.checksum].append(node)
+                else:
+                    index[node.checksum]=[node]
+        return {checksum:nodes for checksum,nodes in index.items() if len(nodes)>1}
+
     def dfs_search_for_path(self,path):
         """
         returns the node that matches this path
@@ -256,14 +388,15 @@ class Node:
         """
         if self.name!=path[0]:
             raise Exception("the dfs has led to a problem")
-        elif len(path)>1:
-            folder=path[1]
-            for child in self.children:
+        node=self
+        for folder in path[1:]:
+            for child in node.children:
                 if folder==child.name:
-                    return child.dfs_search_for_path(path[1:len(path)])
-            raise Exception("the path does not exist in the tree")
-        else:
-            return self
+                    node=child
+                    break
+            else:
+                raise Exception("the path does not exist in the tree")
+        return node
 
     def dfs_search_for_partial_path(self,path):
         """
@@ -273,41 +406,32 @@ class Node:
         """
         if self.name!=path[0]:
             raise Exception("the dfs has led to a problem")
-        elif len(path)>1:
-            folder=path[1]
-            for child in self.children:
+        node=self
+        for folder in path[1:]:
+            for child in node.children:
                 if folder==child.name:
-                    return child.dfs_search_for_partial_path(path[1:len(path)])
-            return self
-        else:
-            return self
+                    node=child
+                    break
+            else:
+                break
+        return node
 
     def dfs_create_checksums(self):
         """
         computes a checksum for all nodes
         :rtype: None
         """
-        if self.children==[]:
-            self.checksum=md5()
-            self.checksum.update(str(self.id).encode("utf-8"))
-            return
-
-        else:
-            children_checksums=[]
-            for child in self.children:
-                child.dfs_create_checksums()
-                children_checksums.append(child.checksum.digest())
-
-            if self.potentialDup:
-                children_checksums.sort()
-                self.checksum=md5()
-                for child_checksum in children_checksums:
-                    self.checksum.update(child_checksum)
-                return
+        # checksums are stored as 128 bit blake2b digests (bytes), not as hash objects
+        # children before their parents
+        for node in postorder(self,children):
+            if node.children==[]:
+                node.checksum=blake2b(str(node.id).encode("utf-8"),digest_size=CHECKSUM_SIZE).digest()
+            elif node.potentialDup:
+                children_checksums=sorted(child.checksum for child in node.children)
+                node.checksum=blake2b(b"".join(children_checksums),digest_size=CHECKSUM_SIZE).digest()
             else:
                 #this is not a duplicate, give it a checksum no duplicate could have, so that it is not accidentally found
-                self.checksum=md5()
-                self.checksum.update(str(-1).encode("utf-8"))
+                node.checksum=blake2b(str(-1).encode("utf-8"),digest_size=CHECKSUM_SIZE).digest()
 
     def dfs_print_graphml(self,file):
         """
@@ -315,10 +439,10 @@ class Node:
         :param file: file which contains the data for this tree
         :rtype: None
         """
-        print("<node id=\""+self.name+"\" />",file=file)
-        for child in self.children:
-            child.dfs_print_graphml(file)
-            print("<edge source=\""+self.name+"\" target=\""+child.name+"\"/>",file=file)
+        for parent,node in preorder_edges(self,children):
+            print("<node id=\""+node.name+"\" />",file=file)
+            if parent is not None:
+                print("<edge source=\""+parent.name+"\" target=\""+node.name+"\"/>",file=file)
 
     def dfs_print_graphdot(self,file):
         """
@@ -326,35 +450,39 @@ class Node:
         :param file: file which contains the data for this tree
         :rtype: None
         """
-        for child in self.children:
-            #print(("".join(self.path)+self.name).replace("/","_").replace("\n","")+"->"+("".join(child.path)+child.name).replace("/","_").replace("\n","")+";",file=file)
-            print("\""+"/".join(self.path)+"/"+self.name+"\""+"->"+"\""+"/".join(child.path)+"/"+child.name+"\"",file=file)
-            #print("\""+self.name+"\""+"->"+"\""+child.name+"\"",file=file)
-            child.dfs_print_graphdot(file)
+        # each node carries its own and its parent's full path
+        paths=preorder_with_path(self,children,(self.full_path(),None),lambda paths,child:(join_path(paths[0],child),paths[0]))
+        for child,(child_path,parent_path) in paths:
+            if child is self:
+                continue
+            #print(("".join(parent.path)+parent.name).replace("/","_").replace("\n","")+"->"+("".join(child.path)+child.name).replace("/","_").replace("\n","")+";",file=file)
+            print("\""+parent_path+"\""+"->"+"\""+child_path+"\"",file=file)
+            #print("\""+parent.name+"\""+"->"+"\""+child.name+"\"",file=file)
 
     def dfs_treeshake(self):
         """
         Check if this could potentially be a duplicate.
         Return True if yes, False otherwise
         """
-        # if this is a file, found by fdupes, it can be a duplicate
-        if self.isFile:
-            return True
+        # subfolders are decided before their parent
+        for node,path in postorder_with_path(self,children_of_folders,self.full_path(),join_path):
+            # if this is a file, found by fdupes, it can be a duplicate
+            if node.isFile:
+                continue
 
-        # if the folder contains a subfolder which is not a duplicate, it isn't a duplicate itself
-        for child in self.children:
-            if not child.dfs_treeshake():
-                self.potentialDup=False
+            # if the folder contains a subfolder which is not a duplicate, it isn't a duplicate itself
+            for child in node.children:
+                if not (child.isFile or child.potentialDup):
+                    node.potentialDup=False
 
-        # each child in the tree was created by fdupes and is a potential duplicate
-        # if there are more subfolders / files in this dir than there are children, this is not a duplicate
-        num_files=os.listdir("/".join(self.path)+"/"+self.name+"")
-        print(os.listdir("/".join(self.path)+"/"+self.name+""))
-        if len(num_files)>len(self.children):
-            self.potentialDup=False
-            return False
+            # each child in the tree was created by fdupes and is a potential duplicate
+            # if there are more subfolders / files in this dir than there are children, this is not a duplicate
+            # one scandir per folder, memoized for the run (see listing.py)
+            listing=listing_cache.listing(path)
+            if listing is None or len(listing)>len(node.children):
+                node.potentialDup=False
 
-        return self.potentialDup
+        return self.isFile or self.potentialDup
 
     def dfs_generate_checksum_list(self,checksum_list):
         """
@@ -362,12 +490,10 @@ class Node:
         :param checksum_list: a list of all checksums computed so far, call with an empty list
         :rtype: []
         """
-        for child in self.children:
-            child.dfs_generate_checksum_list(checksum_list)
-
-        # only if this is a potential duplicate, check its filesum
-        if self.potentialDup:
-            checksum_list.append(self.checksum.digest())
+        for node in postorder(self,children):
+            # only if this is a potential duplicate, check its filesum
+            if node.potentialDup:
+                checksum_list.append(node.checksum)
         return checksum_list
 
 
@@ -2,49 +2,119 @@ __author__ = 'lars'
 
 from Tree import Tree
 from Tree import Node
-from subprocess import call
 import os
+import sys
+import getopt
+
+# Tree puts the shared modules on sys.path
+from dupfinder import find_duplicates
+from results import ResultWriter
+from scanner import scan_lines, ScannerError
+from report_formats import read_sets, ReportMetadata, ReportFormatError, FORMATS
+from listing import cache as listing_cache
+
+# number of sets of dups printed, largest reclaimable space first
+TOP=10
+
+def insert_duplicate(tree,target,line,id):
+    """
+    inserts one file of a set of dups into the tree
+    :param tree: Tree, its root is the target
+    :param target: absolute path of the scanned folder
+    :param line: absolute path of the file
+    :param id: number of the set of dups
+    :rtype: None
+    """
+    print(line,id)
+
+    # split the path below the target into folders and filename
+    parts=os.path.relpath(line,target).split(os.sep)
+    path=[target]+parts[0:-1]
+    name=parts[-1]
+    new_node=Node(True,path,name,id)
+    tree.insert(new_node)
+
+def usage():
+    print("process_lars.py [--scanner command [--input-format "+"|".join(FORMATS)+"]]")
+    sys.exit(1)
 
 def main():
+    try:
+        opts,args=getopt.getopt(sys.argv[1:],"",["scanner=","input-format="])
+    except getopt.GetoptError:
+        usage()
+    # e.g. --scanner "fdupes -r": its output is read while it scans, no fdupes_output.txt
+    scanner=dict(opts).get("--scanner")
+    # e.g. --scanner "fclones group" --input-format fclones: the sizes of its report are used for the ranking
+    input_format=dict(opts).get("--input-format")
+    if input_format is not None and (input_format not in FORMATS or not scanner):
+        usage()
+
     print(os.listdir("."))
     target=input("please enter a filename to be scanned for duplicates:")
     print("target:" + target)
-    call("fdupes -r \""+target+"\" > fdupes_output.txt",shell=True)
+    # the root node carries the full path of the target, all other nodes are below it
+    target=os.path.abspath(target)
+
+    root=Node(False,[],target,-1)
+    tree=Tree(root)
 
-    with open("fdupes_output.txt") as file:
+    metadata=None
+    if scanner and input_format:
+        # parsed by report_formats.py, the sets are still inserted as they come in
+        metadata=ReportMetadata()
+        try:
+            for id,duplicate_set in enumerate(read_sets(scan_lines(scanner,[target]),input_format)):
+                metadata.add(id,duplicate_set)
+                print("set of duplicates",id)
+                for line in duplicate_set.paths:
+                    insert_duplicate(tree,target,os.fsdecode(line),id)
+        except (ScannerError,ReportFormatError) as e:
+            print(e)
+            sys.exit(1)
+    elif scanner:
+        # the sets of dups are inserted as they come in - the tree is built while the scanner runs
         id=0
-        root=Node(False,[],target,-1)
-        tree=Tree(root)
-        
-        for line in file:
-            # strip off the trailing newline
-            line=line[0:-1]
-            if line=="":
-                print("empty line")
-                id+=1
-                continue
-            print(line,id)
-
-            # split the line into path and filename
-            parts=line.split("/")
-            path=parts[0:-1]
-
-            # special considerations for paths starting with /
-
-            if path[0]=="":
-                path[1]="/"+path[1]
-                path=path[1:-1]
-            else:
-                path[1]="./"+path[1]
-                path=path[1:-1]
-
-            path_string="/".join(path)
-            name=parts[-1]
-            new_node=Node(True,path,name,id)
-            tree.insert(new_node)
-
-        tree.print_graphdot("test.graphdot")
-        tree.find_toplevel_duplicates("dups_found.txt")
+        in_set=False
+        try:
+            for line in scan_lines(scanner,[target]):
+                line=os.fsdecode(line).rstrip("\n")
+                if not line:
+                    # an empty line ends a set of dups
+                    if in_set:
+                        id+=1
+                        in_set=False
+                    continue
+                if not line.startswith("/"):
+                    # e.g. "N bytes each:" of fdupes -S
+                    continue
+                if not in_set:
+                    print("set of duplicates",id)
+                    in_set=True
+                insert_duplicate(tree,target,line,id)
+        except ScannerError as e:
+            print(e)
+            sys.exit(1)
+    else:
+        # built-in duplicate search (see dupfinder.py) - no fdupes, no fdupes_output.txt
+        for id,duplicates in enumerate(find_duplicates([target])):
+            print("set of duplicates",id)
+            for line in duplicates:
+                insert_duplicate(tree,target,line,id)
+
+    tree.print_graphdot("test.graphdot")
+    sizes=metadata.sizes if metadata is not None and metadata.sizes else None
+    if sizes is None:
+        # the treeshake records the file sizes for the ranking
+        listing_cache.sizes=True
+    # the same sets of dups, machine-readable (see results.py)
+    with ResultWriter("dups_found.jsonl") as writer:
+        duplicates=tree.find_toplevel_duplicates("dups_found.txt",writer)
+
+    for ranked in tree.largest_duplicates(duplicates,TOP,sizes=sizes):
+        print(ranked.reclaimable,"bytes reclaimable:")
+        for node in ranked.group:
+            print(" "+node.full_path())
 
 if __name__=="__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,112 @@
+import os
+import threading
+
+# Directory listings for the verification phases of both engines (process_fdups.py and lars/Tree.py).
+# One os.scandir per directory: the entry types come from d_type, so files and folders are told apart
+# without a stat per entry (only symlinks need one). Listings are only memoized if a later phase asks for
+# the same directory again (keep, or sizes for the ranking) - then that costs a dict lookup. Otherwise a
+# listing is dropped as soon as check_folder has decided: kept for the whole run, the listings of a big
+# report take about 100 bytes per file, several times a CompactTree.
+
+class Listing:
+    __slots__ = ("files", "folders", "sizes")
+
+    def __init__(self, files, folders, sizes=None):
+        # names of the non-directories (os.walk semantics: symlinks to folders count as folders)
+        self.files = files
+        self.folders = folders
+        # file name -> size in bytes, if the cache records sizes (see ListingCache)
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.files) + len(self.folders)
+
+
+class ListingCache:
+    # sizes: record the sizes of the files, too. Costs a stat per file (except on Windows, where
+    # scandir gets them for free) - set it before the listings are made, e.g. for ranking by size.
+    # The sizes are read by a later phase, so these listings are kept like with keep.
+    # keep: memoize the listings (see invalidate and clear).
+    def __init__(self, sizes=False, keep=False):
+        self.sizes = sizes
+        self.keep = keep
+        self.listings = {}
+        # listings may be requested from worker threads (see parallel.bounded_map).
+        self.lock = threading.Lock()
+        # number of scandir/stat calls issued vs. listings served from the cache.
+        self.syscalls = 0
+        self.hits = 0
+
+    # Returns the Listing of path or None if path is not a (readable) directory.
+    def listing(self, path):
+        with self.lock:
+            listing = self.listings.get(path, False)
+            if listing is not False and (listing is None or listing.sizes is not None or not self.sizes):
+                self.hits += 1
+                return listing
+
+        syscalls = 1
+        files, folders = [], []
+        sizes = {} if self.sizes else None
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        # d_type says "link" - finding out what it points to takes a stat.
+                        syscalls += 1
+                    if entry.is_dir():
+                        folders.append(entry.name)
+                    else:
+                        files.append(entry.name)
+                        if sizes is not None:
+                            try:
+                                sizes[entry.name] = entry.stat(follow_symlinks=False).st_size
+                            except OSError:
+                                # vanished in the meantime.
+                                pass
+                            syscalls += 1
+            listing = Listing(files, folders, sizes)
+        except (FileNotFoundError, NotADirectoryError):
+            listing = None
+
+        with self.lock:
+            self.syscalls += syscalls
+            if self.keep or self.sizes:
+                self.listings[path] = listing
+        return listing
+
+    # forget path, e.g. because it changed on disk.
+    def invalidate(self, path):
+        with self.lock:
+            self.listings.pop(path, None)
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+    def report(self):
+        return "{0} directory syscalls, {1} listings served from cache.".format(self.syscalls, self.hits)
+
+# shared by all phases of a run.
+cache = ListingCache()
+
+
+# Verdicts of check_folder.
+MISSING = 0   # the folder does not exist (anymore)
+UNIQUE = 1    # the folder contains files that fdupes did not report ==> unique content
+CLEAN = 2     # every file in the folder is known to the tree
+
+# Compares the files on disk in path with known_names (anything supporting "in": the names of the
+# files and folders the tree has for this folder). Does not modify anything - safe to run on worker threads.
+def check_folder(path, known_names, listing_cache=cache):
+    try:
+        listing = listing_cache.listing(path)
+    except PermissionError:
+        # we can not tell what is in there - so we can not claim it holds duplicates only.
+        return UNIQUE
+    if listing is None:
+        return MISSING
+    for file in listing.files:
+        if file not in known_names:
+            return UNIQUE
+    return CLEAN
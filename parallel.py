@@ -0,0 +1,18 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs func on every item on a pool of jobs threads and yields (item, result) in the order of items.
+# At most jobs * backlog calls are in flight, so items may be a lazy generator over a huge tree -
+# results are handed out as soon as all earlier ones are done.
+# Meant for latency-bound I/O (directory listings on NFS/CIFS): the GIL is released while waiting.
+def bounded_map(func, items, jobs, backlog=4):
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= jobs * backlog:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
@@ -1,8 +1,34 @@
 #!/usr/bin/python3
 import os
 import sys
+import atexit
 import getopt
-import pickle
+import mmap
+import time
+from collections import Counter
+
+import compact_tree
+from compact_tree import CompactTree, NO_NODE
+from snapshot import save_snapshot, load_snapshot, SnapshotError
+from signature import leaf_signature, folder_signature, identical_groups
+import listing
+from listing import check_folder, MISSING, UNIQUE
+from parallel import bounded_map
+from dupfinder import find_duplicates, format_fdupes
+from traversal import preorder, preorder_with_depth, preorder_with_path, postorder, ancestors, children, subfolders, \
+    parent, join_path
+from hashcache import HashCache
+from similarity import find_similar_folders
+from instrumentation import Metrics, NullMetrics, Progress
+from bitmap import Bitmap, compute_bitmaps
+from duplicate_index import DuplicateIndex
+from results import ResultWriter, files_size, FORMATS as RESULT_FORMATS
+from sharded import sharded_identical_folders
+from ranking import rank_groups, listed_size
+from watch import TreeWatcher
+from external import external_identical_folders
+from scanner import scan_lines, ScannerError
+from report_formats import read_sets, as_report_lines, ReportMetadata, ReportFormatError, FORMATS as REPORT_FORMATS
 
 # Idee zum Algorithmus:
 # Problem
@@ -30,35 +56,9 @@ import pickle
 #                      Ein v_i, dessen t_i zu keinem anderen Unterordner identisch war, ist für diesen v_i einzigartig. Entferne diesen v_i vom Baum.
 #             Problem: Was tun, falls die v_i mehr als Ordner haben? Dann wird die Separierung ein riesiges Chaos..
 
-class ProgressPrinter:
-    def __init__(self):
-        self.total   = 0
-        self.current = 0
-        self.message = ""
-
-    def print(self):
-        if self.current % 500 == 0:
-            sys.stdout.write("\r{0}... [{1:.2%}]".format(self.message, self.current/self.total))
-
-    def set_total(self, total):
-        self.total = total
-
-    def add_progress(self):
-        self.current += 1
-        self.print()
-
-    def reset(self):
-        if self.message:
-            print("\r{0}... [100.00%].".format(self.message))
-        self.total = self.current = 0
-        self.message = ""
-
-    def parametrize(self, total, message):
-        self.reset()
-        self.total = total
-        self.message = message
-
-pprinter = ProgressPrinter()
+# replaced by main if --metrics is given.
+metrics = NullMetrics()
+pprinter = Progress()
 
 
 #TODO: in Ast und Blatt trennen.
@@ -66,138 +66,94 @@ pprinter = ProgressPrinter()
 class Node:
     # every node has one parent and indefinitely many children.
     # only specify a udid for leafs.
+    # no per-instance __dict__ - there is one Node per file in the report.
+    __slots__ = ("name", "parent", "children", "udid", "_signature", "_bitmap")
+
     def __init__(self, name, udid=None):
         self.name = name
         self.parent = None
-        self.children = []
+        # name -> node. filesystems do not allow two entries of a folder to share a name,
+        # so lookups and membership tests are O(1) instead of a scan over a list.
+        self.children = {}
         # References other nodes that are equal according to fdupes
         self.udid = udid
-        self.highest_udid = None
-        self.lowest_udid = None
-
-    def find_deepest_nodes(self):
-        nodes = [child for child in self.children if child.children]
-
-        deepest_nodes = []
-        if nodes:
-            for node in nodes:
-                deepest_nodes += node.find_deepest_nodes()
-            return deepest_nodes
-        # self is a deepest node.
-        else:
-            return self
+        # cached content signature, see signature(). None = not computed (yet) or invalidated.
+        self._signature = None
+        # cached Bitmap of the duplicate sets below a folder, see bitmap(). Never set on files.
+        self._bitmap = None
 
+    # removes this node (and its subtree) from the tree, together with every parent that becomes empty.
     def remove(self):
-        for child in self.children:
-            child.remove()
-
-        if self.is_leaf():
-            save_parent = self.parent
-            self.parent = None
-            save_parent.remove_if_empty(self.parent)
-
-
-    def find_file(self, udid):
-        # we don't have that udid.
-        if udid > self.highest_udid or udid < self.lowest_udid:
-            return []
-
-        found_files = []
-        # else: this node or one or more of its children-nodes hold this udid.
-        for child in self.children:
-            if child.is_leaf():
-                if child.udid == udid:
-                    found_files += [child]
-            else:
-                found_files += child.find_file(udid)
-
-        return found_files
+        index = tree_index(self)
+        if index is not None:
+            index.discard_subtree(self)
+        save_parent = self.parent
+        self.parent = None
+        if save_parent:
+            save_parent.remove_if_empty()
 
     # removes this node and every parent node that would then become empty.
     def remove_if_empty(self):
-        # drop all children that seperated themselves from the tree
-        self.children = [child for child in self.children if self.parent]
-        if not self.children:
-            save_parent = self.parent
-            self.parent = None
-            save_parent.remove_if_empty(self.parent)
-
-    # recursively propagate a change in udid.
-    def udid_added(self, udid):
-        assert bool(self.children) # do not call on leafs
-        if not self.highest_udid or udid > self.highest_udid:
-            self.highest_udid = udid
-        if not self.lowest_udid or udid< self.lowest_udid:
-            self.lowest_udid = udid
-        if self.parent:
-            self.parent.udid_added(udid)
-
-    def udid_removed(self, udid):
-        assert bool(self.children) # do not call on leafs
-        assert( self.lowest_udid <= udid <= self.highest_udid )
-
-        if self.lowest_udid != udid and self.highest_udid != udid:
-            return
-
-        children = [child for child in self.children if not child.children]
-        nodes = [child for child in self.children if child.children]
-
-        # find a new lower bound if the old one was removed.
-        if self.lowest_udid == udid:
-            # either children or nodes is not empty
-            new_lowest_udid = children[0].udid if bool(children) else nodes[0].lowest_udid
-            for child in children:
-                new_lowest_udid = min(new_lowest_udid, child.udid)
-            for node in nodes:
-                new_lowest_udid = min(new_lowest_udid, node.lowest_udid)
-            self.lowest_udid = new_lowest_udid
-
-        # find a new upper bound if the old one was removed.
-        if self.highest_udid == udid:
-            # either children or nodes is not empty
-            new_highest_udid = children[0].udid if bool(children) else nodes[0].highest_udid # children[0] exists (see first assertion)
-            for child in children:
-                new_highest_udid = min(new_highest_udid, child.udid)
-            for node in nodes:
-                new_highest_udid = min(new_highest_udid, node.lowest_udid)
-            self.lowest_udid = new_highest_udid
-
-        if self.parent:
-            self.parent.udid_removed(udid)
-
-    def set_udid(self, udid):
+        node = self
+        while node is not None:
+            # drop all children that seperated themselves from the tree
+            node.children = {name: child for name, child in node.children.items() if child.parent}
+            node.invalidate_signature()
+            if node.children or not node.parent:
+                break
+            save_parent = node.parent
+            node.parent = None
+            node = save_parent
+
+    # index: the DuplicateIndex of the tree, if it has one (see tree_index).
+    def set_udid(self, udid, index=None):
         assert not self.children # call on leafs only
-        save_udid = self.udid
+        if index is not None:
+            index.discard(self)
         self.udid = udid
-        self.parent.udid_added(udid)
-        if save_udid:
-            self.parent.udid_removed(save_udid)
+        if index is not None:
+            index.add(self)
+        self.invalidate_signature()
 
-    # Returns file and folder counts (recursively, top-down).
-    def stats(self, file_count=0, folder_count=0):
+    # Returns file and folder counts below this node (top-down).
+    def stats(self):
         global pprinter
-        pprinter.add_progress()
-
-        subfolders = [child for child in self.children if child.children]
-        # folders and files of this particular node.
-        folder_count += len(subfolders)
-        file_count += len(self.children) - folder_count
-        # folders and files of this node's children and their children respective.
-        for subfolder in subfolders:
-            # subfolders should report their OWN counts - do not accumulate our counts.
-            # therefore (0,0) (default values) and not (file_count, folder_count)
-            additional_file_count, additional_folder_count = subfolder.stats()
-            file_count += additional_file_count
-            folder_count += additional_folder_count
-
+        file_count = folder_count = 0
+        for node in preorder(self, subfolders):
+            pprinter.add_progress()
+            folders = sum(1 for _ in subfolders(node))
+            # folders and files of this particular node.
+            folder_count += folders
+            file_count += len(node.children) - folders
         return file_count, folder_count
 
     def is_leaf(self):
         return not self.children
 
     def add_child(self, node):
-        self.children.append(node)
+        self.children[node.name] = node
         node.parent = self
+        self.invalidate_signature()
+
+    # creates the missing nodes along folders (the path components below this node),
+    # makes the last one a file with the given udid and returns the number of nodes created.
+    # Called on a RootNode, the file is added to its DuplicateIndex.
+    def insert(self, folders, udid):
+        index = getattr(self, "index", None)
+        created = 0
+        current_node = self
+        for folder in folders:
+            maybe_node = current_node.get_child(folder)
+            if maybe_node:
+                current_node = maybe_node
+                continue
+            created += 1
+            new_node = Node(folder)
+            current_node.add_child(new_node)
+            current_node = new_node
+        # current_node is now a leaf.
+        current_node.set_udid(udid, index)
+        return created
 
     # true if this node holds the same files
     # false if one of those folders holds files that the other one does not.
@@ -205,85 +161,156 @@ class Node:
     # undefined if this node owns other nodes.
     def equal_content(self, node):
         # do only call on nodes that do not have any nodes.
-        assert not [child for child in self.children if child.children]
-        assert not [child for child in self.children if child.children]
-        my_udids =    [child.udids for child in self.children]
-        other_udids = [child.udids for child in node.children]
-
-        my_udids.sort()
-        other_udids.sort()
-
-        return my_udids == other_udids
+        assert not [child for child in self.children.values() if child.children]
+        assert not [child for child in node.children.values() if child.children]
+        if len(self.children) != len(node.children):
+            return False
+        # different sets of duplicate sets - no need to count.
+        if self.bitmap() != node.bitmap():
+            return False
+        # compare the udid multisets - linear instead of sorting both lists.
+        return Counter(child.udid for child in self.children.values()) == \
+               Counter(child.udid for child in node.children.values())
 
     def has_child(self, name):
-        return name in [c.name for c in self.children]
+        return name in self.children
 
     def get_child(self, name):
-        # assuming there are no two children sharing the same name
-        for child in self.children:
-            if child.name == name:
-                return child
-        return None
+        return self.children.get(name)
 
     def print_recursive(self, level=0):
-        indent = "  " * level
-        if self.is_leaf():
-            print(indent + self.name + ", UDID={0}".format(self.udid))
-        else:
-            print(indent + self.name + ", UDIDS=[{0}...{1}]".format(self.lowest_udid, self.highest_udid))
-        for child in self.children:
-            child.print_recursive(level+1)
+        for node, depth in preorder_with_depth(self, children):
+            indent = "  " * (level + depth)
+            if node.is_leaf():
+                print(indent + node.name + ", UDID={0}".format(node.udid))
+            else:
+                print(indent + node.name + "/")
 
 
-    def drop_leafs(self):
+    def drop_leafs(self, index=None):
         # Nodes, die keine Kinder mehr haben, löschen (rekursiv nach oben)
         #TODO: ==> sicherstellen, dass keine Ordner Leafs sind (illegal!)
         # leaf = no children
-        self.children = [c for c in self.children if c.children]
-
-    def path(self, first_incovation=True):
-        if self.parent:
-            return self.parent.path(False) + "/" + self.name
-        else:
-            # root is special... that sucks.
-            if self.name == "/":
-                if first_incovation:
-                    return "/"
-                else:
-                    return ""
-            return self.name
-
-    # sum of leaf IDs multiplied by their number, added to the subnodes' hashes, if any.
-    # todo: für eine Hashfunktion sehr teuer - Cache einbauen.
-    def hash(self):
-        leafs = [child for child in self.children if not child.children]
-        nodes = [child for child in self.children if child.children]
-
-        sum = 0
-        for leaf in leafs:
-            sum += leaf.udid
+        if index is not None:
+            for child in self.children.values():
+                if not child.children:
+                    index.discard(child)
+        self.children = {name: c for name, c in self.children.items() if c.children}
+        self.invalidate_signature()
+
+    def path(self):
+        names = [node.name for node in ancestors(self, parent)]
+        # root is special... that sucks.
+        if names[-1] == "/":
+            if len(names) == 1:
+                return "/"
+            names[-1] = ""
+        return "/".join(reversed(names))
+
+    # content signature of this node (see signature.py): equal signatures <=> equal content.
+    # Cached - computed for the whole uncached part of the subtree in one pass, recomputed after mutations only.
+    def signature(self):
+        if self._signature is None:
+            compute_signatures(self)
+        return self._signature
+
+    # the duplicate sets (udids) of all files below this folder as a Bitmap (see bitmap.py).
+    # Cached like the signature: computed for the uncached part of the subtree in one pass.
+    def bitmap(self):
+        if not self.children:
+            return Bitmap.of(() if self.udid is None else (self.udid,))
+        if self._bitmap is None:
+            compute_bitmaps(self)
+        return self._bitmap
+
+    # to be called whenever the subtree below this node changes.
+    # a cached signature (bitmap) implies cached signatures (bitmaps) for the whole subtree,
+    # so we can stop at the first ancestor that has neither cached anyway.
+    def invalidate_signature(self):
+        self._signature = None
+        self._bitmap = None
+        node = self.parent
+        while node is not None and (node._signature is not None or node._bitmap is not None):
+            node._signature = None
+            node._bitmap = None
+            node = node.parent
+
+
+# size of the blocks read from a pipe when streaming a report.
+READ_CHUNK_SIZE = 1 << 20
+
+# Streams the lines (as bytes, including the newline) of an fdupes report.
+# source is a file name, "-" for stdin or an already opened binary file object.
+# Regular files are mmap'd, pipes are read chunk by chunk - the report is never held in memory as a whole.
+def read_report(source, use_mmap=True):
+    if source == "-":
+        yield from _read_chunks(sys.stdin.buffer)
+        return
+    if isinstance(source, (str, bytes)):
+        with open(source, "rb") as f:
+            yield from read_report(f, use_mmap)
+        return
 
-        sum *= len(leafs)
+    if use_mmap:
+        try:
+            mm = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, AttributeError):
+            # empty file, pipe or not backed by a file descriptor.
+            mm = None
+        if mm is not None:
+            with mm:
+                yield from iter(mm.readline, b"")
+            return
 
-        for node in nodes:
-            sum += node.hash()
+    yield from _read_chunks(source)
 
-        return sum
+def _read_chunks(f):
+    rest = b""
+    while True:
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b"\n")
+        # the last piece is incomplete (or empty) - keep it for the next chunk.
+        rest = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if rest:
+        yield rest
+
+# Returns the size of the report in bytes or None if it is not known up front (pipes, stdin).
+def report_size(source):
+    if source == "-":
+        return None
+    try:
+        size = os.stat(source).st_size
+    except OSError:
+        return None
+    return size or None
 
 
-def build_tree(lines):
+# lines may be any iterable of str or bytes lines - a list from readlines() as well as read_report().
+# total is the size of the report in bytes, used for progress reporting only (None if unknown).
+# tree is the (empty) root to build into - a Node by default, a CompactTree for huge reports.
+def build_tree(lines, total=None, tree=None):
     global pprinter
     folder_count = 0
     file_count = 0
-    tree = Node("/")
-    line_count = len(lines)
-    print("{0} files to process.".format(line_count))
+    if tree is None:
+        tree = RootNode("/")
+    if total is None and hasattr(lines, "__len__"):
+        # legacy: a list of lines.
+        total = sum(len(line) for line in lines)
+    if total:
+        print("{0} bytes to process.".format(total))
     discarded = 0
     unique_duplicate_id = 0
 
-    pprinter.parametrize(line_count, "Building directory tree")
+    pprinter.start(total, "Building directory tree", "bytes_read")
     for path in lines:
-        pprinter.add_progress()
+        pprinter.add_progress(len(path))
+        # paths are decoded the way the filesystem would - undecodable names survive as surrogates.
+        path = os.fsdecode(path)
         # Create a node.
         if path.strip() == "": # empty line indicates: new set of duplicates will follow.
             unique_duplicate_id += 1
@@ -297,126 +324,315 @@ def build_tree(lines):
         folders = path.split("/")
         # throw away the first token ''
         folders.pop(0)
-        current_node = tree
-        for folder in folders:
-            maybe_node = current_node.get_child(folder)
-            if maybe_node:
-                current_node = maybe_node
-                continue
-            else:
-                folder_count += 1
-                new_node = Node(folder)
-                current_node.add_child(new_node)
-                current_node = new_node
-        # current_node is now a leaf.
-        current_node.set_udid(unique_duplicate_id)
-        folder_count -= 1
+        # the last created node is the file itself.
+        folder_count += tree.insert(folders, unique_duplicate_id) - 1
         file_count += 1
 
-    pprinter.reset()
+    pprinter.finish()
     print(" Note: {0} invalid files discarded.".format(discarded))
 
     return (file_count, folder_count, tree)
 
 
-def usage():
-    print("process_fdups [-h] [-c checkpoint_file]")
+# the root of a tree built by build_tree - additionally owns the DuplicateIndex of the tree.
+class RootNode(Node):
+    __slots__ = ("index",)
 
-# recursively.
-# assumes correct parametrization of pprinter.
-def drop_unique_folders(node):
-    global pprinter
-    pprinter.add_progress()
-    # also contains folder names - but filesystems demand that no "nodes (files or folders) share the same name.
-    # ==> no false positives.
-    children_names = [c.name for c in node.children]
-    path = node.path()
-    if not os.path.isdir(path):
-        print("\rCannot find directory '{0}' - removing path from tree.".format(path))
-        # the owning recursive call will interpret this as deletion-request.
-        node.parent = None
-        return
+    def __init__(self, name="/"):
+        super().__init__(name)
+        self.index = DuplicateIndex()
+
+# the DuplicateIndex of the tree node belongs to - None for trees without a RootNode (e.g. those of the shards).
+def tree_index(node):
+    for node in ancestors(node, parent):
+        root = node
+    return getattr(root, "index", None)
 
-    _,_,files = next(os.walk(path))
-    # alphabetische Sortierung einfuehren? Dann O(n) statt O(n²). Aber nicht erst in dieser Funktion sortieren -
-    # das ist dann nicht viel billiger (?)
-    for file in files:
-        if not file in children_names:
-            #print(file + " is not in " + str(children_names))
-            # the folder contains a file that was listed as a duplicate by fdupes.
-            # ==> the folder has unique content.
-            node.drop_leafs()
-            # the leafs are dropped, no need to look for even more unique-ness
-            break
 
-    # drop folders only
-    for child in [n for n in node.children if not n.is_leaf()]:
-        drop_unique_folders(child)
-        # purge folders that lost all their childs and are leafs now (illegal)!
-        if child.is_leaf():
-            # schedule for deletion
-            child.parent = None
+# one post-order pass over all nodes below root whose signature is not cached.
+def compute_signatures(root):
+    # cached subtrees are not entered at all.
+    for node in postorder(root, lambda node: () if node._signature is not None else node.children.values()):
+        if node._signature is not None:
+            continue
+        if not node.children:
+            # files. a folder that lost all its children is an empty folder.
+            node._signature = leaf_signature(node.udid) if node.udid is not None else folder_signature([])
+        else:
+            node._signature = folder_signature(child._signature for child in node.children.values())
 
-    # only take the items that are not scheduled for deletion.
-    node.children = [c for c in node.children if c.parent]
+# Yields lists of folders with identical content (two or more folders each), each as soon as it is complete
+# (see signature.identical_groups) - the groups are never held all at once.
+def find_identical_folders(root):
+    compute_signatures(root)
+    return identical_groups(lambda: ((folder, folder._signature) for folder in preorder(root, subfolders)
+                                     if folder is not root))
 
 
-def update_checkpoint_file(file_name, state):
-    #todo: tempfile und dann verschieben.
-    print("Checkpoint - saving program state to disk...")
-    file = open(file_name, "wb")
-    pickle.dump(state, file)
-
-# Achtung - funktioniert so noch nicht
-# Das soll später der eigentliche Algorithmus werden.
-def find_equal_folders(root):
-    result = ""
-    # root holds the highest udid.
-    highest_udid = tree.highest_udid
-    for i in range(0, highest_udid+1):
-        # find all nodes with this udid.
-        equal_files = root.find_file(i)
-        if not equal_files:
-            # an earlier invocation found the parent folder's of i to be equal and moved them to the result tree.
-            continue
-        if len(equal_files) == 1:
-            # an invocation of drop_unique_folders removed the related twin path.
-            # drop the whole node! it now has a file with no duplicates that will prohibit matching
-            #TODO: das stimmt so nicht für teilweises Matching (also Subset-Bestimmung).
-            equal_files[0].children = None
-            equal_files[0].parent.remove_if_empty()
+def usage():
+    print("process_fdups [-h] [-c checkpoint_file [--trust-snapshot]] [-i fdupes_report|-] [-s scan_dir]... [--hash-cache file | --scanner command] [--input-format fdupes|jdupes|jdupes-json|rdfind|fclones|fclones-json|fclones-csv] [--similar threshold] [-b node|compact|numpy] [-j jobs] [--metrics file] [--trace-memory] [--shards processes | --external memory[K|M|G]] [--temp-dir dir] [--output file|- [--format jsonl|csv]] [--top k [--time-budget seconds]] [--watch]")
+
+# the paths of the files below folder - a Node or, with tree, the index of a folder in that CompactTree.
+def file_paths(folder, tree=None):
+    if tree is None:
+        return [path for node, path in preorder_with_path(folder, children, folder.path(), join_path)
+                if not node.children and node.udid is not None]
+    return [path for node, path in preorder_with_path(folder, tree.children, tree.path(folder), tree.join_path)
+            if tree.is_leaf(node) and tree.udids[node] != NO_NODE]
+
+# the udids of the files below folder, see file_paths.
+def file_udids(folder, tree=None):
+    if tree is None:
+        return [node.udid for node in preorder(folder, children) if not node.children and node.udid is not None]
+    return [tree.udids[node] for node in preorder(folder, tree.children)
+            if tree.is_leaf(node) and tree.udids[node] != NO_NODE]
+
+# registered with atexit - the metrics are written even if the run is aborted.
+def dump_metrics(file_name):
+    metrics.set("directory_syscalls", listing.cache.syscalls)
+    metrics.set("listings_from_cache", listing.cache.hits)
+    metrics.dump(file_name)
+
+# Lists all folders below root on a pool of jobs threads (bounded number of listings in flight)
+# and returns node -> verdict (see listing.check_folder) for drop_unique_folders.
+# Folders below a missing folder are checked, too - wasted, but cheaper than waiting for the parent.
+def verify_folders(root, jobs):
+    verdicts = {}
+    folders = preorder_with_path(root, subfolders, root.path(), join_path)
+    for (node, path), verdict in bounded_map(lambda folder: check_folder(folder[1], folder[0].children), folders, jobs):
+        verdicts[node] = verdict
+    return verdicts
+
+# removes folders that do not exist on disk and the files of folders that contain files unknown to fdupes,
+# then purges folders that lost all their children - iteratively, post-order.
+# assumes correct parametrization of pprinter.
+# verdicts: the result of verify_folders. Without, every folder is checked on the spot.
+# The tree is modified in the same (deterministic) order either way.
+def drop_unique_folders(node, verdicts=None):
+    global pprinter
+    # the files leaving the tree leave its index, too.
+    index = tree_index(node)
+    # post-order with an explicit stack: a folder is cleaned up after all of its subfolders.
+    # the paths are built from the parent's path on the way down.
+    stack = [(node, False, node.path())]
+    while stack:
+        node, visited, path = stack.pop()
+        if visited:
+            # purge folders that lost all their childs and are leafs now (illegal)!
+            for child in node.children.values():
+                if child.is_leaf() and child.udid is None:
+                    # schedule for deletion
+                    child.parent = None
+            # only take the items that are not scheduled for deletion.
+            node.children = {name: c for name, c in node.children.items() if c.parent}
+            node.invalidate_signature()
             continue
 
-        # check all the parent nodes for equality, pairwisely.
-        parent_nodes = [child.parent for child in equal_files]
-        #TODO: pairwisely - bisher nur Vergleich mit dem ersten.
-        check_node = parent_nodes[0]
-        identical_nodes = []
-        #skip the first node.
-        for i in range(1,len(parent_nodes)):
-            check_node2 = parent_nodes[i]
-            # make sure that the checked nodes only have leafs, no other nodes
-            assert not [child for child in check_node2 if check_node2.children]
-
-            #those folders are identical.
-            if check_node.equal_content(check_node2):
-                identical_nodes.append(check_node)
+        pprinter.add_progress()
+        # node.children also contains folder names - but filesystems demand that no "nodes (files or folders) share the same name.
+        # ==> no false positives.
+        # node.children is a dict ==> O(1) per lookup, O(n) for the whole folder.
+        verdict = verdicts[node] if verdicts is not None else check_folder(path, node.children)
+        if verdict == MISSING:
+            print("\rCannot find directory '{0}' - removing path from tree.".format(path))
+            # the parent's post step will interpret this as deletion-request.
+            node.parent = None
+            if index is not None:
+                index.discard_subtree(node)
+            continue
 
-        # extract identical nodes and save them to the output
-        check_node.path()
+        if verdict == UNIQUE:
+            # the folder contains a file that was not listed as a duplicate by fdupes.
+            # ==> the folder has unique content.
+            node.drop_leafs(index)
+
+        stack.append((node, True, path))
+        # drop folders only
+        stack.extend((child, False, join_path(path, child))
+                     for child in reversed([n for n in node.children.values() if not n.is_leaf()]))
+
+
+# converts a Node tree into a CompactTree (e.g. to write a snapshot).
+def node_to_compact(root):
+    tree = CompactTree(root.name)
+    stack = [(root, CompactTree.ROOT)]
+    while stack:
+        node, index = stack.pop()
+        for child in node.children.values():
+            udid = NO_NODE if child.udid is None else child.udid
+            stack.append((child, tree.add_node(index, child.name, udid)))
+    tree.finish_build()
+    return tree
+
+# converts a CompactTree (e.g. a loaded snapshot) back into Nodes.
+def compact_to_node(tree):
+    root = RootNode(tree.name(CompactTree.ROOT))
+    stack = [(CompactTree.ROOT, root)]
+    while stack:
+        index, node = stack.pop()
+        for child_index in tree.children(index):
+            child = Node(tree.name(child_index))
+            node.add_child(child)
+            if tree.is_leaf(child_index):
+                child.set_udid(tree.udid(child_index), root.index)
+            else:
+                stack.append((child_index, child))
+    return root
 
+# state is (file_count, folder_count, tree), sizes the file sizes of the report by udid (None if there are
+# none). Written atomically (temp file + rename), see snapshot.py.
+def update_checkpoint_file(file_name, state, sizes=None):
+    print("Checkpoint - saving program state to disk...")
+    file_count, folder_count, tree = state
+    if not isinstance(tree, CompactTree):
+        tree = node_to_compact(tree)
+    save_snapshot(file_name, file_count, folder_count, tree, sizes)
+
+# returns (file_count, folder_count, tree, sizes) or raises SnapshotError / OSError.
+# The tree is the mapped CompactTree unless nodes is set - converting it to Nodes costs an object per node,
+# so that is left to the steps that need Nodes (the similarity search, the watch mode).
+# verify=False: a trusted snapshot, see snapshot.load_snapshot.
+def load_checkpoint_file(file_name, nodes=False, verify=True):
+    file_count, folder_count, tree, sizes = load_snapshot(file_name, verify)
+    if nodes:
+        tree = compact_to_node(tree)
+    return file_count, folder_count, tree, sizes
+
+# "512M" -> bytes. None if invalid.
+def parse_size(text):
+    factor = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}.get(text[-1:].upper(), 1)
+    if factor > 1:
+        text = text[:-1]
+    try:
+        size = int(text) * factor
+    except ValueError:
+        return None
+    return size if size > 0 else None
+
+# the out-of-core pipeline for reports bigger than the memory: build, purge and match with sorted runs on disk.
+def run_external(report, memory, temp_dir=None, output=None, output_format="jsonl", scan_roots=(), scanner=None,
+                 input_format=None):
+    # the sizes are dropped by the pipeline once a set is read.
+    metadata = ReportMetadata()
+    lines, _ = report_lines(report, scan_roots, None, scanner, input_format, metadata)
+    print("Building, purging and matching with {0} bytes of memory per sort...".format(memory))
+    with metrics.phase("external"):
+        # without sizes in the report, the files are stat'ed for the output - like the serial engine does.
+        result = external_identical_folders(lines, memory, temp_dir, sizes=metadata.sizes if input_format else None,
+                                            stat=output is not None)
+        print(" Note: {0} invalid files discarded.".format(result.discarded))
+        print("{0} files.".format(result.file_count))
+        print("{0} folders.".format(result.folder_count))
+        print("---after purge---")
+        print("{0} files.".format(result.purged_file_count))
+        print("{0} folders.".format(result.purged_folder_count))
+
+        print("---identical folders---")
+        writer = ResultWriter(output, output_format) if output else None
+        groups = 0
+        # streamed - the groups are never held in memory at once.
+        for group, file_count, size in result.groups:
+            groups += 1
+            print("\n".join(group))
+            print()
+            if writer:
+                writer.write_group(group, file_count, size)
+        if writer:
+            writer.close()
+    metrics.set("identical_groups", groups)
+
+# Returns the lines of the report and its size (None if unknown): read from the report file (or stdin),
+# found by the built-in duplicate finder or - with scanner - streamed from an external one.
+# input_format: the report (or the scanner's output) is parsed by report_formats.py; the sizes it holds are
+# added to metadata, by udid.
+def report_lines(report, scan_roots, hash_cache, scanner=None, input_format=None, metadata=None):
+    if scan_roots and scanner:
+        print("Running {0} on {1}".format(scanner, ", ".join(scan_roots)))
+        # read while the scanner is still running - scanning and building overlap.
+        lines = scan_lines(scanner, scan_roots)
+        if input_format:
+            return as_report_lines(read_sets(lines, input_format), metadata or ReportMetadata()), None
+        return lines, None
+    if scan_roots:
+        print("Searching for duplicate files in " + ", ".join(scan_roots))
+        cache = HashCache(hash_cache) if hash_cache else None
+        with metrics.phase("scan"):
+            duplicates = find_duplicates(scan_roots, cache=cache)
+        if cache:
+            print(cache.report())
+            metrics.set("hash_cache_hits", cache.hits)
+            metrics.set("hash_cache_misses", cache.misses)
+            cache.close()
+        return format_fdupes(duplicates), None
+    if input_format:
+        return as_report_lines(read_sets(report, input_format), metadata or ReportMetadata()), None
+    return read_report(report), report_size(report)
+
+# the sharded pipeline: build, purge and match at once - the same groups and sizes as the serial one, largest
+# groups first instead of as soon as they are complete (see sharded.py).
+def run_sharded(report, scan_roots, hash_cache, jobs, output=None, output_format="jsonl", scanner=None,
+                input_format=None, temp_dir=None):
+    metadata = ReportMetadata()
+    lines, _ = report_lines(report, scan_roots, hash_cache, scanner, input_format, metadata)
+
+    print("Building, purging and matching on {0} processes...".format(jobs))
+    with metrics.phase("sharded"):
+        # the sizes are complete once the shards are spilled - before any worker starts.
+        # without sizes in the report, the files are stat'ed for the output - like the serial engine does.
+        result = sharded_identical_folders(lines, jobs, temp_dir, metadata.sizes if input_format else None,
+                                           stat=output is not None)
+    print(" Note: {0} invalid files discarded.".format(result.discarded))
+    print("{0} files.".format(result.file_count))
+    print("{0} folders.".format(result.folder_count))
+    print("---after purge---")
+    print("{0} files.".format(result.purged_file_count))
+    print("{0} folders.".format(result.purged_folder_count))
+    metrics.set("identical_groups", len(result.groups))
+
+    print("---identical folders---")
+    writer = ResultWriter(output, output_format) if output else None
+    for group, file_count, size in zip(result.groups, result.file_counts, result.sizes):
+        group = sorted(group)
+        print("\n".join(group))
+        print()
+        if writer:
+            # the shards are not listed again - the sizes come from the report or the workers.
+            writer.write_group(group, file_count, size)
+    if writer:
+        writer.close()
 
 
 def main():
-    global pprinter
+    global pprinter, metrics
 
+    started = time.monotonic()
     tree = None
     file_count = 0
     folder_count = 0
     checkpoint_file = None
+    trust_snapshot = False
+    report_file = "dups"
+    backend = "node"
+    jobs = 1
+    scan_roots = []
+    hash_cache = None
+    similarity_threshold = None
+    metrics_file = None
+    trace_memory = False
+    shards = None
+    output = None
+    output_format = "jsonl"
+    top = None
+    time_budget = None
+    watch = False
+    external_memory = None
+    temp_dir = None
+    scanner = None
+    input_format = None
+    metadata = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hc:")
+        opts, args = getopt.getopt(sys.argv[1:], "hc:i:b:j:s:", ["hash-cache=", "similar=", "metrics=", "trace-memory", "shards=", "output=", "format=", "top=", "time-budget=", "watch", "external=", "temp-dir=", "scanner=", "input-format=", "trust-snapshot"])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -426,59 +642,350 @@ def main():
             usage()
             return
         elif opt == "-c":
-            # open checkpoint file
-            if os.path.isfile(arg):
-                print("Opening checkpoint file " + str(arg))
-                checkpoint_file = open(arg, "rb")
-                try:
-                    sys.stdout.write("Loading tree... ")
-                    file_count, folder_count, tree = pickle.load(checkpoint_file)
-                    print("successful.")
-                    # dirty hack to make checkpoint_file a string for the call to update_checkpoint_file
-                    # ==> just extract the arg here and make a new funcion load_cp_file.
-                    checkpoint_file = arg
-                    continue
-                except:
-                    print("Invalid checkpoint file.")
-                    # continue below
-
-            print("Saving checkpoints to " + str(arg))
+            # the checkpoint is loaded below, once the backend is known.
             checkpoint_file = arg
+        elif opt == "--trust-snapshot":
+            # skips the checksum and the validation of the checkpoint - for snapshots nobody else can write.
+            trust_snapshot = True
+        elif opt == "-i":
+            # "-" reads the report from stdin, e.g. fdupes -r dir | process_fdups -i -
+            report_file = arg
+        elif opt == "-b":
+            if arg not in ("node", "compact", "numpy"):
+                usage()
+                sys.exit(1)
+            backend = arg
+        elif opt == "-s":
+            # find the duplicates ourselves instead of reading an fdupes report (may be given several times).
+            scan_roots.append(arg)
+        elif opt == "--scanner":
+            # -s runs this duplicate finder (e.g. "fdupes -r" or "jdupes -r") instead of the built-in one.
+            scanner = arg
+        elif opt == "--input-format":
+            # the report (-i or --scanner) is the output of another duplicate finder - its sizes are used.
+            if arg not in REPORT_FORMATS:
+                usage()
+                sys.exit(1)
+            input_format = arg
+        elif opt == "--hash-cache":
+            # remembers file hashes between runs (-s only)
+            hash_cache = arg
+        elif opt == "--similar":
+            # report near-duplicate folders with a Jaccard similarity >= the threshold
+            try:
+                similarity_threshold = float(arg)
+            except ValueError:
+                similarity_threshold = -1
+            if not 0 < similarity_threshold <= 1:
+                usage()
+                sys.exit(1)
+        elif opt == "--metrics":
+            # phase timings and counters are written to this file (JSON) at exit.
+            metrics_file = arg
+        elif opt == "--trace-memory":
+            # adds Python memory usage to the metrics - slow.
+            trace_memory = True
+        elif opt == "--output":
+            # the groups of identical folders as JSON Lines or CSV ("-" for stdout), see results.py.
+            output = arg
+        elif opt == "--format":
+            if arg not in RESULT_FORMATS:
+                usage()
+                sys.exit(1)
+            output_format = arg
+        elif opt == "--top":
+            # only the k groups freeing the most space, largest first (see ranking.py).
+            try:
+                top = int(arg)
+            except ValueError:
+                top = 0
+            if top < 1:
+                usage()
+                sys.exit(1)
+        elif opt == "--time-budget":
+            # seconds for the whole run - the ranking returns the best groups found when they are up.
+            try:
+                time_budget = float(arg)
+            except ValueError:
+                time_budget = -1
+            if time_budget <= 0:
+                usage()
+                sys.exit(1)
+        elif opt == "--external":
+            # sort buffer size: the tree is never held in memory (see external.py).
+            external_memory = parse_size(arg)
+            if external_memory is None:
+                usage()
+                sys.exit(1)
+        elif opt == "--temp-dir":
+            # where --external and --shards spill the report - needs a few times its size.
+            temp_dir = arg
+        elif opt == "--watch":
+            # keep running and report again whenever the surviving folders change (Linux, see watch.py).
+            watch = True
+        elif opt == "--shards":
+            # number of processes building the subtrees of the deepest common folder (see sharded.py).
+            try:
+                shards = int(arg)
+            except ValueError:
+                shards = 0
+            if shards < 1:
+                usage()
+                sys.exit(1)
+        elif opt == "-j":
+            # number of directory listings in flight during the purge - worth it on network filesystems.
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                usage()
+                sys.exit(1)
+
+    if scanner and not scan_roots:
+        print("--scanner needs -s.")
+        sys.exit(1)
+    if input_format and scan_roots and not scanner:
+        print("--input-format needs -i or --scanner.")
+        sys.exit(1)
+
+    if backend == "numpy":
+        # the compact tree with the counting, signature and grouping passes in NumPy (see vectorized.py).
+        try:
+            import vectorized
+        except ImportError:
+            print("-b numpy needs NumPy.")
+            sys.exit(1)
+
+    if output == "-":
+        # the results are written to stdout - everything else (groups, progress, notes) goes to stderr,
+        # so the results can be piped into other tools.
+        output = sys.stdout
+        sys.stdout = sys.stderr
+
+    if metrics_file:
+        metrics = pprinter.metrics = Metrics(trace_memory)
+        atexit.register(dump_metrics, metrics_file)
+
+    if time_budget is not None and top is None:
+        print("--time-budget needs --top.")
+        sys.exit(1)
+    if watch and (backend != "node" or time_budget is not None):
+        print("--watch can not be combined with --time-budget or -b compact|numpy.")
+        sys.exit(1)
+
+    if external_memory:
+        if (checkpoint_file or similarity_threshold is not None or backend != "node" or top or watch or shards
+                or (scan_roots and not scanner)):
+            print("--external can not be combined with -c, -s (except with --scanner), --similar, --top, --watch, "
+                  "--shards or -b compact|numpy.")
+            sys.exit(1)
+        try:
+            run_external(report_file, external_memory, temp_dir, output, output_format, scan_roots, scanner,
+                         input_format)
+        except (ScannerError, ReportFormatError) as e:
+            print("\n{0}".format(e))
+            sys.exit(1)
+        return
+
+    if shards:
+        if checkpoint_file or similarity_threshold is not None or backend != "node" or top or watch:
+            print("--shards can not be combined with -c, --similar, --top, --watch or -b compact|numpy.")
+            sys.exit(1)
+        try:
+            run_sharded(report_file, scan_roots, hash_cache, shards, output, output_format, scanner, input_format,
+                        temp_dir)
+        except (ScannerError, ReportFormatError) as e:
+            print("\n{0}".format(e))
+            sys.exit(1)
+        return
 
-    if not tree:
-        with open("dups") as f:
-            lines = f.readlines()
-            file_count, folder_count, tree = build_tree(lines)
-            if checkpoint_file:
-                update_checkpoint_file(checkpoint_file, (file_count, folder_count, tree))
+    if checkpoint_file and os.path.isfile(checkpoint_file):
+        print("Opening checkpoint file " + str(checkpoint_file))
+        try:
+            sys.stdout.write("Loading tree... ")
+            with metrics.phase("load"):
+                # the node backend keeps the loaded CompactTree unless Nodes are needed - same results.
+                nodes = backend == "node" and (similarity_threshold is not None or watch)
+                file_count, folder_count, tree, sizes = load_checkpoint_file(checkpoint_file, nodes,
+                                                                             not trust_snapshot)
+            print("successful.")
+            if sizes is not None:
+                # the sizes of the report the checkpoint was built from.
+                metadata = ReportMetadata()
+                metadata.sizes = sizes
+        except (SnapshotError, OSError) as e:
+            print("Invalid checkpoint file ({0}).".format(e))
+    if checkpoint_file and tree is None:
+        print("Saving checkpoints to " + str(checkpoint_file))
+
+    if tree is None:
+        # the compact backend trades a little speed for a fraction of the memory (see compact_tree.py).
+        root = CompactTree() if backend != "node" else None
+        metadata = ReportMetadata() if input_format else None
+        lines, total = report_lines(report_file, scan_roots, hash_cache, scanner, input_format, metadata)
+        # the report is parsed while the tree is built - one phase (with a scanner: while it scans).
+        with metrics.phase("build"):
+            try:
+                file_count, folder_count, tree = build_tree(lines, total, root)
+            except (ScannerError, ReportFormatError) as e:
+                print("\n{0}".format(e))
+                sys.exit(1)
+            if backend != "node":
+                tree.finish_build()
+        if checkpoint_file:
+            with metrics.phase("checkpoint"):
+                update_checkpoint_file(checkpoint_file, (file_count, folder_count, tree),
+                                       metadata.sizes if metadata is not None else None)
 
     print("{0} files.".format(file_count))
     print("{0} folders.".format(folder_count))
 
+    if similarity_threshold is not None:
+        # before the purge: it drops the files of every folder holding a single unique file,
+        # which are exactly the near-duplicates we are looking for.
+        if isinstance(tree, CompactTree):
+            print("Similarity search needs the node backend.")
+        else:
+            print("---similar folders (>= {0:.0%})---".format(similarity_threshold))
+            with metrics.phase("similar"):
+                pairs = find_similar_folders(tree, similarity_threshold, index=tree.index)
+            for pair in pairs:
+                print("{0:.1%} similar, {1:.1%} / {2:.1%} contained: {3} <-> {4}".format(
+                    pair.jaccard, pair.first_in_second, pair.second_in_first, pair.first.path(), pair.second.path()))
+
+    # the sizes the duplicate finder reported (kept in checkpoints) - no stat calls at all.
+    reported_sizes = metadata.sizes if metadata is not None else None
+    if top and not reported_sizes:
+        # the sizes are taken from the listings of the purge: one stat per file, no extra scandir.
+        listing.cache.sizes = True
+
     print("---sanity check---")
-    pprinter.parametrize(folder_count, "Counting")
-    _file_count, _folder_count = tree.stats()
-    pprinter.reset()
+    pprinter.start(folder_count, "Counting", "nodes_visited")
+    with metrics.phase("sanity_count"):
+        _file_count, _folder_count = vectorized.stats(tree) if backend == "numpy" else tree.stats()
+    pprinter.finish()
 
     print("{0} files.".format(_file_count))
     print("{0} folders.".format(_folder_count))
 
 
     # now a tree is loaded
-    pprinter.parametrize(folder_count, "Purging unique folders")
-    drop_unique_folders(tree)
-    pprinter.reset()
+    verdicts = None
+    if jobs > 1:
+        print("Listing folders ({0} in parallel)...".format(jobs))
+        with metrics.phase("verify"):
+            if isinstance(tree, CompactTree):
+                verdicts = compact_tree.verify_folders(tree, jobs)
+            else:
+                verdicts = verify_folders(tree, jobs)
+    pprinter.start(folder_count, "Purging unique folders", "nodes_visited")
+    with metrics.phase("purge"):
+        if isinstance(tree, CompactTree):
+            compact_tree.drop_unique_folders(tree, verdicts=verdicts)
+        else:
+            drop_unique_folders(tree, verdicts=verdicts)
+    pprinter.finish()
 
     # just a crude approximation
-    pprinter.parametrize(folder_count, "Counting")
-    _file_count, _folder_count = tree.stats()
-    pprinter.reset()
+    pprinter.start(folder_count, "Counting", "nodes_visited")
+    with metrics.phase("count"):
+        _file_count, _folder_count = vectorized.stats(tree) if backend == "numpy" else tree.stats()
+    pprinter.finish()
 
     print("{0} files.".format(_file_count))
     print("{0} folders.".format(_folder_count))
-
-    update_checkpoint_file(checkpoint_file,(_file_count, _folder_count, tree))
-
+    print(listing.cache.report())
+
+    if checkpoint_file:
+        with metrics.phase("checkpoint"):
+            update_checkpoint_file(checkpoint_file,(_file_count, _folder_count, tree),
+                                   metadata.sizes if metadata is not None else None)
+
+    print("---identical folders---")
+    with metrics.phase("match"):
+        if backend == "numpy":
+            groups = vectorized.find_identical_folders(tree)
+            path = tree.path
+        elif isinstance(tree, CompactTree):
+            groups = compact_tree.find_identical_folders(tree)
+            path = tree.path
+        else:
+            groups = find_identical_folders(tree)
+            path = Node.path
+    compact = tree if isinstance(tree, CompactTree) else None
+
+    # size of the files below folder, None if unknown.
+    def folder_size(folder):
+        if reported_sizes:
+            return metadata.total_size(file_udids(folder, compact))
+        return listed_size(file_paths(folder, compact), listing.cache)
+
+    # groups: an iterable of groups, looked at once. Returns the number of groups.
+    def report(groups):
+        writer = ResultWriter(output, output_format) if output else None
+        count = 0
+        if top:
+            # all folders of a group hold the same files - the size of one of them counts.
+            def group_size(group):
+                return folder_size(group[0])
+
+            # the files that could be deleted - known without listing a folder.
+            def group_files(group):
+                return (len(group) - 1) * len(file_udids(group[0], compact))
+
+            deadline = None
+            if time_budget is not None:
+                deadline = started + time_budget
+                # all groups are at hand to be ordered by their files - and counted.
+                groups = list(groups)
+            with metrics.phase("rank"):
+                ranked, count = rank_groups(groups, group_size, top, deadline,
+                                            group_files if deadline is not None else None)
+            metrics.set("ranked_groups", count)
+            if deadline is not None and count < len(groups):
+                print("Time budget exceeded - best of the first {0} of {1} groups.".format(count, len(groups)))
+                count = len(groups)
+            for ranked_group in ranked:
+                paths = sorted(path(folder) for folder in ranked_group.group)
+                print("{0} bytes reclaimable ({1} x {2} bytes):".format(ranked_group.reclaimable, len(paths) - 1,
+                                                                     ranked_group.size))
+                print("\n".join(paths))
+                print()
+                if writer:
+                    writer.write_group(paths, len(file_paths(ranked_group.group[0], compact)), ranked_group.size)
+        else:
+            for group in groups:
+                count += 1
+                paths = sorted(path(folder) for folder in group)
+                print("\n".join(paths))
+                print()
+                if writer:
+                    # all folders of a group hold the same files - count and size those of one of them.
+                    files = file_paths(group[0], compact)
+                    size = metadata.total_size(file_udids(group[0], compact)) if reported_sizes else files_size(files)
+                    writer.write_group(paths, len(files), size)
+        if writer:
+            writer.close()
+        return count
+
+    metrics.set("identical_groups", report(groups))
+
+    if watch:
+        try:
+            watcher = TreeWatcher(tree)
+            watcher.start()
+        except OSError as e:
+            print("Cannot watch the folders ({0}).".format(e))
+            sys.exit(1)
+        print("Watching {0} folders for changes (Ctrl-C to stop)...".format(len(watcher.watches)))
+
+        def on_change(changed):
+            # the output file (if any) is rewritten with the current groups.
+            print("---identical folders ({0} folders changed)---".format(changed))
+            report(watcher.identical_folders())
+
+        watcher.run(on_change)
 
 if __name__ == "__main__":
     main()
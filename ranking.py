@@ -0,0 +1,72 @@
+import os
+import time
+import heapq
+from collections import namedtuple
+
+# Ranking of duplicate groups by reclaimable space: deleting all but one folder of a group of n identical
+# folders of size s frees (n - 1) * s bytes. Used by process_fdups.py (--top) and lars/Tree.py.
+#
+# The sizes come from the directory listings of the verification (see listing.ListingCache.sizes) - no
+# extra stat per file if the cache records sizes before the folders are listed.
+# Only the best k groups are kept (a min-heap of size k). With a deadline, the ranking stops when it
+# expires and returns the best groups found so far - so the groups are first ordered by a cheap estimate
+# (e.g. the number of files that could be deleted, no listing needed) and the promising ones are sized first.
+
+# group: whatever was passed in, reclaimable and size in bytes.
+RankedGroup = namedtuple("RankedGroup", ["reclaimable", "size", "group"])
+
+
+# the k items with the highest scores, in O(log k) per push. Ties: the item pushed first wins.
+class TopK:
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self.pushed = 0
+
+    def push(self, score, item):
+        self.pushed += 1
+        # -pushed: of equal scores, the latest one is the smallest - and dropped first. Items are never compared.
+        entry = (score, -self.pushed, item)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    # best first.
+    def best(self):
+        return [item for _, _, item in sorted(self.heap, reverse=True)]
+
+
+# total size of the files in paths from the listings of their folders - None if one of them is unknown.
+def listed_size(paths, cache):
+    total = 0
+    for path in paths:
+        folder, name = os.path.split(path)
+        listing = cache.listing(folder)
+        size = listing.sizes.get(name) if listing is not None else None
+        if size is None:
+            return None
+        total += size
+    return total
+
+
+# groups: lists of identical folders (or files), size: group -> size of one of its members in bytes (None
+# if unknown - the group is skipped). deadline: time.monotonic() value; the groups are looked at in the
+# given order until it expires (at least one). estimate: group -> a cheap guess of its reclaimable space (any
+# unit); if given, the groups are looked at highest estimate first instead.
+# Returns the best k RankedGroups, best first, and the number of groups looked at.
+def rank_groups(groups, size, k, deadline=None, estimate=None):
+    if estimate is not None:
+        groups = sorted(groups, key=estimate, reverse=True)
+    top = TopK(k)
+    ranked = 0
+    for group in groups:
+        if deadline is not None and ranked and time.monotonic() >= deadline:
+            break
+        ranked += 1
+        group_size = size(group)
+        if group_size is None:
+            continue
+        reclaimable = (len(group) - 1) * group_size
+        top.push(reclaimable, RankedGroup(reclaimable, group_size, group))
+    return top.best(), ranked
@@ -0,0 +1,282 @@
+import os
+import re
+import sys
+import csv
+import json
+import codecs
+from collections import namedtuple
+
+# Parsers for the reports of other duplicate finders. Every parser yields DuplicateSets in the order of
+# the report; as_report_lines turns them into fdupes' format for build_tree (and the sharded and external
+# pipelines) and keeps what the finder already knew about every set in a ReportMetadata:
+#
+#   fdupes        one path per line, sets separated by empty lines; "N bytes each:" lines of -S are used
+#   jdupes        the same (jdupes' plain output), with -S sizes
+#   jdupes-json   jdupes -j: {"matchSets": [{"fileSize": N, "fileList": [{"filePath": ...}, ...]}, ...]}
+#   rdfind        results.txt: "duptype id depth size device inode priority name", a set shares abs(id)
+#   fclones       the default text report: "<hash>, <size> B (...) * <count>:" followed by indented paths
+#   fclones-json  fclones -f json: {"groups": [{"file_len": N, "file_hash": ..., "files": [...]}, ...]}
+#   fclones-csv   fclones -f csv: size,hash,count,path,path,...
+#
+# The sizes replace the stat calls of the sizing phases (--top and the bytes of --output) of every pipeline
+# and are kept in checkpoints (see snapshot.py). The hashes are parsed but not kept: a hash says nothing
+# about the files on disk that are not in the report, so it can not replace the listings of the purge.
+# A source is a file name, "-" for stdin or an iterable of lines (bytes), e.g. scanner.scan_lines.
+# All formats are streamed: of a JSON document only the current set is held (see JsonArrayReader).
+
+# size in bytes and hash (as printed by the finder) of every file of the set - None if not in the report.
+DuplicateSet = namedtuple("DuplicateSet", ["paths", "size", "hash"])
+
+FORMATS = ("fdupes", "jdupes", "jdupes-json", "rdfind", "fclones", "fclones-json", "fclones-csv")
+
+SIZE_LINE = re.compile(rb"^(\d+) bytes? each:\s*$")
+FCLONES_GROUP = re.compile(rb"^([0-9a-fA-F]+), (\d+) B .*:\s*$")
+RDFIND_TYPES = (b"DUPTYPE_FIRST_OCCURRENCE", b"DUPTYPE_WITHIN_SAME_TREE", b"DUPTYPE_OUTSIDE_TREE")
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# what may follow a number cut off by the end of the buffer ("12|3", "1|.5", "1e|3").
+JSON_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*\Z")
+# bytes read at once from a JSON report.
+JSON_CHUNK_SIZE = 1 << 16
+
+
+class ReportFormatError(Exception):
+    pass
+
+
+# what the finder knew about the sets, by unique duplicate id (the number of the set, see build_tree).
+class ReportMetadata:
+    def __init__(self):
+        self.sizes = {}
+
+    def add(self, udid, duplicate_set):
+        if duplicate_set.size is not None:
+            self.sizes[udid] = duplicate_set.size
+
+    # total size of files with these udids - None if one of them is unknown.
+    def total_size(self, udids):
+        total = 0
+        for udid in udids:
+            size = self.sizes.get(udid)
+            if size is None:
+                return None
+            total += size
+        return total
+
+
+# the lines of source as bytes, including the newline.
+def _binary_lines(source):
+    if source == "-":
+        yield from sys.stdin.buffer
+    elif isinstance(source, str):
+        with open(source, "rb") as f:
+            yield from f
+    else:
+        yield from source
+
+def _lines(source):
+    for line in _binary_lines(source):
+        yield line.rstrip(b"\r\n")
+
+# the text of source in pieces. Undecodable file names survive as surrogates, like everywhere else.
+def _text_chunks(source):
+    decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+    if source == "-":
+        chunks = iter(lambda: sys.stdin.buffer.read(JSON_CHUNK_SIZE), b"")
+    elif isinstance(source, str):
+        def chunks():
+            with open(source, "rb") as f:
+                yield from iter(lambda: f.read(JSON_CHUNK_SIZE), b"")
+        chunks = chunks()
+    else:
+        chunks = source
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    yield decoder.decode(b"", final=True)
+
+
+# Reads the elements of one array in the top-level object of a JSON document, one at a time: the other
+# members are skipped, the elements decoded as they come (json.JSONDecoder.raw_decode). A value cut off by
+# the end of the buffer is decoded again with more text - only the current value is ever held.
+class JsonArrayReader:
+    def __init__(self, source):
+        self.chunks = _text_chunks(source)
+        self.buffer = ""
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    # False at the end of the document.
+    def _more(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        # the decoded part is dropped.
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    # the next character that is not whitespace - not consumed.
+    def _peek(self):
+        while True:
+            self.position = JSON_WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._more():
+                raise ReportFormatError("invalid JSON: unexpected end of the document")
+
+    def _expect(self, characters):
+        character = self._peek()
+        if character not in characters:
+            raise ReportFormatError("invalid JSON: {0!r} instead of {1!r} at {2!r}".format(
+                character, characters, self.buffer[self.position:self.position + 40]))
+        self.position += 1
+        return character
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number may go on in the next chunk.
+                if not JSON_NUMBER_TAIL.match(self.buffer, end) or not self._more():
+                    self.position = end
+                    return value
+            except ValueError as e:
+                if not self._more():
+                    raise ReportFormatError("invalid JSON: {0}".format(e))
+
+    # the elements of the array that is the value of key.
+    def elements(self, key):
+        self._expect("{")
+        if self._peek() != "}":
+            while True:
+                name = self._value()
+                if not isinstance(name, str):
+                    raise ReportFormatError("invalid JSON: {0!r} is not a member name".format(name))
+                self._expect(":")
+                if name == key:
+                    self._expect("[")
+                    if self._peek() == "]":
+                        return
+                    while True:
+                        yield self._value()
+                        if self._expect(",]") == "]":
+                            return
+                self._value()
+                if self._expect(",}") == "}":
+                    break
+        raise ReportFormatError("no {0!r} in the JSON report".format(key))
+
+
+def parse_fdupes(source):
+    paths = []
+    size = None
+    for line in _lines(source):
+        if not line.strip():
+            if paths:
+                yield DuplicateSet(paths, size, None)
+            paths = []
+            size = None
+            continue
+        match = SIZE_LINE.match(line)
+        if match and not paths:
+            size = int(match.group(1))
+            continue
+        paths.append(line)
+    if paths:
+        yield DuplicateSet(paths, size, None)
+
+def parse_jdupes_json(source):
+    try:
+        for match_set in JsonArrayReader(source).elements("matchSets"):
+            yield DuplicateSet([entry["filePath"] for entry in match_set["fileList"]], match_set.get("fileSize"), None)
+    except (KeyError, TypeError) as e:
+        raise ReportFormatError("not a jdupes JSON report ({0})".format(e))
+
+def parse_rdfind(source):
+    paths = []
+    set_id = size = None
+    finished = set()
+    for line in _lines(source):
+        if not line or line.startswith(b"#"):
+            continue
+        fields = line.split(b" ", 7)
+        if len(fields) != 8 or fields[0] not in RDFIND_TYPES:
+            raise ReportFormatError("not an rdfind result line: {0!r}".format(line))
+        line_id = abs(int(fields[1]))
+        if line_id != set_id:
+            if paths:
+                yield DuplicateSet(paths, size, None)
+                finished.add(set_id)
+            if line_id in finished:
+                # rdfind writes every set in one piece - anything else would split it into two sets here.
+                raise ReportFormatError("set {0} of the rdfind results is not contiguous".format(line_id))
+            paths = []
+            set_id = line_id
+            size = int(fields[3])
+        paths.append(fields[7])
+    if paths:
+        yield DuplicateSet(paths, size, None)
+
+def parse_fclones(source):
+    duplicate_set = None
+    for line in _lines(source):
+        if not line or line.startswith(b"#"):
+            continue
+        if line.startswith(b" "):
+            if duplicate_set is None:
+                raise ReportFormatError("fclones report: path outside of a group: {0!r}".format(line))
+            duplicate_set.paths.append(line.lstrip(b" "))
+            continue
+        match = FCLONES_GROUP.match(line)
+        if not match:
+            raise ReportFormatError("not an fclones group line: {0!r}".format(line))
+        if duplicate_set is not None:
+            yield duplicate_set
+        duplicate_set = DuplicateSet([], int(match.group(2)), match.group(1).decode("ascii"))
+    if duplicate_set is not None:
+        yield duplicate_set
+
+def parse_fclones_json(source):
+    try:
+        for group in JsonArrayReader(source).elements("groups"):
+            yield DuplicateSet(list(group["files"]), group.get("file_len"), group.get("file_hash"))
+    except (KeyError, TypeError) as e:
+        raise ReportFormatError("not an fclones JSON report ({0})".format(e))
+
+def parse_fclones_csv(source):
+    rows = csv.reader(line.decode("utf-8", "surrogateescape") for line in _binary_lines(source))
+    for row in rows:
+        if not row or row[0] == "size":
+            # the header.
+            continue
+        try:
+            yield DuplicateSet(row[3:], int(row[0]), row[1] or None)
+        except (ValueError, IndexError):
+            raise ReportFormatError("not an fclones CSV row: {0!r}".format(row))
+
+PARSERS = {
+    "fdupes": parse_fdupes,
+    "jdupes": parse_fdupes,
+    "jdupes-json": parse_jdupes_json,
+    "rdfind": parse_rdfind,
+    "fclones": parse_fclones,
+    "fclones-json": parse_fclones_json,
+    "fclones-csv": parse_fclones_csv,
+}
+
+def read_sets(source, format):
+    if format not in PARSERS:
+        raise ValueError("unknown report format '{0}'".format(format))
+    return PARSERS[format](source)
+
+
+# the sets as the lines of an fdupes report (see build_tree). The set with udid n is the n-th set -
+# its size is added to metadata before its lines are handed out.
+def as_report_lines(sets, metadata):
+    for udid, duplicate_set in enumerate(sets):
+        metadata.add(udid, duplicate_set)
+        for path in duplicate_set.paths:
+            yield os.fsencode(path) + b"\n"
+        yield b"\n"
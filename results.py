@@ -0,0 +1,89 @@
+import os
+import sys
+import csv
+import json
+import time
+
+# Machine-readable result files for both engines (process_fdups.py --output and lars/Tree.py).
+#
+# Every group of identical folders (or files) is written as soon as it is known, with
+#   group: running number, starting at 1
+#   paths: the folders of the group
+#   files: number of files in one folder of the group (null if unknown)
+#   bytes: size of the files in one folder of the group (null if unknown)
+# as JSON Lines (one object per group) or CSV (one row per path: group,path,files,bytes).
+# Nothing is kept per group: the memory used does not depend on the number of groups. The output is
+# buffered and flushed at least every FLUSH_INTERVAL seconds, so it can be consumed while the run goes on.
+
+FORMATS = ("jsonl", "csv")
+
+
+class ResultWriter:
+    FLUSH_INTERVAL = 1.0
+
+    # file_name: "-" for stdout or an already opened text file - both are flushed, not closed.
+    def __init__(self, file_name, format="jsonl"):
+        if format not in FORMATS:
+            raise ValueError("unknown result format '{0}'".format(format))
+        self.format = format
+        self.owned = isinstance(file_name, str) and file_name != "-"
+        if file_name == "-":
+            self.file = sys.stdout
+        elif not self.owned:
+            self.file = file_name
+        else:
+            # undecodable file names survive as surrogates. CSV writes them back as the original bytes; JSON
+            # strings can only hold text, so json.dumps escapes them (\udcXX) - os.fsencode of the loaded
+            # path gives the original bytes.
+            self.file = open(file_name, "w", buffering=1 << 16, newline="", errors="surrogateescape")
+        self.groups = 0
+        self.last_flush = time.monotonic()
+        if format == "csv":
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(["group", "path", "files", "bytes"])
+
+    # Returns the id of the group.
+    def write_group(self, paths, file_count=None, size=None):
+        self.groups += 1
+        if self.format == "jsonl":
+            self.file.write(json.dumps({"group": self.groups, "paths": paths, "files": file_count, "bytes": size}))
+            self.file.write("\n")
+        else:
+            self.csv.writerows([self.groups, path, file_count, size] for path in paths)
+        now = time.monotonic()
+        if now - self.last_flush >= self.FLUSH_INTERVAL:
+            self.file.flush()
+            self.last_flush = now
+        return self.groups
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# total size of the files in bytes - None if one of them can not be stat'ed (anymore).
+def files_size(paths):
+    total = 0
+    for path in paths:
+        try:
+            total += os.stat(path, follow_symlinks=False).st_size
+        except OSError:
+            return None
+    return total
+
+# total of sizes in bytes - None if one of them is None (unknown).
+def sizes_total(sizes):
+    total = 0
+    for size in sizes:
+        if size is None:
+            return None
+        total += size
+    return total
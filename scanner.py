@@ -0,0 +1,35 @@
+import shlex
+import subprocess
+
+# External duplicate finders (fdupes, jdupes, ...) as a stream of report lines.
+#
+# The scanner runs as a subprocess - without a shell, the folders are passed as arguments as they are -
+# and its stdout is read while it is still scanning: the tree is built as the sets of duplicates come in,
+# no report file is written and nothing waits for the scan to finish.
+# The scanner has to print fdupes' default format: one path per line, sets separated by empty lines -
+# or one of the formats of report_formats.py, parsed from the same stream.
+
+class ScannerError(Exception):
+    pass
+
+
+# command: the scanner and its options, e.g. "fdupes -r" (split like a shell would do it, quotes work).
+# Yields the lines (bytes, including the newline). Raises ScannerError if the scanner can not be started
+# or fails - after all its output has been read.
+def scan_lines(command, roots):
+    args = shlex.split(command) + list(roots)
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    except OSError as e:
+        raise ScannerError("cannot run {0}: {1}".format(args[0], e))
+    try:
+        yield from process.stdout
+    except GeneratorExit:
+        # the reader stopped early - do not wait for a scan nobody reads.
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise ScannerError("{0} failed with exit code {1}".format(args[0], returncode))
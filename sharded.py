@@ -0,0 +1,232 @@
+import os
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from signature import leaf_signature, folder_signature
+from listing import check_folder, MISSING, UNIQUE
+from external import ExternalSorter
+from results import files_size, sizes_total
+
+# Sharded variant of build_tree + drop_unique_folders + find_identical_folders (process_fdups.py) for
+# machines with many cores: the signature of a folder depends on its own subtree only.
+#
+#   1. the report is streamed to a temp file while the chain of folders all paths share - from the root down
+#      to the deepest common folder - is found. Every subfolder of that folder is a shard.
+#   2. the paths are sorted by shard (externally, the order of the report kept within a shard) into one file;
+#      every shard is a range of it. The parent never holds the paths of the report.
+#   3. every shard is read, built, purged and signed by a worker process, which returns one (path, signature)
+#      record per surviving folder.
+#   4. the parent purges and signs the chain and the files directly in the deepest common folder and
+#      groups all records by signature.
+#
+# The groups are the same as those of the serial engine, but in another order: the serial engine streams
+# every group as soon as it is complete, here all records are in before the first group is known - so they
+# are handed out largest first. The sizes of the groups are the same, too: from the report if it has them,
+# else (with stat) from the file system. The shards are as big as the subfolders of the common folder - one
+# huge subfolder still ends up on one core.
+
+# file_counts: the number of files in one folder of each group, sizes: their size in bytes (None if unknown).
+ShardedResult = namedtuple("ShardedResult", ["groups", "file_counts", "sizes", "file_count", "folder_count",
+                                             "purged_file_count", "purged_folder_count", "discarded"])
+
+# memory for sorting the paths by shard.
+SORT_MEMORY = 64 << 20
+
+# on the worker processes (see _set_sizes): udid -> file size of the report (None if unknown) and whether to
+# stat the files instead.
+_sizes = None
+_stat = False
+
+# initializer of the worker processes: the sizes are sent once per process, not once per shard.
+def _set_sizes(sizes, stat):
+    global _sizes, _stat
+    _sizes = sizes
+    _stat = stat
+
+# size of the file path in bytes, None if unknown: from the report's sizes or - with stat - from the file
+# system, like the serial engine.
+def _file_size(udid, path, sizes, stat):
+    if sizes is not None:
+        return sizes.get(udid)
+    return files_size([path]) if stat else None
+
+
+# builds, purges and signs one shard: the lines (udid, "\0", path) from start to end of file_name.
+# prefix: the names from the root down to the shard folder. dropped: the chain is missing - only count.
+# Runs on the worker processes.
+def _process_shard(shard):
+    # imported here: process_fdups imports this module.
+    from process_fdups import Node, drop_unique_folders, compute_signatures, subfolders, join_path
+    from traversal import preorder_with_path, postorder
+
+    file_name, start, end, prefix, dropped = shard
+    with open(file_name, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    root = Node("/")
+    for line in data.splitlines():
+        udid, path = line.split(b"\0", 1)
+        root.insert(os.fsdecode(path).split("/")[1:], int(udid))
+    data = None
+    node = root
+    for name in prefix:
+        node = node.get_child(name)
+    file_count, folder_count = node.stats()
+    counts = (file_count, folder_count + 1)
+    if dropped:
+        return None, [], counts, (0, 0)
+
+    drop_unique_folders(node)
+    if node.parent is None or node.is_leaf():
+        # missing or purged completely.
+        return None, [], counts, (0, 0)
+    compute_signatures(node)
+    # the shard folder comes first.
+    paths = dict(preorder_with_path(node, subfolders, node.path(), join_path))
+    files = {}
+    sizes = {}
+    for folder in postorder(node, subfolders):
+        files[folder] = sum(files[child] if child.children else 1 for child in folder.children.values())
+        sizes[folder] = sizes_total(sizes[child] if child.children else
+                                    _file_size(child.udid, join_path(paths[folder], child), _sizes, _stat)
+                                    for child in folder.children.values())
+    records = [(path, folder._signature, files[folder], sizes[folder]) for folder, path in paths.items()]
+    file_count, folder_count = node.stats()
+    return node._signature, records, counts, (file_count, folder_count + 1)
+
+
+# Phase 1 - returns the spill file (lines udid, "\0", path), the chain and the number of discarded lines.
+def _spill(lines, directory):
+    spill = tempfile.TemporaryFile(dir=directory)
+    chain = None
+    discarded = 0
+    unique_duplicate_id = 0
+    for path in lines:
+        path = os.fsdecode(path)
+        # same rules as build_tree.
+        if path.strip() == "":
+            unique_duplicate_id += 1
+            continue
+        if not path.startswith("/"):
+            discarded += 1
+            continue
+        path = path.rstrip()
+        names = path.split("/")
+        names.pop(0)
+        if chain is None:
+            chain = names[:-1]
+        else:
+            common = 0
+            limit = min(len(chain), len(names) - 1)
+            while common < limit and names[common] == chain[common]:
+                common += 1
+            del chain[common:]
+        spill.write(b"%d\0%s\n" % (unique_duplicate_id, os.fsencode(path)))
+    spill.seek(0)
+    return spill, chain, discarded
+
+def _path(names):
+    return "/" + "/".join(names)
+
+
+# lines: like build_tree. jobs: number of worker processes (default: one per CPU). sizes: udid -> file size
+# in bytes (e.g. report_formats.ReportMetadata.sizes), complete once the lines are read. stat: without
+# sizes, the sizes of the groups are taken from the file system - one stat per surviving file, so only
+# worth it if they are written out.
+# Returns a ShardedResult, groups are lists of folder paths, largest groups first.
+def sharded_identical_folders(lines, jobs=None, directory=None, sizes=None, stat=False):
+    spill, chain, discarded = _spill(lines, directory)
+    if not sizes:
+        # a report without sizes - like none at all.
+        sizes = None
+    if chain is None:
+        spill.close()
+        return ShardedResult([], [], [], 0, 0, 0, 0, discarded)
+    depth = len(chain)
+
+    # Phase 2 - the files directly in the common folder stay here, the rest is sorted by shard.
+    files = {}
+    shard_ids = {}
+    sorter = ExternalSorter(SORT_MEMORY, directory)
+    file_count = 0
+    with spill:
+        for number, line in enumerate(spill):
+            file_count += 1
+            udid, path = line[:-1].split(b"\0", 1)
+            names = path.split(b"/", depth + 2)
+            if len(names) == depth + 2:
+                files[os.fsdecode(names[-1])] = int(udid)
+            else:
+                shard = shard_ids.setdefault(names[depth + 1], len(shard_ids))
+                sorter.add(b"%010d%012d%s\0%s\n" % (shard, number, udid, path))
+    sorted_file = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    try:
+        bounds = []
+        with sorted_file:
+            for line in sorter:
+                shard = int(line[:10])
+                if shard == len(bounds):
+                    bounds.append([sorted_file.tell(), None])
+                    if shard:
+                        bounds[shard - 1][1] = bounds[shard][0]
+                sorted_file.write(line[22:])
+            if bounds:
+                bounds[-1][1] = sorted_file.tell()
+        return _sharded_result(sorted_file.name, bounds, [os.fsdecode(name) for name in shard_ids], chain, files,
+                               file_count, discarded, jobs, sizes, stat)
+    finally:
+        os.unlink(sorted_file.name)
+
+def _sharded_result(file_name, bounds, shard_names, chain, files, file_count, discarded, jobs, sizes, stat):
+    depth = len(chain)
+    # the chain is purged before the shards are looked at - like drop_unique_folders does it, top-down.
+    dropped = False
+    for level in range(depth + 1):
+        path = _path(chain[:level])
+        known = {chain[level]} if level < depth else set(files) | set(shard_names)
+        verdict = check_folder(path, known)
+        if verdict == MISSING:
+            print("\rCannot find directory '{0}' - removing path from tree.".format(path))
+            # nothing below survives - the shards are only counted.
+            files = {}
+            dropped = True
+            break
+        if verdict == UNIQUE and level == depth:
+            files = {}
+
+    shards = [(file_name, start, end, chain + [name], dropped) for (start, end), name in zip(bounds, shard_names)]
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1, initializer=_set_sizes,
+                             initargs=(sizes, stat)) as executor:
+        results = list(executor.map(_process_shard, shards))
+
+    folder_count = depth + sum(before[1] for _, _, before, _ in results)
+    child_signatures = [leaf_signature(udid) for udid in files.values()]
+    child_signatures += [signature for signature, _, _, _ in results if signature is not None]
+    if not child_signatures:
+        # the common folder lost all its children - and so did the chain.
+        return ShardedResult([], [], [], file_count, folder_count, 0, 0, discarded)
+    purged_file_count = len(files) + sum(after[0] for _, _, _, after in results)
+    purged_folder_count = depth + sum(after[1] for _, _, _, after in results)
+
+    # signatures of the chain, bottom-up. The root itself is never reported.
+    # the size of the common folder: its files and the shard folders (the first record of a shard).
+    size = sizes_total([_file_size(udid, _path(chain + [name]), sizes, stat) for name, udid in files.items()] +
+                       [shard_records[0][3] for signature, shard_records, _, _ in results if signature is not None])
+    records = []
+    signature = folder_signature(child_signatures)
+    for level in range(depth, 0, -1):
+        records.append((_path(chain[:level]), signature, purged_file_count, size))
+        signature = folder_signature([signature])
+    records.reverse()
+
+    # pre-order, like the serial engine: the chain, then the shards in the order of the report.
+    groups = {}
+    for _, shard_records, _, _ in [(None, records, None, None)] + results:
+        for path, signature, files, size in shard_records:
+            groups.setdefault(signature, ([], files, size))[0].append(path)
+    groups = sorted((group for group in groups.values() if len(group[0]) > 1), key=lambda group: len(group[0]),
+                    reverse=True)
+    return ShardedResult([paths for paths, _, _ in groups], [files for _, files, _ in groups],
+                         [size for _, _, size in groups], file_count, folder_count, purged_file_count,
+                         purged_folder_count, discarded)
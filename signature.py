@@ -0,0 +1,43 @@
+from hashlib import blake2b
+from collections import Counter
+
+# Order-independent content signatures for files and folders (Merkle style).
+# A file is identified by its unique duplicate id, a folder by the multiset of its children's signatures:
+# the child signatures are sorted before hashing, so the order in which fdupes listed the files or
+# in which the tree stores its children does not matter. Names are deliberately not part of the signature -
+# two folders are duplicates if they hold the same content, whatever the files are called.
+#
+# blake2b truncated to 128 bits: faster than md5 and still collision resistant for any realistic tree.
+
+SIGNATURE_SIZE = 16
+
+def leaf_signature(udid):
+    return blake2b(b"F%d" % udid, digest_size=SIGNATURE_SIZE).digest()
+
+# child_signatures: iterable of the signatures of all files and folders directly below the folder.
+def folder_signature(child_signatures):
+    h = blake2b(b"D", digest_size=SIGNATURE_SIZE)
+    # all signatures have the same length, so the concatenation is unambiguous.
+    for child_signature in sorted(child_signatures):
+        h.update(child_signature)
+    return h.digest()
+
+# Groups folders by signature without holding all groups: items() returns a fresh iterator over the
+# (folder, signature) pairs - the same pairs in the same order every time. The first pass counts the folders
+# per signature, the second one yields a group as soon as its last folder is reached. Memory: the first pass
+# holds one count per distinct signature - O(folders), like the signatures it counts; after it only the
+# counts of repeated signatures and the folders of the unfinished groups are kept. What is never held is the
+# list of all groups (with all their folders) - the caller gets them one at a time.
+def identical_groups(items):
+    counts = Counter(signature for _, signature in items())
+    counts = {signature: count for signature, count in counts.items() if count > 1}
+    pending = {}
+    for folder, signature in items():
+        count = counts.get(signature)
+        if count is None:
+            continue
+        group = pending.setdefault(signature, [])
+        group.append(folder)
+        if len(group) == count:
+            del pending[signature], counts[signature]
+            yield group
@@ -0,0 +1,267 @@
+import random
+from array import array
+from collections import namedtuple, Counter, OrderedDict
+
+from traversal import preorder, postorder, ancestors, children, subfolders, parent
+from duplicate_index import DuplicateIndex
+
+# Near-duplicate and subset detection for folders (Node trees, see process_fdups.py).
+#
+# A folder is described by the multiset of duplicate ids (udids) of all files below it - a folder holding two
+# copies of a file differs from one holding a single copy. Two folders that are 95% copies of each other share
+# 95% of these ids, a strict superset contains all ids of the other folder. Comparing all pairs of folders is
+# quadratic, so:
+#
+#   1. every folder gets a MinHash sketch of its udid multiset: the k-th copy of a udid is hashed as an element
+#      of its own, so the sketches estimate the weighted Jaccard similarity sum(min) / sum(max). The sketch of
+#      a folder is the element-wise minimum of the sketches of its children plus the copies that only the
+#      folder as a whole has (a udid found in several children) - all sketches in one bottom-up pass.
+#   2. locality sensitive hashing: the sketch is cut into bands, folders sharing any band end up in the
+#      same bucket and become a candidate pair. Pairs with Jaccard similarity >= threshold are found
+#      with high probability, dissimilar pairs rarely become candidates.
+#   3. containment: a small folder inside a much larger one has a low Jaccard similarity and is missed by
+#      the LSH. A folder contains at least threshold of another one only if it holds one of the other's
+#      rarest udids that make up more than (1 - threshold) of its files (prefix filtering) - the folders
+#      holding those are found through the DuplicateIndex of the tree. The files a folder shares with each of
+#      them are counted by walking up from the files of the folder's own sets, so a superset is never walked:
+#      the cost per folder is O(files of its sets * depth), whatever the size of the supersets. Of a chain of
+#      such supersets (a folder and its parents) only the deepest one is reported.
+#   4. the exact Jaccard similarity and containment of the LSH candidates are computed from their udid
+#      multisets.
+
+NUM_PERM = 128
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 64) - 1
+# sketches of single files (1 KiB each) and udid multisets of folders kept for reuse - most recently used.
+LEAF_CACHE_SIZE = 4096
+COUNT_CACHE_SIZE = 1024
+
+SimilarPair = namedtuple("SimilarPair", ["first", "second", "jaccard", "first_in_second", "second_in_first"])
+
+
+# number of bands for the given threshold: the LSH "S-curve" has its steepest point
+# at about (1/bands) ** (1/rows) - choose the split that comes closest to the threshold.
+def choose_bands(num_perm, threshold):
+    best = None
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands:
+            continue
+        rows = num_perm // bands
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    def __init__(self, num_perm=NUM_PERM, seed=1):
+        generator = random.Random(seed)
+        self.permutations = [(generator.randrange(1, MERSENNE_PRIME), generator.randrange(0, MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+        self.num_perm = num_perm
+        self.leaf_sketches = OrderedDict()
+
+    # sketch of the copy-th (1, 2, ...) file of the duplicate set udid. Cached (at most LEAF_CACHE_SIZE),
+    # the files of a set are usually close to each other in the tree.
+    def leaf_sketch(self, udid, copy=1):
+        key = (udid, copy)
+        sketch = self.leaf_sketches.get(key)
+        if sketch is not None:
+            self.leaf_sketches.move_to_end(key)
+            return sketch
+        element = udid << 32 | copy
+        sketch = array("Q", [(a * element + b) % MERSENNE_PRIME for a, b in self.permutations])
+        self.leaf_sketches[key] = sketch
+        if len(self.leaf_sketches) > LEAF_CACHE_SIZE:
+            self.leaf_sketches.popitem(last=False)
+        return sketch
+
+    def empty_sketch(self):
+        return array("Q", [MAX_HASH]) * self.num_perm
+
+
+# one post-order pass: folder -> sketch. Only folders with at least min_files files are kept - tiny folders
+# are similar to everything and not worth reporting. file_counts: a dict to fill with the number of files
+# below every folder.
+def compute_sketches(root, hasher, min_files=2, file_counts=None):
+    sketches = {}
+    # folder -> (sketch, udid multiset, number of files) until its parent is done.
+    partial = {}
+    for node in postorder(root, subfolders):
+        parts = []
+        files = Counter()
+        for child in node.children.values():
+            if child.children:
+                parts.append(partial.pop(child))
+            elif child.udid is not None:
+                files[child.udid] += 1
+        # the multiset of the largest subfolder is extended (small to large): a udid is moved O(log n) times.
+        parts.sort(key=lambda part: len(part[1]), reverse=True)
+        if parts:
+            sketch, counts, file_count = parts[0]
+        else:
+            sketch, counts, file_count = hasher.empty_sketch(), Counter(), 0
+        # udid -> copies covered by the sketch of one of the parts.
+        covered = {}
+        for part_sketch, part_counts, part_file_count in parts[1:]:
+            sketch = array("Q", map(min, sketch, part_sketch))
+            file_count += part_file_count
+            for udid, count in part_counts.items():
+                before = counts[udid]
+                covered[udid] = max(covered.get(udid, before), count)
+                counts[udid] = before + count
+        for udid, count in files.items():
+            before = counts[udid]
+            covered.setdefault(udid, before)
+            counts[udid] = before + count
+        file_count += sum(files.values())
+        for udid, copies in covered.items():
+            for copy in range(copies + 1, counts[udid] + 1):
+                sketch = array("Q", map(min, sketch, hasher.leaf_sketch(udid, copy)))
+        partial[node] = (sketch, counts, file_count)
+        if file_counts is not None:
+            file_counts[node] = file_count
+        if file_count >= min_files and node is not root:
+            sketches[node] = sketch
+    return sketches
+
+
+def _is_ancestor(node, other):
+    return any(ancestor is node for ancestor in ancestors(other, parent))
+
+# the udid multiset of all files below folder.
+def udid_counts(folder):
+    return Counter(node.udid for node in preorder(folder, children) if not node.children and node.udid is not None)
+
+
+# udid multisets of folders, the most recently used ones are kept.
+class CountCache:
+    def __init__(self, size=COUNT_CACHE_SIZE):
+        self.size = size
+        self.counts = OrderedDict()
+
+    def get(self, folder):
+        counts = self.counts.get(folder)
+        if counts is not None:
+            self.counts.move_to_end(folder)
+            return counts
+        counts = self.counts[folder] = udid_counts(folder)
+        if len(self.counts) > self.size:
+            self.counts.popitem(last=False)
+        return counts
+
+
+# Returns (weighted Jaccard similarity, containment of first in second, containment of second in first).
+def compare(first_counts, second_counts):
+    common = sum(min(count, second_counts[udid]) for udid, count in first_counts.items() if udid in second_counts)
+    first_size, second_size = sum(first_counts.values()), sum(second_counts.values())
+    return common / (first_size + second_size - common), common / first_size, common / second_size
+
+
+# candidate pairs from the LSH buckets of the sketches.
+def _lsh_candidates(sketches, bands, rows):
+    candidates = set()
+    for band in range(bands):
+        buckets = {}
+        start = band * rows
+        for node, sketch in sketches.items():
+            buckets.setdefault(sketch[start:start+rows].tobytes(), []).append(node)
+        for bucket in buckets.values():
+            for i in range(len(bucket)):
+                for j in range(i + 1, len(bucket)):
+                    candidates.add(_pair(bucket[i], bucket[j]))
+    return candidates
+
+def _pair(first, second):
+    return (first, second) if id(first) < id(second) else (second, first)
+
+
+# (folder, deepest superset) -> number of files in common for the folders in folders: every superset holds
+# at least threshold of the folder's files. file_counts: see compute_sketches.
+def _containment_candidates(root, folders, counts, threshold, index, file_counts):
+    candidates = {}
+    for folder in folders:
+        folder_counts = counts.get(folder)
+        size = file_counts[folder]
+        # a superset misses at most (1 - threshold) of the files - so it holds one of these udids.
+        budget = (1 - threshold) * size
+        prefix = []
+        missing = 0
+        for udid in sorted(folder_counts, key=lambda udid: (index.count(udid), udid)):
+            prefix.append(udid)
+            missing += folder_counts[udid]
+            if missing > budget:
+                break
+        supersets = set()
+        for udid in prefix:
+            supersets.update(index.folders_containing(udid, root))
+        # the folder itself and its ancestors contain it anyway, its subfolders are part of it.
+        supersets.difference_update(ancestors(folder, parent))
+        supersets = {superset for superset in supersets if not _is_ancestor(folder, superset)}
+        if not supersets:
+            continue
+
+        # the files of the folder's sets below every superset, counted from the files up.
+        common = Counter()
+        for udid, count in folder_counts.items():
+            found = Counter()
+            for leaf in index.files(udid):
+                for ancestor in ancestors(leaf.parent, parent):
+                    if ancestor in supersets:
+                        found[ancestor] += 1
+            for superset, superset_count in found.items():
+                common[superset] += min(count, superset_count)
+
+        depths = {superset: sum(1 for _ in ancestors(superset, parent)) for superset in supersets}
+        # deepest first: a superset with a superset below it is not reported.
+        covered = set()
+        for superset in sorted(supersets, key=depths.get, reverse=True):
+            if superset in covered:
+                continue
+            if common[superset] >= threshold * size:
+                candidates[_pair(folder, superset)] = common[superset]
+                covered.update(ancestors(superset.parent, parent))
+    return candidates
+
+
+# Returns the SimilarPairs of folders below root with a Jaccard similarity of at least threshold or where
+# one contains at least threshold of the other, most similar first. A folder and its own subfolders are
+# never paired. index: the DuplicateIndex of the tree (process_fdups.RootNode.index) - built if not given.
+def find_similar_folders(root, threshold=0.8, num_perm=NUM_PERM, min_files=2, index=None):
+    if index is None:
+        index = DuplicateIndex.of(root)
+    hasher = MinHasher(num_perm)
+    file_counts = {}
+    sketches = compute_sketches(root, hasher, min_files, file_counts)
+    bands, rows = choose_bands(num_perm, threshold)
+    candidates = _lsh_candidates(sketches, bands, rows)
+    folders = list(sketches)
+    sketches = None
+    counts = CountCache()
+    contained = _containment_candidates(root, folders, counts, threshold, index, file_counts)
+    candidates |= set(contained)
+
+    paths = {}
+    def path(node):
+        if node not in paths:
+            paths[node] = node.path()
+        return paths[node]
+
+    pairs = []
+    for first, second in candidates:
+        if _is_ancestor(first, second) or _is_ancestor(second, first):
+            continue
+        if (first, second) in contained:
+            # the common files are known - no need to walk the superset.
+            common = contained[first, second]
+            first_count, second_count = file_counts[first], file_counts[second]
+            jaccard = common / (first_count + second_count - common)
+            first_in_second, second_in_first = common / first_count, common / second_count
+        else:
+            jaccard, first_in_second, second_in_first = compare(counts.get(first), counts.get(second))
+        if jaccard >= threshold or first_in_second >= threshold or second_in_first >= threshold:
+            if path(first) > path(second):
+                first, second, first_in_second, second_in_first = second, first, second_in_first, first_in_second
+            pairs.append(SimilarPair(first, second, jaccard, first_in_second, second_in_first))
+    pairs.sort(key=lambda pair: (-pair.jaccard, path(pair.first), path(pair.second)))
+    return pairs
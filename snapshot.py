@@ -0,0 +1,242 @@
+import os
+import sys
+import mmap
+import struct
+import tempfile
+import zlib
+from array import array
+from itertools import islice
+
+from compact_tree import CompactTree, NO_NODE
+
+# Versioned binary snapshot of a CompactTree, replacing the pickled checkpoints.
+#
+# Layout (native byte order, recorded in the header):
+#
+#   header      MAGIC, version, byte order, node count, string count, name blob size, size count,
+#               file count, folder count, payload crc32, header crc32
+#   parents     node count * int32      \
+#   names       node count * int32       |
+#   udids       node count * int32       |  the arrays of CompactTree, byte for byte
+#   first_child node count * int32       |
+#   next_sibl.  node count * int32      /
+#   padding     zero bytes up to the next multiple of 8 - the offsets are used in place (memoryview.cast)
+#   offsets     (string count + 1) * uint64 - start of every name in the blob
+#   blob        utf-8 (surrogateescape) encoded names
+#   sizes       size count * int64 - the file size of every duplicate set reported by the duplicate finder
+#               (see report_formats.ReportMetadata), by udid; -1 if unknown. Empty without a report.
+#
+# Snapshots are written to a temp file next to the target and renamed, so a crash never leaves a half
+# written checkpoint behind. Loading mmaps the file copy-on-write and uses the arrays in place - no objects
+# are created up front. Nothing in the file is ever executed (unlike pickle); the header and the payload
+# are checksummed, so truncated or corrupted files are rejected with a SnapshotError. A checksum is easily
+# recomputed for a crafted file, so the tree itself is validated, too (see _validate).
+
+MAGIC = b"FDUPSNAP"
+VERSION = 3
+HEADER = struct.Struct("<8sIIQQQQQQII")
+ARRAYS = ("parents", "names", "udids", "first_child", "next_sibling")
+INT32 = array("i").itemsize
+INT64 = array("q").itemsize
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+# the zero bytes between the arrays and the (8-byte aligned) offsets.
+def _padding(node_count):
+    return -(HEADER.size + len(ARRAYS) * node_count * INT32) % 8
+
+
+class MappedStringTable:
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __getitem__(self, string_id):
+        start, end = self.offsets[string_id], self.offsets[string_id+1]
+        return bytes(self.blob[start:end]).decode("utf-8", "surrogateescape")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def freeze(self):
+        pass
+
+
+def _encode_strings(strings):
+    offsets = array("Q", [0])
+    parts = []
+    position = 0
+    for string in strings:
+        encoded = string.encode("utf-8", "surrogateescape")
+        parts.append(encoded)
+        position += len(encoded)
+        offsets.append(position)
+    return offsets, b"".join(parts)
+
+
+# sizes: udid -> file size in bytes (e.g. ReportMetadata.sizes), None if there are none.
+def save_snapshot(file_name, file_count, folder_count, tree, sizes=None):
+    byte_order = 0 if sys.byteorder == "little" else 1
+    strings = [tree.strings[i] for i in range(len(tree.strings))]
+    offsets, blob = _encode_strings(strings)
+    size_table = array("q", [-1]) * (max(sizes) + 1 if sizes else 0)
+    for udid, size in (sizes or {}).items():
+        size_table[udid] = size
+    sections = [bytes(getattr(tree, name)) for name in ARRAYS] + [bytes(_padding(len(tree))), offsets.tobytes(), blob,
+                                                                  size_table.tobytes()]
+
+    crc = 0
+    for section in sections:
+        crc = zlib.crc32(section, crc)
+    header = HEADER.pack(MAGIC, VERSION, byte_order, len(tree), len(strings), len(blob), len(size_table),
+                         file_count, folder_count, crc, 0)
+    header = header[:-4] + struct.pack("<I", zlib.crc32(header[:-4]))
+
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_name = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    # mkstemp creates the file 0600 - give it the permissions open() would have.
+    umask = os.umask(0)
+    os.umask(umask)
+    try:
+        os.fchmod(fd, 0o666 & ~umask)
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            for section in sections:
+                f.write(section)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, file_name)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+    # make the rename itself durable.
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+# Every index the CompactTree methods use must be in range and the child lists must form a tree: a walk from
+# the root reaches every node at most once (no shared children, no sibling cycles) and every child points back
+# to its parent. Nodes outside the tree are marked removed - nothing follows their parents in a loop.
+def _validate(tree, node_count, string_count):
+    for name in ("parents", "first_child", "next_sibling"):
+        values = getattr(tree, name)
+        if min(values) < NO_NODE or max(values) >= node_count:
+            raise SnapshotError("{0}: node index out of range".format(name))
+    if min(tree.names) < 0 or max(tree.names) >= string_count:
+        raise SnapshotError("names: string id out of range")
+    if min(tree.udids) < NO_NODE:
+        raise SnapshotError("udids: invalid duplicate id")
+    offsets = tree.strings.offsets
+    # the first offset is 0 and the last one the blob size (checked by the caller).
+    if any(start > end for start, end in zip(offsets, islice(offsets, 1, None))):
+        raise SnapshotError("invalid string table")
+
+    parents, first_child, next_sibling = tree.parents, tree.first_child, tree.next_sibling
+    reached = bytearray(node_count)
+    reached[CompactTree.ROOT] = 1
+    stack = [CompactTree.ROOT]
+    while stack:
+        node = stack.pop()
+        child = first_child[node]
+        while child != NO_NODE:
+            if reached[child]:
+                raise SnapshotError("node {0} is reached twice".format(child))
+            if parents[child] != node:
+                raise SnapshotError("node {0} is not a child of its parent".format(child))
+            reached[child] = 1
+            stack.append(child)
+            child = next_sibling[child]
+    for node in range(node_count):
+        if not reached[node] and parents[node] != NO_NODE:
+            raise SnapshotError("node {0} is not in the tree".format(node))
+
+
+# Returns (file_count, folder_count, tree, sizes) - sizes: a dict udid -> file size in bytes of the sets whose
+# size is known, None if the snapshot has none. The tree is backed by a private (copy-on-write) mapping of the
+# file, so the purge phase may modify it without touching the snapshot.
+# verify=False skips the payload checksum (one sequential read of the file) and the validation of the tree
+# (one pass over all nodes) for trusted snapshots.
+def load_snapshot(file_name, verify=True):
+    with open(file_name, "rb") as f:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except ValueError:
+            raise SnapshotError("empty snapshot file")
+
+    if len(mapping) < HEADER.size:
+        raise SnapshotError("truncated header")
+    raw_header = mapping[:HEADER.size]
+    magic, version, byte_order, node_count, string_count, blob_size, size_count, file_count, folder_count, crc, \
+        header_crc = HEADER.unpack(raw_header)
+    if magic != MAGIC:
+        raise SnapshotError("not a snapshot file")
+    if zlib.crc32(raw_header[:-4]) != header_crc:
+        raise SnapshotError("corrupted header")
+    if version != VERSION:
+        raise SnapshotError("unsupported snapshot version {0}".format(version))
+    if node_count < 1 or node_count >= 2**31:
+        raise SnapshotError("invalid node count")
+
+    array_size = node_count * INT32
+    offsets_size = (string_count + 1) * 8
+    padding = _padding(node_count)
+    expected = HEADER.size + len(ARRAYS) * array_size + padding + offsets_size + blob_size + size_count * INT64
+    if len(mapping) != expected:
+        raise SnapshotError("size mismatch: {0} bytes, expected {1} (partially written?)".format(len(mapping), expected))
+
+    view = memoryview(mapping)
+    if verify and zlib.crc32(view[HEADER.size:]) != crc:
+        raise SnapshotError("payload checksum mismatch")
+
+    swap = byte_order != (0 if sys.byteorder == "little" else 1)
+    tree = CompactTree.__new__(CompactTree)
+    position = HEADER.size
+    for name in ARRAYS:
+        section = view[position:position+array_size]
+        if swap:
+            # written on a machine with the other byte order - no way around a copy.
+            values = array("i")
+            values.frombytes(section)
+            values.byteswap()
+        else:
+            values = section.cast("i")
+        setattr(tree, name, values)
+        position += array_size
+
+    position += padding
+    offsets = view[position:position+offsets_size]
+    if swap:
+        swapped = array("Q")
+        swapped.frombytes(offsets)
+        swapped.byteswap()
+        offsets = swapped
+    else:
+        offsets = offsets.cast("Q")
+    position += offsets_size
+    if offsets[0] != 0 or offsets[string_count] != blob_size:
+        raise SnapshotError("invalid string table")
+    tree.strings = MappedStringTable(offsets, view[position:position+blob_size])
+    position += blob_size
+
+    # one entry per duplicate set - small next to the tree, so copied into a dict like the one of the report.
+    size_table = array("q")
+    size_table.frombytes(view[position:])
+    if swap:
+        size_table.byteswap()
+    if size_count and min(size_table) < -1:
+        raise SnapshotError("sizes: invalid file size")
+    sizes = {udid: size for udid, size in enumerate(size_table) if size >= 0} if size_count else None
+    tree._lookup = None
+    if tree.parents[CompactTree.ROOT] != NO_NODE:
+        raise SnapshotError("invalid root node")
+    if verify:
+        _validate(tree, node_count, string_count)
+    # keep the mapping alive as long as the tree uses it.
+    tree._mapping = mapping
+    return file_count, folder_count, tree, sizes
@@ -0,0 +1,86 @@
+import os
+import sys
+import random
+import unittest
+
+# the shared modules are in the folder above.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_fdups
+from bitmap import Bitmap, union_all, ARRAY_LIMIT, CHUNK_BITS
+
+# The set operations of bitmap.py against Python sets - for array and bitset chunks and mixes of both.
+
+
+# ids of a few chunks: sparse ones (arrays) and dense ones (bitsets), some of them just at ARRAY_LIMIT.
+def sample(generator, dense_chunks=1):
+    values = set()
+    for high in generator.sample(range(4), 3):
+        count = generator.choice([1, 50, ARRAY_LIMIT, ARRAY_LIMIT + 1]) if dense_chunks <= 0 else 10000
+        dense_chunks -= 1
+        values.update(high << CHUNK_BITS | low for low in generator.sample(range(1 << CHUNK_BITS), count))
+    return values
+
+
+class BitmapTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = random.Random(17)
+        self.samples = [sample(self.generator, dense_chunks) for dense_chunks in (0, 0, 1, 2, 3)]
+        self.bitmaps = [Bitmap.of(values) for values in self.samples]
+
+    # (ids, their bitmap, other ids, their bitmap) for all combinations of the samples.
+    def pairs(self):
+        for first, first_bitmap in zip(self.samples, self.bitmaps):
+            for second, second_bitmap in zip(self.samples, self.bitmaps):
+                yield first, first_bitmap, second, second_bitmap
+
+    def test_values(self):
+        for values, bitmap in zip(self.samples + [set()], self.bitmaps + [Bitmap.of(())]):
+            self.assertEqual(list(bitmap), sorted(values))
+            self.assertEqual(len(bitmap), len(values))
+            self.assertEqual(bool(bitmap), bool(values))
+
+    def test_contains(self):
+        values, bitmap = self.samples[3], self.bitmaps[3]
+        for value in list(values)[:1000] + [self.generator.randrange(4 << CHUNK_BITS) for _ in range(1000)]:
+            self.assertEqual(value in bitmap, value in values)
+
+    def test_union(self):
+        for first, first_bitmap, second, second_bitmap in self.pairs():
+            self.assertEqual(list(first_bitmap | second_bitmap), sorted(first | second))
+        self.assertEqual(list(union_all(self.bitmaps, [7, 1 << 20])), sorted(set().union(*self.samples) | {7, 1 << 20}))
+
+    def test_intersection(self):
+        for first, first_bitmap, second, second_bitmap in self.pairs():
+            intersection = first_bitmap & second_bitmap
+            self.assertEqual(list(intersection), sorted(first & second))
+            # the containers are canonical: equal to the bitmap built from the ids.
+            self.assertEqual(intersection, Bitmap.of(first & second))
+            self.assertEqual(first_bitmap.intersection_count(second_bitmap), len(first & second))
+
+    def test_issubset(self):
+        for first, first_bitmap, second, second_bitmap in self.pairs():
+            self.assertEqual(first_bitmap.issubset(second_bitmap), first <= second)
+            self.assertTrue((first_bitmap & second_bitmap).issubset(first_bitmap))
+
+    def test_equality(self):
+        # built in pieces or at once, across the array/bitset boundary both ways: the same containers.
+        values = sorted(self.samples[0] | self.samples[2])
+        pieces = [Bitmap.of(values[start::4]) for start in range(4)]
+        self.assertEqual(union_all(pieces), Bitmap.of(values))
+        self.assertEqual(Bitmap.of(values) & Bitmap.of(values[:ARRAY_LIMIT]), Bitmap.of(values[:ARRAY_LIMIT]))
+        self.assertNotEqual(Bitmap.of(values), Bitmap.of(values[1:]))
+        self.assertNotEqual(Bitmap.of(values), values)
+
+    def test_folders(self):
+        # the bitmap of a folder holds the duplicate sets of all files below it.
+        lines = [b"/r/a/f\n", b"/r/b/c/f\n", b"\n", b"/r/a/g\n", b"/r/d/g\n", b"\n", b"/r/b/h\n", b"/r/d/h\n", b"\n"]
+        _, _, tree = process_fdups.build_tree(lines)
+        folder = tree.get_child("r")
+        expected = {"a": [0, 1], "b": [0, 2], "d": [1, 2]}
+        self.assertEqual({name: list(child.bitmap()) for name, child in folder.children.items()}, expected)
+        self.assertEqual(list(folder.bitmap()), [0, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
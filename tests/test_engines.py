@@ -0,0 +1,103 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# the shared modules are in the folder above.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_fdups
+from results import files_size
+from sharded import sharded_identical_folders
+from external import external_identical_folders
+
+# The sharded and the external engine against the serial one (build_tree, drop_unique_folders, find_identical_folders) on a
+# small tree on disk: the same groups with the same file counts and sizes.
+
+# duplicate sets of (path, content). "only" is not in the report, so a is unique; "gone" is not on disk.
+SETS = [[("a/x/f1", "11"), ("b/x/f1", "11")],
+        [("a/x/f2", "222"), ("b/x/f2", "222")],
+        [("a/y/g", "4444"), ("b/y/g", "4444"), ("c/g", "4444")],
+        [("a/h", "55555"), ("b/h", "55555")],
+        [("t", "666666"), ("d/t", "666666")],
+        [("gone/f", None), ("gone2/f", None)]]
+UNREPORTED = [("a/only", "7")]
+
+
+class EngineTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for path, content in [file for files in SETS for file in files] + UNREPORTED:
+            if content is not None:
+                path = os.path.join(self.directory, path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w") as f:
+                    f.write(content)
+        # the sizes a duplicate finder would report, by duplicate id.
+        self.sizes = {udid: len(files[0][1]) for udid, files in enumerate(SETS) if files[0][1] is not None}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def lines(self):
+        for files in SETS:
+            for path, _ in files:
+                yield os.fsencode(os.path.join(self.directory, path)) + b"\n"
+            yield b"\n"
+
+    def assertLargestFirst(self, groups):
+        lengths = [len(paths) for paths in groups]
+        self.assertEqual(lengths, sorted(lengths, reverse=True))
+
+    def serial(self):
+        _, _, tree = process_fdups.build_tree(list(self.lines()))
+        process_fdups.drop_unique_folders(tree)
+        groups = []
+        for group in process_fdups.find_identical_folders(tree):
+            files = process_fdups.file_paths(group[0])
+            groups.append((sorted(folder.path() for folder in group), len(files), files_size(files)))
+        return sorted(groups)
+
+    def test_serial(self):
+        # the fixture itself: two groups survive the purge.
+        expected = [[os.path.join(self.directory, path) for path in paths] for paths in (["a/x", "b/x"],
+                                                                                         ["a/y", "b/y", "c"])]
+        self.assertEqual([paths for paths, _, _ in self.serial()], expected)
+
+    def sharded(self, **options):
+        result = sharded_identical_folders(self.lines(), 2, **options)
+        self.assertLargestFirst(result.groups)
+        return sorted(zip(map(sorted, result.groups), result.file_counts, result.sizes))
+
+    def test_sharded(self):
+        self.assertEqual(self.sharded(stat=True), self.serial())
+
+    def test_sharded_reported_sizes(self):
+        self.assertEqual(self.sharded(sizes=self.sizes), self.serial())
+
+    def test_sharded_without_sizes(self):
+        self.assertEqual(self.sharded(), [(paths, files, None) for paths, files, _ in self.serial()])
+
+
+    def external(self, **options):
+        # a tiny sort buffer: every level is spilled and merged.
+        groups = list(external_identical_folders(self.lines(), 64, **options).groups)
+        self.assertLargestFirst([paths for paths, _, _ in groups])
+        return sorted((sorted(paths), files, size) for paths, files, size in groups)
+
+    def test_external(self):
+        self.assertEqual(self.external(stat=True), self.serial())
+
+    def test_external_reported_sizes(self):
+        # the sizes are dropped as the sets are read.
+        sizes = dict(self.sizes)
+        self.assertEqual(self.external(sizes=sizes), self.serial())
+        self.assertEqual(sizes, {})
+
+    def test_external_without_sizes(self):
+        self.assertEqual(self.external(), [(paths, files, None) for paths, files, _ in self.serial()])
+
+
+if __name__ == "__main__":
+    unittest.main()
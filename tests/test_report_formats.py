@@ -0,0 +1,109 @@
+import os
+import sys
+import unittest
+
+# the shared modules are in the folder above.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from report_formats import read_sets, as_report_lines, ReportMetadata, ReportFormatError, JsonArrayReader
+
+# Checks the parsers of report_formats.py against the sample reports in reports/ (see reports/README).
+
+REPORTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports")
+
+PHOTO = ["/data/photos/img 1.jpg", "/backup/photos/img 1.jpg"]
+REPORT = ["/data/docs/report.pdf", "/backup/docs/report.pdf", "/tmp/report.pdf"]
+SONG = ["/data/music/song.mp3", "/backup/music/song.mp3"]
+SETS = [(PHOTO, 1000), (REPORT, 2000), (SONG, 3000)]
+
+
+def read(file_name, format):
+    # the text formats hand out bytes, the others str.
+    return [([os.fsdecode(path) for path in duplicate_set.paths], duplicate_set.size, duplicate_set.hash)
+            for duplicate_set in read_sets(os.path.join(REPORTS, file_name), format)]
+
+
+class ParserTest(unittest.TestCase):
+    def assertSets(self, sets, expected):
+        self.assertEqual([(paths, size) for paths, size, _ in sets], expected)
+
+    def test_jdupes(self):
+        # the last set has no "bytes each:" line.
+        self.assertSets(read("jdupes.txt", "jdupes"), SETS[:2] + [(SONG, None)])
+
+    def test_jdupes_json(self):
+        self.assertSets(read("jdupes.json", "jdupes-json"), SETS)
+
+    def test_rdfind(self):
+        self.assertSets(read("results.txt", "rdfind"), SETS)
+
+    def test_fclones(self):
+        sets = read("fclones.txt", "fclones")
+        self.assertSets(sets, SETS)
+        self.assertEqual(sets[0][2], "6f0ba5b6d1f1cd0e3a5a1c4e8a3e2f11")
+
+    def test_fclones_json(self):
+        sets = read("fclones.json", "fclones-json")
+        self.assertSets(sets, SETS)
+        self.assertEqual(sets[1][2], "a1d3c94e0b7f6a2255e0c7d6f4b3a9e2")
+
+    def test_fclones_csv(self):
+        sets = read("fclones.csv", "fclones-csv")
+        self.assertSets(sets, SETS)
+        self.assertEqual(sets[2][2], "0c8e2f7a9b4d1e6f3a5c7b9d2e4f6a81")
+
+    def test_rdfind_split_set(self):
+        lines = [b"DUPTYPE_FIRST_OCCURRENCE 1 0 5 1 1 1 /a\n", b"DUPTYPE_FIRST_OCCURRENCE 2 0 5 1 2 1 /b\n",
+                 b"DUPTYPE_WITHIN_SAME_TREE -1 0 5 1 3 1 /c\n"]
+        with self.assertRaises(ReportFormatError):
+            list(read_sets(lines, "rdfind"))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            read_sets([], "dupeguru")
+
+
+class JsonArrayReaderTest(unittest.TestCase):
+    def test_chunks(self):
+        # every value cut at every position - numbers, strings and multi-byte characters.
+        with open(os.path.join(REPORTS, "fclones.json"), "rb") as f:
+            document = f.read().replace(b"/tmp/", "/témp/".encode()) + b"\n"
+        expected = list(JsonArrayReader([document]).elements("groups"))
+        self.assertEqual(expected[1]["files"][2], "/témp/report.pdf")
+        for size in (1, 2, 3, 7):
+            chunks = [document[start:start + size] for start in range(0, len(document), size)]
+            self.assertEqual(list(JsonArrayReader(chunks).elements("groups")), expected)
+
+    def test_undecodable(self):
+        sets = list(read_sets([b'{"groups": [{"files": ["/a/\xff", "/b/\xff"]}]}'], "fclones-json"))
+        self.assertEqual([os.fsencode(path) for path in sets[0].paths], [b"/a/\xff", b"/b/\xff"])
+
+    def test_invalid(self):
+        for document in (b"", b"[]", b'{"header": {}}', b'{"groups": [{"files": []}', b'{"groups": [1 2]}',
+                         b'{"groups": 3}'):
+            with self.assertRaises(ReportFormatError, msg=document):
+                list(JsonArrayReader([document]).elements("groups"))
+
+    def test_not_a_report(self):
+        with self.assertRaises(ReportFormatError):
+            list(read_sets([b'{"groups": [{"file_len": 1}]}'], "fclones-json"))
+
+
+class ReportLinesTest(unittest.TestCase):
+    def test_report_lines(self):
+        metadata = ReportMetadata()
+        lines = list(as_report_lines(read_sets(os.path.join(REPORTS, "fclones.txt"), "fclones"), metadata))
+        self.assertEqual(lines[:3], [b"/data/photos/img 1.jpg\n", b"/backup/photos/img 1.jpg\n", b"\n"])
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(metadata.sizes, {0: 1000, 1: 2000, 2: 3000})
+        self.assertEqual(metadata.total_size([0, 1, 1]), 5000)
+
+    def test_unknown_size(self):
+        metadata = ReportMetadata()
+        list(as_report_lines(read_sets(os.path.join(REPORTS, "jdupes.txt"), "jdupes"), metadata))
+        self.assertEqual(metadata.sizes, {0: 1000, 1: 2000})
+        self.assertIsNone(metadata.total_size([0, 2]))
+
+
+if __name__ == "__main__":
+    unittest.main()
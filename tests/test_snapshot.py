@@ -0,0 +1,147 @@
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+# the shared modules are in the folder above.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compact_tree import CompactTree
+from snapshot import save_snapshot, load_snapshot, SnapshotError, HEADER, ARRAYS, INT32
+
+# Round trips of snapshot.py and the rejection of truncated, corrupted and invalid snapshots.
+
+FILES = [("a/b/f", 0), ("a/c/f", 0), ("d/g", 1), ("d/h", 2), ("d/é", 2)]
+
+
+def sample_tree(files=FILES):
+    tree = CompactTree()
+    for path, udid in files:
+        tree.insert(path.split("/"), udid)
+    tree.finish_build()
+    return tree
+
+
+def paths(tree):
+    return sorted((tree.path(node), tree.udid(node)) for node in range(len(tree))
+                  if not tree.is_removed(node) and tree.is_leaf(node))
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "checkpoint")
+        self.tree = sample_tree()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, sizes=None):
+        save_snapshot(self.file_name, 5, 4, self.tree, sizes)
+        with open(self.file_name, "rb") as f:
+            return bytearray(f.read())
+
+    def write(self, data):
+        with open(self.file_name, "wb") as f:
+            f.write(data)
+
+    # writes data with valid checksums - only the validation of the tree can reject it.
+    def write_checksummed(self, data):
+        fields = list(HEADER.unpack(bytes(data[:HEADER.size])))
+        fields[-2] = zlib.crc32(bytes(data[HEADER.size:]))
+        header = HEADER.pack(*fields)
+        data[:HEADER.size] = header[:-4] + struct.pack("<I", zlib.crc32(header[:-4]))
+        self.write(data)
+
+    def set_value(self, data, name, node, value):
+        offset = HEADER.size + (ARRAYS.index(name) * len(self.tree) + node) * INT32
+        struct.pack_into("i", data, offset, value)
+
+    def assertRejected(self, message=None, verify=True):
+        with self.assertRaises(SnapshotError) as context:
+            load_snapshot(self.file_name, verify)
+        if message:
+            self.assertIn(message, str(context.exception))
+
+    def test_round_trip(self):
+        self.save({0: 10, 2: 30})
+        file_count, folder_count, tree, sizes = load_snapshot(self.file_name)
+        self.assertEqual((file_count, folder_count), (5, 4))
+        self.assertEqual(paths(tree), paths(self.tree))
+        self.assertEqual(tree.stats(), self.tree.stats())
+        self.assertEqual(sizes, {0: 10, 2: 30})
+
+    def test_without_sizes(self):
+        self.save()
+        self.assertIsNone(load_snapshot(self.file_name)[3])
+
+    def test_odd_node_counts(self):
+        # the offsets are 8-byte aligned whatever the number of nodes.
+        for count in range(1, 4):
+            self.tree = sample_tree(FILES + [("odd{0}".format(extra), 3) for extra in range(count)])
+            self.save()
+            self.assertEqual(paths(load_snapshot(self.file_name)[2]), paths(self.tree))
+
+    def test_removed_nodes(self):
+        self.tree.remove(self.tree.first_child[CompactTree.ROOT])
+        self.save()
+        self.assertEqual(paths(load_snapshot(self.file_name)[2]), paths(self.tree))
+
+    def test_modifications_stay_private(self):
+        data = self.save()
+        tree = load_snapshot(self.file_name)[2]
+        tree.remove(tree.first_child[CompactTree.ROOT])
+        with open(self.file_name, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_truncated(self):
+        data = self.save({0: 10})
+        for size in (0, HEADER.size - 1, HEADER.size, len(data) - 1):
+            self.write(data[:size])
+            self.assertRejected()
+
+    def test_corrupted(self):
+        data = self.save()
+        data[-1] ^= 1
+        self.write(data)
+        self.assertRejected("checksum")
+
+    def test_corrupted_header(self):
+        data = self.save()
+        data[20] ^= 1
+        self.write(data)
+        self.assertRejected("header")
+
+    def test_not_a_snapshot(self):
+        self.write(b"\x80\x04" + bytes(HEADER.size))
+        self.assertRejected("not a snapshot")
+
+    def test_invalid_trees(self):
+        data = self.save()
+        child = self.tree.first_child[CompactTree.ROOT]
+        for name, node, value, message in (("first_child", 1, 999, "out of range"),
+                                           ("next_sibling", child, child, "reached twice"),
+                                           ("next_sibling", child, CompactTree.ROOT, "reached twice"),
+                                           ("names", 1, 999, "string id"),
+                                           ("parents", child, 999, "out of range"),
+                                           ("udids", child, -2, "duplicate id")):
+            invalid = bytearray(data)
+            self.set_value(invalid, name, node, value)
+            self.write_checksummed(invalid)
+            self.assertRejected(message)
+
+    def test_trusted(self):
+        # a trusted snapshot skips the checksum - the layout is still checked.
+        data = self.save()
+        data[-1] ^= 1
+        self.write(data)
+        load_snapshot(self.file_name, verify=False)
+        self.write(data[:-1])
+        self.assertRejected(verify=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
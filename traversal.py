@@ -0,0 +1,94 @@
+from collections import deque
+
+# Explicit-stack tree traversals shared by all tree operations of both engines.
+# No recursion: the depth of a tree (node_modules, nested backups, ...) does not matter and there is no
+# frame per node. children(node) returns the children of a node (any iterable, in their natural order);
+# returning an empty iterable prunes the subtree. All traversals visit children in that order.
+
+def preorder(root, children):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(list(children(node))))
+
+# like preorder, yields (node, depth) with depth 0 for root.
+def preorder_with_depth(root, children):
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        stack.extend((child, depth + 1) for child in reversed(list(children(node))))
+
+# like preorder, yields (parent, node) with parent None for root.
+def preorder_edges(root, children):
+    stack = [(None, root)]
+    while stack:
+        parent, node = stack.pop()
+        yield parent, node
+        stack.extend((node, child) for child in reversed(list(children(node))))
+
+# every node after all of its children.
+def postorder(root, children):
+    stack = [(root, iter(children(root)))]
+    while stack:
+        node, pending = stack[-1]
+        for child in pending:
+            stack.append((child, iter(children(child))))
+            break
+        else:
+            stack.pop()
+            yield node
+
+# breadth first, root first.
+def levelorder(root, children):
+    queue = deque([root])
+    while queue:
+        node = queue.popleft()
+        yield node
+        queue.extend(children(node))
+
+# node, its parent, ... up to the root. parent(node) returns None for the root.
+def ancestors(node, parent):
+    while node is not None:
+        yield node
+        node = parent(node)
+
+# like preorder, yields (node, path). The path of a child is join(path of its parent, child), so every
+# path is built from the already resolved path of the parent instead of walking up to the root again.
+def preorder_with_path(root, children, root_path, join):
+    stack = [(root, root_path)]
+    while stack:
+        node, path = stack.pop()
+        yield node, path
+        stack.extend((child, join(path, child)) for child in reversed(list(children(node))))
+
+# like postorder, yields (node, path) - see preorder_with_path.
+def postorder_with_path(root, children, root_path, join):
+    stack = [(root, root_path, iter(children(root)))]
+    while stack:
+        node, path, pending = stack[-1]
+        for child in pending:
+            child_path = join(path, child)
+            stack.append((child, child_path, iter(children(child))))
+            break
+        else:
+            stack.pop()
+            yield node, path
+
+
+# the accessors for the Node trees of process_fdups.py - shared by all modules working on them.
+
+def children(node):
+    return node.children.values()
+
+def subfolders(node):
+    return [child for child in node.children.values() if child.children]
+
+def parent(node):
+    return node.parent
+
+# the path of node, given the path of its parent (see Node.path).
+def join_path(parent_path, node):
+    # root is special.
+    return ("" if parent_path == "/" else parent_path) + "/" + node.name
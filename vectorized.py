@@ -0,0 +1,121 @@
+import numpy as np
+
+from compact_tree import CompactTree, NO_NODE
+
+# NumPy engine for the signature and grouping passes of the compact backend (process_fdups.py -b numpy).
+# compact_tree.find_identical_folders hashes one folder at a time in the interpreter; here the arrays of the
+# CompactTree are used as they are (no copy) and every pass works on all nodes of one depth at once:
+#
+#   1. depth of every node (by following the parents of all nodes in lockstep).
+#   2. bottom-up, one level at a time: the signatures of the nodes of a level are finished and added to
+#      their parents with np.add.at - a scatter-add, so the order of the children does not matter.
+#   3. the folders are sorted by signature (np.lexsort) and cut into groups where the signature changes.
+#
+# Signatures are 128 bits in two independent 64-bit lanes. A file hashes its udid with splitmix64; a folder
+# mixes the sum (mod 2**64) of its children's hashes with splitmix64 again - the mixing keeps a folder from
+# colliding with the sum of its own contents one level up. Not a cryptographic hash like signature.py, but
+# equal signatures for different content need a 128 bit collision of a well-mixed function.
+
+# distinct seeds per lane and per kind of node.
+LEAF_SEEDS = (np.uint64(0x243F6A8885A308D3), np.uint64(0x13198A2E03707344))
+FOLDER_SEEDS = (np.uint64(0xA4093822299F31D0), np.uint64(0x082EFA98EC4E6C89))
+
+
+def splitmix64(values):
+    with np.errstate(over="ignore"):
+        z = values + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+# the arrays of tree as NumPy arrays - views, not copies.
+def _arrays(tree):
+    parents = np.frombuffer(tree.parents, dtype=np.intc)
+    udids = np.frombuffer(tree.udids, dtype=np.intc)
+    return parents, udids
+
+# nodes still in the tree (the root included) and the files among them.
+def _alive(parents, udids):
+    alive = parents != NO_NODE
+    alive[CompactTree.ROOT] = True
+    return alive, alive & (udids != NO_NODE)
+
+def depths(parents, alive):
+    depth = np.zeros(len(parents), dtype=np.intc)
+    ancestor = np.where(alive, parents, NO_NODE)
+    ancestor[CompactTree.ROOT] = NO_NODE
+    # one step up per round, for all nodes at once - as many rounds as the tree is deep.
+    while True:
+        climbing = ancestor != NO_NODE
+        if not climbing.any():
+            return depth
+        depth[climbing] += 1
+        ancestor[climbing] = parents[ancestor[climbing]]
+
+
+# Returns (lanes, file_counts): the two signature lanes and the number of files below every node
+# (1 for files). Removed nodes get zeros.
+def compute_signatures(tree):
+    parents, udids = _arrays(tree)
+    alive, files = _alive(parents, udids)
+    depth = depths(parents, alive)
+    size = len(parents)
+
+    sums = [np.zeros(size, dtype=np.uint64), np.zeros(size, dtype=np.uint64)]
+    lanes = [np.zeros(size, dtype=np.uint64), np.zeros(size, dtype=np.uint64)]
+    file_counts = files.astype(np.int64)
+    leaf_udids = udids.astype(np.uint64)
+
+    # the alive nodes ordered by depth, deepest last.
+    order = np.flatnonzero(alive)
+    order = order[np.argsort(depth[order], kind="stable")]
+    bounds = np.searchsorted(depth[order], np.arange(depth[order[-1]] + 2))
+    for level in range(len(bounds) - 2, 0, -1):
+        nodes = order[bounds[level]:bounds[level + 1]]
+        level_files = files[nodes]
+        leaves, folders = nodes[level_files], nodes[~level_files]
+        targets = parents[nodes]
+        for lane in range(2):
+            with np.errstate(over="ignore"):
+                lanes[lane][leaves] = splitmix64(leaf_udids[leaves] ^ LEAF_SEEDS[lane])
+                lanes[lane][folders] = splitmix64(sums[lane][folders] ^ FOLDER_SEEDS[lane])
+            np.add.at(sums[lane], targets, lanes[lane][nodes])
+        np.add.at(file_counts, targets, file_counts[nodes])
+    for lane in range(2):
+        lanes[lane][CompactTree.ROOT] = splitmix64(sums[lane][CompactTree.ROOT] ^ FOLDER_SEEDS[lane])
+    return lanes, file_counts
+
+
+# Counterpart of compact_tree.find_identical_folders: yields lists of folder indices, largest groups first
+# (groups of the same size ordered by their first folder). The groups live in the sorted arrays - a list is
+# only made for the group handed out.
+def find_identical_folders(tree):
+    parents, udids = _arrays(tree)
+    alive, files = _alive(parents, udids)
+    lanes, _ = compute_signatures(tree)
+
+    folders = np.flatnonzero(alive & ~files)
+    folders = folders[folders != CompactTree.ROOT]
+    if not len(folders):
+        return
+    first, second = lanes[0][folders], lanes[1][folders]
+    # by signature, equal signatures by index.
+    order = np.lexsort((folders, second, first))
+    first, second, folders = first[order], second[order], folders[order]
+    starts = np.flatnonzero(np.concatenate(([True], (first[1:] != first[:-1]) | (second[1:] != second[:-1]))))
+    sizes = np.diff(np.append(starts, len(folders)))
+    duplicated = sizes > 1
+    starts, sizes = starts[duplicated], sizes[duplicated]
+    # largest first, then by the first folder.
+    ranking = np.lexsort((folders[starts], -sizes))
+    for start, group_size in zip(starts[ranking].tolist(), sizes[ranking].tolist()):
+        yield folders[start:start + group_size].tolist()
+
+
+# Counterpart of CompactTree.stats: files and folders below the root.
+def stats(tree):
+    parents, udids = _arrays(tree)
+    alive, files = _alive(parents, udids)
+    file_count = int(files.sum())
+    return file_count, int(alive.sum()) - file_count - 1
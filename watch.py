@@ -0,0 +1,286 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from listing import ListingCache, check_folder, MISSING, UNIQUE
+from traversal import preorder, preorder_with_path, ancestors, subfolders, parent, join_path
+
+# Watch mode for process_fdups.py (Linux only): keeps a purged Node tree and its groups of identical
+# folders up to date while the filesystem changes, instead of rebuilding and re-verifying everything.
+#
+# Every surviving folder gets an inotify watch. When files are created, deleted, renamed or written in a
+# folder, only that folder is checked again (listing.check_folder, like the purge):
+#   - a file that fdupes did not report (new, moved in, overwritten) makes the folder unique: its files
+#     are dropped, like drop_unique_folders does it.
+#   - files and folders that are gone are dropped from the tree.
+#   - a folder that lost all its children is dropped, and so is every parent left empty.
+# Only the signatures up the changed ancestor chains are invalidated and recomputed, and the groups of
+# identical folders (signature -> folders) are updated for those folders only: the work done per change
+# is proportional to the depth of the tree and the size of the changed folders, not to the whole tree.
+#
+# The tree only ever shrinks: new files are unknown to the report, so they can not be duplicates.
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+# the events a folder is watched for.
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+# events naming an entry whose content may be new to the report.
+NEW_CONTENT = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# struct inotify_event without the name: wd, mask, cookie, len.
+EVENT = struct.Struct("iIII")
+READ_SIZE = 1 << 16
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        code = ctypes.get_errno()
+        if code == errno.ENOSPC:
+            # /proc/sys/fs/inotify/max_user_watches
+            raise OSError(code, "too many inotify watches - raise fs.inotify.max_user_watches", path)
+        raise OSError(code, os.strerror(code), path)
+
+    # Returns the watch descriptor.
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # fails if the folder is gone already - the watch is gone with it.
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    # Waits up to timeout seconds (None: forever) and returns the events as (wd, mask, name) tuples.
+    def read_events(self, timeout=None):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, READ_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            # the name is padded with null bytes.
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TreeWatcher:
+    # root: a purged process_fdups.Node tree. inotify: for tests, an Inotify by default.
+    def __init__(self, root, inotify=None):
+        self.root = root
+        self.inotify = inotify if inotify is not None else Inotify()
+        # wd -> folder and back.
+        self.folders = {}
+        self.watches = {}
+        # signature -> set of folders (the root excluded), for every folder with a cached signature.
+        self.signatures = {}
+        # folders taken out of self.signatures because their signature is about to change.
+        self.changed = set()
+        # folders that could not be watched because they are gone - dropped by the next poll.
+        self.lost = set()
+        # the listing of the folder being checked - read twice, then dropped.
+        self.listings = ListingCache(keep=True)
+        # the DuplicateIndex of the tree (see process_fdups.RootNode), kept up to date - None if it has none.
+        self.index = getattr(root, "index", None)
+
+    # watches all folders of the tree and groups them.
+    def start(self):
+        for folder, path in preorder_with_path(self.root, subfolders, self.root.path(), join_path):
+            self._watch(folder, path)
+        self.root.signature()
+        for folder in preorder(self.root, subfolders):
+            if folder is not self.root:
+                self.signatures.setdefault(folder._signature, set()).add(folder)
+
+    def _watch(self, folder, path):
+        try:
+            wd = self.inotify.add_watch(path)
+        except FileNotFoundError:
+            self.lost.add(folder)
+            return
+        self.folders[wd] = folder
+        self.watches[folder] = wd
+
+    # Returns the groups of identical folders, like process_fdups.find_identical_folders.
+    def identical_folders(self):
+        groups = [list(group) for group in self.signatures.values() if len(group) > 1]
+        return sorted(groups, key=len, reverse=True)
+
+    # Waits for events until delay seconds pass without one (or timeout seconds without any) and
+    # applies them. Returns the number of folders that changed the tree.
+    def poll(self, delay=0.5, timeout=None):
+        pending = {folder: set() for folder in self.lost}
+        self.lost = set()
+        overflow = False
+        events = self.inotify.read_events(timeout if not pending else 0)
+        while events:
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost - everything has to be checked.
+                    overflow = True
+                    continue
+                folder = self.folders.get(wd)
+                if folder is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # the folder is gone (or unmounted): the watch was removed by the kernel.
+                    del self.folders[wd]
+                    self.watches.pop(folder, None)
+                    pending.setdefault(folder, set())
+                    continue
+                names = pending.setdefault(folder, set())
+                if mask & NEW_CONTENT and name:
+                    names.add(name)
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and folder.parent is not None:
+                    # the parent sees the folder go.
+                    pending.setdefault(folder.parent, set())
+            events = self.inotify.read_events(delay)
+        if overflow:
+            pending = {folder: set() for folder in preorder(self.root, subfolders)}
+        # top-down: a folder dropped with its parent is not checked anymore.
+        depths = {folder: sum(1 for _ in ancestors(folder, parent)) for folder in pending}
+        changed = 0
+        for folder in sorted(pending, key=depths.get):
+            if self._attached(folder) and self._check(folder, pending[folder]):
+                changed += 1
+        self._regroup()
+        return changed
+
+    # runs until interrupted, calling on_change(number of folders changed) after every batch of changes.
+    def run(self, on_change, delay=0.5):
+        try:
+            while True:
+                changed = self.poll(delay)
+                if changed:
+                    on_change(changed)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.inotify.close()
+
+    def _attached(self, node):
+        for ancestor in ancestors(node, parent):
+            root = ancestor
+        return root is self.root
+
+    # checks a folder again. new_names: entries whose content may not be the one fdupes reported.
+    # Returns True if the tree changed.
+    def _check(self, folder, new_names):
+        path = folder.path()
+        self.listings.clear()
+        verdict = check_folder(path, folder.children, self.listings)
+        if verdict == MISSING:
+            self._drop(folder)
+            return True
+        if verdict != UNIQUE and any(name in folder.children and not folder.children[name].children
+                                     for name in new_names):
+            # a known name with new content (overwritten, or deleted and created again).
+            verdict = UNIQUE
+        try:
+            entries = self.listings.listing(path)
+        except PermissionError:
+            # unique (see check_folder) - whatever is gone, the files are dropped anyway.
+            entries = None
+        gone = []
+        if entries is not None:
+            on_disk = set(entries.files).union(entries.folders)
+            gone = [child for name, child in folder.children.items() if name not in on_disk]
+        files = [child for child in folder.children.values() if not child.children]
+        if not gone and (verdict != UNIQUE or not files):
+            # nothing the tree knows of is gone or new - e.g. a new file next to the subfolders.
+            return False
+
+        self._invalidate(folder)
+        for child in gone:
+            self._forget(child)
+            if self.index is not None:
+                self.index.discard_subtree(child)
+            child.parent = None
+            del folder.children[child.name]
+        if verdict == UNIQUE:
+            folder.drop_leafs(self.index)
+        if not folder.children:
+            self._drop(folder)
+        return True
+
+    # removes node, its subtree and every parent left empty from the tree.
+    def _drop(self, node):
+        while node is not self.root:
+            above = node.parent
+            self._invalidate(above)
+            self._forget(node)
+            if self.index is not None:
+                self.index.discard_subtree(node)
+            node.parent = None
+            del above.children[node.name]
+            if above.children:
+                break
+            node = above
+
+    # takes the subtree of node out of the watches and the groups.
+    def _forget(self, node):
+        for folder in preorder(node, subfolders):
+            wd = self.watches.pop(folder, None)
+            if wd is not None:
+                del self.folders[wd]
+                self.inotify.rm_watch(wd)
+            self._ungroup(folder)
+            self.changed.discard(folder)
+            self.lost.discard(folder)
+
+    # the signatures of folder and its ancestors are about to change.
+    def _invalidate(self, folder):
+        for ancestor in ancestors(folder, parent):
+            if ancestor in self.changed:
+                # and so are those of all of its ancestors - taken care of already.
+                break
+            self._ungroup(ancestor)
+            self.changed.add(ancestor)
+        folder.invalidate_signature()
+
+    def _ungroup(self, folder):
+        group = self.signatures.get(folder._signature)
+        if group is not None:
+            group.discard(folder)
+            if not group:
+                del self.signatures[folder._signature]
+
+    # recomputes the signatures of the changed folders (only those are uncached) and groups them again.
+    def _regroup(self):
+        self.root.signature()
+        for folder in self.changed:
+            if folder is not self.root and folder.parent is not None:
+                self.signatures.setdefault(folder._signature, set()).add(folder)
+        self.changed = set()
+